@@ -0,0 +1,39 @@
+# app/api/middleware.py - Id de pedido propagado aos logs, às métricas e ao cabeçalho da resposta
+import re
+import uuid
+from app.utils.logger import logger
+from app.utils.metrics import id_pedido
+
+# Ids vindos do cliente/proxy só são aceites se forem curtos e sem caracteres estranhos
+_ID_VALIDO = re.compile(r"^[\w.\-]{1,64}$")
+
+class RequestIdMiddleware:
+    """Atribui um id a cada pedido HTTP (ou reaproveita o `X-Request-ID` recebido).
+
+    ASGI puro, para não bufferizar os streams SSE. O id fica em `id_pedido`
+    (herdado pelas tarefas criadas durante o pedido), é adicionado às linhas de
+    log via `logger.contextualize` e devolvido no cabeçalho `X-Request-ID`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        recebido = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        pedido = recebido if _ID_VALIDO.match(recebido) else uuid.uuid4().hex
+
+        async def enviar(mensagem):
+            if mensagem["type"] == "http.response.start":
+                mensagem["headers"] = [*mensagem.get("headers", []), (b"x-request-id", pedido.encode("latin-1"))]
+            await send(mensagem)
+
+        token = id_pedido.set(pedido)
+        try:
+            with logger.contextualize(request_id=pedido):
+                await self.app(scope, receive, enviar)
+        finally:
+            id_pedido.reset(token)
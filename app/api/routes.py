@@ -1,14 +1,27 @@
-from fastapi import APIRouter, Request
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse
 from app.api.schemas import ChatRequest
 from app.core.config import settings
+from app.core.admission import ServidorOcupado, controlo_admissao
+from app.core.degeneration import estatisticas_degeneracao
+from app.core.history_store import criar_history_store
+from app.core.snapshots import SnapshotIndisponivel
+from app.core.llm import definir_sessao
+from app.core.retrieval import definir_areas
+from app.core.response_cache import cache_respostas, chave_prompt, estatisticas_caches, limpar_caches, normalizar_pergunta
 from app.utils.logger import logger
+from app.utils.metrics import (
+    duracao_pedidos, geracoes_canceladas, id_pedido, iniciar_pedido, medir, pedidos_chat, registar_etapa, registo,
+    resumo_etapas,
+)
+from app.utils.streaming import SSE_PROTOCOL_VERSION, GeracaoPartilhada, TokenQueueHandler, iterar_deltas
 import os
 import json
 import uuid
 import asyncio
 import re
 import html
+import time
 from urllib.parse import quote # Importar quote para URLs seguras
 
 router = APIRouter()
@@ -16,8 +29,14 @@ router = APIRouter()
 # Variáveis globais para RAG
 _vectorstore = None
 _rag_chain = None
-_initialized = False
-_initialization_failed = False
+_ingestion_worker = None
+_vigia_snapshots = None  # só nos modos "multi" e "reader" (ver app/core/snapshots.py)
+# Carregamento do índice em segundo plano: o /readyz só responde 200 quando `estado` for "pronto"
+_arranque = {"estado": "a_iniciar", "tentativas": 0, "ultimo_erro": None, "duracao_s": None}
+_areas_conhecimento = []  # títulos do manifesto, relidos só quando o índice muda
+_geracoes_em_curso = {}  # chave da resposta -> GeracaoPartilhada
+# Histórico das conversas por session_id (o cookie só transporta o id)
+_historico = criar_history_store()
 
 # --- Funções Auxiliares ---
 
@@ -41,28 +60,312 @@ def _remover_duplicacao(texto: str, logger) -> str:
             return primeira_metade
     return texto
 
-def _initialize_rag():
-    """Inicializa o vectorstore e a RAG chain."""
-    global _vectorstore, _rag_chain, _initialized, _initialization_failed
-    if _initialized or _initialization_failed: return _initialized
+def _formatar_fontes(source_docs):
+    """Devolve (fontes agrupadas por ficheiro, trechos com URL do PDF) para os eventos SSE."""
+    fontes_formatadas = []
+    source_chunks_content = []
+    if not source_docs: return fontes_formatadas, source_chunks_content
+    unique_sources = {}
+    logger.debug(f"Recuperados {len(source_docs)} trechos.")
+    for i, doc in enumerate(source_docs):
+        source_path = doc.metadata.get("source", "Desconhecido")
+        source_name = os.path.basename(source_path)
+        page_meta = doc.metadata.get("page")
+        page_num = (int(page_meta) + 1) if isinstance(page_meta, (int, float, str)) and str(page_meta).isdigit() else "?"
+
+        if source_name not in unique_sources: unique_sources[source_name] = set()
+        unique_sources[source_name].add(str(page_num))
+
+        # --- ALTERAÇÃO AQUI: Adiciona URL ---
+        pdf_url = f"/pdfs/{quote(source_name)}" # Cria URL seguro
+
+        source_chunks_content.append({
+            "id": f"chunk_{i}",
+            "source": f"{source_name} (pág. {page_num})",
+            "content": html.escape(doc.page_content),
+            "url": pdf_url  # Adiciona o URL do PDF
+        })
+
+    fontes_formatadas = [f"{name} (pág. {', '.join(sorted(pages))})" for name, pages in unique_sources.items()]
+    logger.debug(f"Fontes formatadas: {fontes_formatadas}")
+    logger.debug(f"Enviando {len(source_chunks_content)} trechos com URLs.")
+    return fontes_formatadas, source_chunks_content
+
+def _chave_resposta(rag_chain, pergunta, areas):
+    """Chave da cache de respostas e das gerações partilhadas: versão do chunk store,
+    áreas pedidas e pergunta normalizada.
+
+    Não depende do tipo de retriever (híbrido ou só vetorial) nem faz a recuperação:
+    com o índice fixo, estes três valores já determinam os chunks e o prompt.
+    """
+    vectorstore = getattr(rag_chain.retriever, "vectorstore", None)
+    versao = getattr(getattr(vectorstore, "docstore", None), "versao", None)
+    if versao is None:
+        return None
+    return chave_prompt(versao, areas or (), normalizar_pergunta(pergunta))
+
+def _obter_geracao(chave, sessao):
+    """Devolve (geração, senha): junta-se a uma geração em curso com a mesma chave (senha None)
+    ou cria uma nova, já com lugar pedido no `controlo_admissao` em nome de `sessao`.
+
+    A vez é pedida antes de registar a geração: um `ServidorOcupado` só chega a este
+    pedido, nunca a subscritores que se juntariam depois.
+    """
+    if chave is not None:
+        geracao = _geracoes_em_curso.get(chave)
+        if geracao is not None and not geracao.abandonada:
+            return geracao, None
+    senha = controlo_admissao.pedir(sessao)
+    geracao = GeracaoPartilhada()
+    if chave is not None:
+        _geracoes_em_curso[chave] = geracao
+    else:
+        logger.debug("🔗 Pergunta com histórico (ou índice sem versão): geração própria, sem agrupamento")
+    return geracao, senha
+
+async def _dispensa_llm(rag_chain, session_id, body):
+    """True se o pedido pode ser servido sem vez no LLM: resposta em cache ou geração idêntica em curso."""
+    if session_id and await asyncio.to_thread(_historico.obter, session_id):
+        return False  # Com histórico não há chave partilhada: gera sempre
+    chave = _chave_resposta(rag_chain, body.message, body.areas)
+    if chave is None:
+        return False
+    geracao = _geracoes_em_curso.get(chave)
+    return cache_respostas.contem(chave) or (geracao is not None and not geracao.abandonada)
+
+async def _gerar_resposta(geracao, rag_chain, pergunta, historico, chave_resposta, senha):
+    """Executa a chain uma vez e difunde os deltas e o resultado final para os subscritores.
+
+    Corre numa tarefa própria: a desconexão de um cliente não interrompe os restantes.
+    Antes de chamar o LLM, espera que a `senha` do `controlo_admissao` seja concedida.
+    """
+    tarefa = None
     try:
-        from app.core.rag import criar_vectorstore, criar_rag_chain
-        logger.info("🚀 Inicializando sistema RAG...")
-        _vectorstore = criar_vectorstore()
-        if not _vectorstore: logger.warning("⚠️ Nenhum documento RAG encontrado.")
-        else:
-            _rag_chain = criar_rag_chain(_vectorstore)
-            logger.success("✅ Sistema RAG inicializado!")
-        _initialized = True
-        return True
+        async for posicao, eta in controlo_admissao.esperar(senha):
+            logger.debug(f"⏳ Na fila do LLM: posição {posicao}")
+            geracao.na_fila(posicao, eta)
+        geracao.admitir()
+
+        handler = TokenQueueHandler()
+        tarefa = asyncio.ensure_future(rag_chain.ainvoke(
+            {"question": pergunta, "chat_history": historico},
+            config={"callbacks": [handler]}
+        ))
+        logger.debug("Iniciando streaming de 'chunk'")
+        async for delta in iterar_deltas(
+            handler, tarefa,
+            intervalo=settings.SSE_FLUSH_INTERVAL_MS / 1000,
+            max_chars=settings.SSE_FLUSH_MAX_CHARS
+        ):
+            geracao.publicar(delta.replace('\\', '\\\\')) # Ajuste LaTeX
+        logger.debug("Finalizado streaming de 'chunk'")
+        result = await tarefa
+
+        # Processa a resposta
+        raw_answer = result.get("answer", "").strip()
+        with medir("postprocess"):
+            resposta_limpa = _limpar_resposta_llm(raw_answer)
+            resposta_sem_duplicacao = _remover_duplicacao(resposta_limpa, logger)
+        resposta_final = resposta_sem_duplicacao.replace('\\', '\\\\') # Ajuste LaTeX
+
+        gerada = bool(resposta_final)
+        if not gerada:
+            resposta_final = "Desculpe, não consegui formular uma resposta."
+        logger.info(f"📝 Resposta Gerada (início): {resposta_final[:100]}...")
+
+        fontes_formatadas, source_chunks_content = _formatar_fontes(result.get("source_documents", []))
+        resultado = {"resposta": resposta_final, "fontes": fontes_formatadas, "trechos": source_chunks_content}
+        if chave_resposta and gerada:
+            cache_respostas.guardar(chave_resposta, resultado)
+        geracao.concluir(resultado)
+    except asyncio.CancelledError as e:
+        logger.info("🛑 Geração cancelada: todos os clientes desligaram")
+        geracoes_canceladas.inc()
+        # Cancelar a chain fecha o stream HTTP do LLM; o llama.cpp deixa de gerar para o slot
+        if tarefa is not None:
+            tarefa.cancel()
+        geracao.concluir(erro=e)
+        raise
     except Exception as e:
-        logger.critical("❌ Falha crítica ao inicializar RAG: {}", e, exc_info=True)
-        _initialization_failed = True
-        return False
+        if tarefa is not None:
+            tarefa.cancel()
+        geracao.concluir(erro=e)
+    finally:
+        if chave_resposta is not None and _geracoes_em_curso.get(chave_resposta) is geracao:
+            del _geracoes_em_curso[chave_resposta]
+
+async def _vigiar_desconexao(request, desligado):
+    """Ativa `desligado` quando o cliente do stream SSE fechar a ligação."""
+    while not await request.is_disconnected():
+        await asyncio.sleep(settings.SSE_DISCONNECT_POLL_MS / 1000)
+    desligado.set()
+
+def _atualizar_areas_conhecimento():
+    global _areas_conhecimento
+    try:
+        from app.core.rag import carregar_areas_conhecimento
+        _areas_conhecimento = carregar_areas_conhecimento()
+    except Exception as e:
+        logger.error("Erro ao ler manifesto: {}", e)
+
+def _modo_snapshots():
+    if settings.WORKER_MODE not in ("single", "multi", "reader"):
+        raise ValueError(f"WORKER_MODE desconhecido: {settings.WORKER_MODE}")
+    return settings.WORKER_MODE != "single"
+
+def _initialize_rag():
+    """Carrega (ou constrói) o vectorstore e cria a RAG chain; levanta a exceção se falhar.
+
+    Pode demorar: com PDFs novos inclui a ingestão. Corre numa thread, a partir de `arrancar_rag`.
+    Com vários workers, só o que obtém o lock de ingestão indexa e publica um snapshot;
+    todos (incluindo ele) servem o snapshot atual, mapeado só para leitura.
+    """
+    global _vectorstore, _rag_chain
+    from app.core.rag import carregar_snapshot, criar_vectorstore, criar_rag_chain
+    from app.core.snapshots import bloqueio_ingestao, publicar_snapshot
+    logger.info("🚀 Inicializando sistema RAG...")
+    if not _modo_snapshots():
+        vectorstore = criar_vectorstore()
+    else:
+        lider = settings.WORKER_MODE == "multi" and bloqueio_ingestao.adquirir()
+        if lider:
+            logger.info(f"👑 Worker {os.getpid()} obteve o lock: faz a ingestão e publica os snapshots")
+            # A cópia devolvida é descartada: o líder também serve o snapshot mapeado
+            if criar_vectorstore() is not None:
+                publicar_snapshot()
+        try:
+            versao, vectorstore = carregar_snapshot()
+        except SnapshotIndisponivel:
+            if not lider:
+                raise
+            # Sem documentos nem snapshot anterior: o líder fica pronto (para ingerir) e o vigia
+            # carrega o primeiro snapshot que a ingestão publicar, como nos outros workers
+            logger.warning("⚠️ Nenhum documento RAG encontrado: à espera do primeiro snapshot")
+            _iniciar_vigia_snapshots(None)
+            return
+        logger.info(f"📸 A servir o snapshot {versao}")
+        _iniciar_vigia_snapshots(versao)
+    if not vectorstore:
+        logger.warning("⚠️ Nenhum documento RAG encontrado.")
+        return
+    _vectorstore, _rag_chain = vectorstore, criar_rag_chain(vectorstore)
+    _atualizar_areas_conhecimento()
+    logger.success("✅ Sistema RAG inicializado!")
+
+async def arrancar_rag():
+    """Tarefa de arranque: carrega o índice com novas tentativas, aquece e liga a ingestão.
+
+    O uvicorn aceita ligações desde o início (o /healthz responde), mas o /readyz só fica
+    pronto no fim. Cada falha espera `STARTUP_RETRY_INITIAL` segundos, a duplicar até
+    `STARTUP_RETRY_MAX`, antes de tentar de novo.
+    """
+    inicio = time.monotonic()
+    if _modo_snapshots() and settings.HISTORY_BACKEND == "memory":
+        logger.warning("⚠️ HISTORY_BACKEND=memory com vários workers: cada worker guarda o seu histórico (use sqlite)")
+    # O manifesto já existe desde a última execução: as áreas ficam disponíveis de imediato
+    await asyncio.to_thread(_atualizar_areas_conhecimento)
+    espera = settings.STARTUP_RETRY_INITIAL
+    while True:
+        _arranque["tentativas"] += 1
+        try:
+            await asyncio.to_thread(_initialize_rag)
+            break
+        except SnapshotIndisponivel:
+            # Worker sem o lock: espera que o líder (ou `python -m app.ingest`) publique o índice
+            _arranque["estado"] = "a_aguardar_snapshot"
+            logger.info("⏳ À espera do primeiro snapshot do índice...")
+            await asyncio.sleep(settings.SNAPSHOT_POLL_INTERVAL)
+        except Exception as e:
+            _arranque.update(estado="erro", ultimo_erro=str(e))
+            logger.critical(
+                f"❌ Falha ao inicializar RAG (tentativa {_arranque['tentativas']}), nova tentativa em {espera:.0f}s: {e}",
+                exc_info=True
+            )
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, settings.STARTUP_RETRY_MAX)
+
+    if _vectorstore is not None and settings.STARTUP_WARMUP:
+        _arranque["estado"] = "a_aquecer"
+        from app.core.warmup import aquecer
+        await aquecer(_vectorstore)
+    _arranque.update(estado="pronto", ultimo_erro=None, duracao_s=round(time.monotonic() - inicio, 2))
+    logger.success(f"🟢 Pronto para responder ({_arranque['duracao_s']}s após o arranque)")
+    # Só agora: a ingestão e o arranque não podem escrever no índice ao mesmo tempo
+    if not _modo_snapshots() or _e_lider():
+        iniciar_ingestao_em_segundo_plano()
+
+def _trocar_vectorstore(vectorstore):
+    """Constrói a chain para o novo índice e troca ambos de uma vez.
+
+    Os pedidos em curso mantêm a referência à chain antiga até terminarem.
+    """
+    global _vectorstore, _rag_chain
+    if vectorstore is None:
+        # Todos os PDFs foram apagados: deixa de responder com os documentos antigos
+        if _rag_chain is not None:
+            logger.warning("⚠️ Nenhum documento RAG restante: índice retirado")
+        _vectorstore, _rag_chain = None, None
+        limpar_caches()
+        _atualizar_areas_conhecimento()
+        return
+    from app.core.rag import criar_rag_chain
+    nova_chain = criar_rag_chain(vectorstore)
+    _vectorstore, _rag_chain = vectorstore, nova_chain
+    # As entradas já não coincidem com a nova versão do índice: liberta a memória
+    limpar_caches()
+    _atualizar_areas_conhecimento()
+
+def _e_lider():
+    from app.core.snapshots import bloqueio_ingestao
+    return bloqueio_ingestao.detido
+
+def _publicar_ingestao(vectorstore):
+    """Com snapshots, a ingestão só publica: a troca é feita pelo vigia, como nos outros workers."""
+    from app.core.snapshots import publicar_snapshot
+    if vectorstore is not None:
+        publicar_snapshot()
+    else:
+        logger.warning("⚠️ Nenhum documento RAG restante: os workers mantêm o último snapshot publicado")
+
+def _carregar_versao(versao):
+    from app.core.rag import carregar_snapshot
+    _, vectorstore = carregar_snapshot(versao)
+    _trocar_vectorstore(vectorstore)
+    logger.success(f"📸 Snapshot {versao} carregado e índice trocado")
+
+def _assumir_ingestao():
+    # O líder anterior pode ter deixado PDFs por indexar: corre já uma ingestão
+    iniciar_ingestao_em_segundo_plano().solicitar()
+
+def _iniciar_vigia_snapshots(versao):
+    global _vigia_snapshots
+    if _vigia_snapshots is not None: return
+    from app.core.snapshots import VigiaSnapshots
+    _vigia_snapshots = VigiaSnapshots(
+        versao,
+        ao_mudar=_carregar_versao,
+        ao_liderar=_assumir_ingestao if settings.WORKER_MODE == "multi" else None,
+        ao_pedir_reindexacao=lambda: iniciar_ingestao_em_segundo_plano().solicitar(),
+    )
+    _vigia_snapshots.iniciar()
+
+def iniciar_ingestao_em_segundo_plano():
+    """Arranca o worker que vigia a pasta de PDFs e troca o índice a quente (ou publica um snapshot)."""
+    global _ingestion_worker
+    if _ingestion_worker is None:
+        from app.core.ingestion_worker import IngestionWorker
+        _ingestion_worker = IngestionWorker(ao_concluir=_publicar_ingestao if _modo_snapshots() else _trocar_vectorstore)
+        _ingestion_worker.iniciar()
+    return _ingestion_worker
+
+def parar_ingestao_em_segundo_plano():
+    if _ingestion_worker is not None:
+        _ingestion_worker.parar()
+    if _vigia_snapshots is not None:
+        _vigia_snapshots.parar()
 
 def get_rag_chain():
-    """Retorna a RAG chain inicializada."""
-    if not _initialize_rag(): return None
+    """Retorna a RAG chain, ou None enquanto o índice não estiver carregado (ou sem documentos)."""
     return _rag_chain
 
 # --- Endpoints da API ---
@@ -77,23 +380,79 @@ async def index():
     else:
         logger.error(f"Ficheiro index.html não encontrado em: {static_file_path}")
         # Retorna um erro 404 se o ficheiro não existir
-        from fastapi import HTTPException
         raise HTTPException(status_code=404, detail="index.html não encontrado")
 
 
 @router.get("/knowledge-areas")
 async def get_knowledge_areas():
-    """Retorna a lista de áreas de conhecimento (títulos dos PDFs)."""
-    _initialize_rag()
-    manifest_path = os.path.join(settings.vectorstore_path, "manifest.json")
-    if not os.path.exists(manifest_path): return {"areas": []}
-    try:
-        with open(manifest_path, "r", encoding="utf-8") as f:
-            manifest_data = json.load(f)
-            return {"areas": sorted(list(set(manifest_data.values())))}
-    except Exception as e:
-        logger.error("Erro ao ler manifesto: {}", e)
-        return {"areas": []}
+    """Retorna a lista de áreas de conhecimento (títulos dos PDFs), mantida em memória."""
+    return {"areas": _areas_conhecimento}
+
+@router.get("/healthz")
+async def healthz():
+    """Liveness: o processo está vivo e o event loop responde (não depende do índice)."""
+    return {"status": "ok"}
+
+@router.get("/readyz")
+async def readyz():
+    """Readiness: 200 só depois de o índice estar carregado e aquecido; 503 até lá."""
+    return JSONResponse(dict(_arranque), status_code=200 if _arranque["estado"] == "pronto" else 503)
+
+def _verificar_admin(token):
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Administração remota desativada (defina ADMIN_TOKEN).")
+    if token != settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=401, detail="Token de administração inválido.")
+
+@router.post("/reindex")
+async def reindex(x_admin_token: str = Header(default="")):
+    """Agenda uma reindexação em segundo plano (o /chat continua a responder com o índice atual)."""
+    _verificar_admin(x_admin_token)
+    if _arranque["estado"] != "pronto":
+        # O arranque já está a indexar; uma segunda ingestão escreveria no mesmo índice
+        raise HTTPException(status_code=409, detail="O índice ainda está a ser carregado.")
+    if settings.WORKER_MODE == "reader":
+        raise HTTPException(status_code=409, detail="A ingestão corre à parte: use `python -m app.ingest`.")
+    if _modo_snapshots() and not _e_lider():
+        # Só o líder escreve o índice: o pedido fica num ficheiro que ele verifica periodicamente
+        from app.core.snapshots import pedir_reindexacao
+        pedir_reindexacao()
+        return {"agendado": True, "status": None, "lider": False}
+    worker = iniciar_ingestao_em_segundo_plano()
+    agendado = worker.solicitar()
+    return {"agendado": agendado, "status": worker.status}
+
+@router.get("/reindex/status")
+async def reindex_status(x_admin_token: str = Header(default="")):
+    """Estado da ingestão em segundo plano."""
+    _verificar_admin(x_admin_token)
+    snapshot = _vigia_snapshots.versao if _vigia_snapshots is not None else None
+    if _ingestion_worker is None: return {"status": None, "snapshot": snapshot}
+    return {"status": _ingestion_worker.status, "snapshot": snapshot}
+
+@router.get("/cache/stats")
+async def cache_stats(x_admin_token: str = Header(default="")):
+    """Acertos, falhas e ocupação das caches de recuperação e de respostas."""
+    _verificar_admin(x_admin_token)
+    return estatisticas_caches()
+
+@router.get("/llm/stats")
+async def llm_stats(x_admin_token: str = Header(default="")):
+    """Gerações interrompidas por repetição ou por desconexão e o que ficou por gerar."""
+    _verificar_admin(x_admin_token)
+    return {
+        "degeneracao": estatisticas_degeneracao.como_dict(),
+        "chat": {
+            **{desfecho: valor for (desfecho,), valor in pedidos_chat.valores().items()},
+            "geracoes_canceladas": sum(geracoes_canceladas.valores().values()),
+        },
+        "admissao": controlo_admissao.estatisticas(),
+    }
+
+@router.get("/metrics")
+async def metrics():
+    """Métricas no formato de texto do Prometheus (latência por etapa, caches, fila, LLM)."""
+    return PlainTextResponse(registo.exportar(), media_type="text/plain; version=0.0.4")
 
 @router.post("/chat")
 async def chat(request: Request, body: ChatRequest):
@@ -104,9 +463,23 @@ async def chat(request: Request, body: ChatRequest):
 
     rag_chain = get_rag_chain()
     if not rag_chain:
-        async def rag_error(): yield 'data: {"type": "error", "content": "Sistema RAG indisponível."}\\n\\n'
+        mensagem = "Sistema RAG indisponível." if _arranque["estado"] == "pronto" else "O sistema ainda está a carregar os documentos: tente novamente dentro de instantes."
+        async def rag_error(): yield f'data: {json.dumps({"type": "error", "content": mensagem})}\n\n'
         return StreamingResponse(rag_error(), media_type="text/event-stream")
 
+    session_id = request.cookies.get("session_id") or str(uuid.uuid4())
+
+    # Fila cheia (ou a sessão já com o máximo de pedidos em espera): recusa já, em vez de
+    # deixar o pedido esperar até ao timeout. Só quem precisa de uma geração nova: respostas
+    # em cache e gerações em curso não ocupam o LLM
+    if controlo_admissao.recusaria(session_id) and not await _dispensa_llm(rag_chain, request.cookies.get("session_id"), body):
+        pedidos_chat.inc(outcome="rejeitado")
+        espera = controlo_admissao.eta(controlo_admissao.max_fila) or 10
+        raise HTTPException(
+            status_code=429, detail="Servidor ocupado: tente novamente dentro de instantes.",
+            headers={"Retry-After": str(max(int(espera), 1))}
+        )
+
     async def event_stream():
         """Gera os eventos Server-Sent Events (SSE) para o frontend."""
         def format_sse(data: dict) -> str:
@@ -117,11 +490,17 @@ async def chat(request: Request, body: ChatRequest):
                 logger.error("Erro serialização SSE: {}", e)
                 return f"data: {json.dumps({'type': 'error', 'content': 'Erro interno ao formatar resposta.'})}\n\n"
 
+        # Sem isto, um cliente que fecha o separador só é notado no próximo envio
+        desligado = asyncio.Event()
+        # Os tempos das etapas são recolhidos antes de criar tarefas: estas herdam o contexto
+        etapas = iniciar_pedido()
+        inicio = time.perf_counter()
+        primeiro_chunk = True
+        vigia = asyncio.create_task(_vigiar_desconexao(request, desligado))
+        desfecho = "cancelado"
         try:
             # Recupera histórico da sessão
-            session_id = request.cookies.get("session_id") or str(uuid.uuid4())
-            history = request.session.setdefault("history", {})
-            session_hist = history.setdefault(session_id, [])
+            session_hist = await asyncio.to_thread(_historico.obter, session_id)
             chat_history_tuples = []
             for i in range(0, len(session_hist), 2):
                  if i + 1 < len(session_hist) and session_hist[i]["role"] == "user" and session_hist[i+1]["role"] == "ai":
@@ -131,87 +510,96 @@ async def chat(request: Request, body: ChatRequest):
                      chat_history_tuples.append((user_content, ai_content))
 
 
-            yield format_sse({"type": "start"})
-            logger.info(f"💬 Pergunta: '{body.message}'")
-
-            # Invoca a RAG chain
-            result = await asyncio.to_thread(
-                rag_chain.invoke, {"question": body.message, "chat_history": chat_history_tuples}
-            )
-
-            # Processa a resposta
-            raw_answer = result.get("answer", "").strip()
-            resposta_limpa = _limpar_resposta_llm(raw_answer)
-            resposta_sem_duplicacao = _remover_duplicacao(resposta_limpa, logger)
-            resposta_final = resposta_sem_duplicacao.replace('\\', '\\\\') # Ajuste LaTeX
-
-            if not resposta_final:
-                resposta_final = "Desculpe, não consegui formular uma resposta."
-            logger.info(f"📝 Resposta Gerada (início): {resposta_final[:100]}...")
-
-            # Processa os documentos fonte
-            source_docs = result.get("source_documents", [])
-            fontes_formatadas = []
-            source_chunks_content = []
-
-            if source_docs:
-                unique_sources = {}
-                logger.debug(f"Recuperados {len(source_docs)} trechos.")
-                for i, doc in enumerate(source_docs):
-                    source_path = doc.metadata.get("source", "Desconhecido")
-                    source_name = os.path.basename(source_path)
-                    page_meta = doc.metadata.get("page")
-                    page_num = (int(page_meta) + 1) if isinstance(page_meta, (int, float, str)) and str(page_meta).isdigit() else "?"
-
-                    if source_name not in unique_sources: unique_sources[source_name] = set()
-                    unique_sources[source_name].add(str(page_num))
-
-                    # --- ALTERAÇÃO AQUI: Adiciona URL ---
-                    pdf_url = f"/pdfs/{quote(source_name)}" # Cria URL seguro
-
-                    source_chunks_content.append({
-                        "id": f"chunk_{i}",
-                        "source": f"{source_name} (pág. {page_num})",
-                        "content": html.escape(doc.page_content),
-                        "url": pdf_url  # Adiciona o URL do PDF
-                    })
-
-                fontes_formatadas = [f"{name} (pág. {', '.join(sorted(pages))})" for name, pages in unique_sources.items()]
-                logger.debug(f"Fontes formatadas: {fontes_formatadas}")
-                logger.debug(f"Enviando {len(source_chunks_content)} trechos com URLs.")
+            yield format_sse({"type": "start", "v": SSE_PROTOCOL_VERSION, "request_id": id_pedido.get()})
+            logger.info(f"💬 Pergunta: '{body.message}'" + (f" (áreas: {body.areas})" if body.areas else ""))
+            # A geração (e a tarefa que a executa) herda a sessão: mantém-se no mesmo slot do llama.cpp
+            definir_sessao(session_id)
+            # ... e as áreas: as recuperações (chave da resposta e chain) buscam só nas partições pedidas
+            definir_areas(body.areas)
+
+            # Perguntas sem histórico podem repetir uma resposta já gerada para o mesmo prompt
+            chave_resposta = _chave_resposta(rag_chain, body.message, body.areas) if not chat_history_tuples else None
+            em_cache = cache_respostas.obter(chave_resposta) if chave_resposta else None
+            if desligado.is_set():
+                logger.info("🔌 Cliente desligou antes da geração")
+                return
+
+            if em_cache:
+                logger.info("⚡ Resposta repetida a partir da cache")
+                resposta_final = em_cache["resposta"]
+                fontes_formatadas = em_cache["fontes"]
+                source_chunks_content = em_cache["trechos"]
+                registar_etapa("sse_first_chunk", time.perf_counter() - inicio)
+                yield format_sse({"type": "chunk", "content": resposta_final})
+            else:
+                # Pedidos idênticos em curso partilham uma única geração no llama.cpp
+                geracao, senha = _obter_geracao(chave_resposta, session_id)
+                if senha is not None:
+                    geracao.tarefa = asyncio.create_task(
+                        _gerar_resposta(geracao, rag_chain, body.message, chat_history_tuples, chave_resposta, senha)
+                    )
+                    # Larga a vez também se a tarefa for cancelada antes de começar a correr
+                    geracao.tarefa.add_done_callback(lambda _, senha=senha: controlo_admissao.soltar(senha))
+                else:
+                    logger.info(f"🔗 Pergunta idêntica em curso: a partilhar a geração ({geracao.subscritores + 1} subscritores)")
+
+                enviado = []
+                geracao.entrar()
+                try:
+                    async for estado in geracao.iterar_fila(parar=desligado):
+                        yield format_sse({"type": "queue", **estado})
+                    async for delta in geracao.iterar(parar=desligado):
+                        enviado.append(delta)
+                        if primeiro_chunk:
+                            primeiro_chunk = False
+                            registar_etapa("sse_first_chunk", time.perf_counter() - inicio)
+                        yield format_sse({"type": "chunk", "content": delta})
+                finally:
+                    # O último subscritor a sair cancela a geração (e o pedido ao llama.cpp)
+                    geracao.sair()
+                if desligado.is_set():
+                    logger.info("🔌 Cliente desligou a meio da resposta")
+                    return
+                resultado = geracao.resultado()
+                resposta_final = resultado["resposta"]
+                fontes_formatadas = resultado["fontes"]
+                source_chunks_content = resultado["trechos"]
+
+                # A limpeza só é possível com a resposta completa: envia a versão final se diferir
+                if resposta_final != "".join(enviado).strip():
+                    yield format_sse({"type": "replace", "content": resposta_final})
 
             # Salva histórico
-            session_hist.extend([
-                {"role": "user", "content": body.message},
-                {"role": "ai", "content": resposta_final}
-            ])
-            history[session_id] = session_hist[-10:]
+            await asyncio.to_thread(_historico.acrescentar, session_id, body.message, resposta_final)
 
             # --- Envio dos Eventos SSE com Logging ---
             if source_chunks_content:
                 logger.debug("Enviando evento: source_chunks")
                 yield format_sse({"type": "source_chunks", "content": source_chunks_content})
 
-            buffer = ""
-            logger.debug("Iniciando streaming de 'chunk'")
-            for char in resposta_final:
-                buffer += char
-                yield format_sse({"type": "chunk", "content": buffer})
-                await asyncio.sleep(0.005)
-            logger.debug("Finalizado streaming de 'chunk'")
-
             if fontes_formatadas:
                 logger.debug("Enviando evento: sources")
                 yield format_sse({"type": "sources", "content": fontes_formatadas})
 
             logger.debug("Enviando evento: complete")
             yield format_sse({"type": "complete"})
+            desfecho = "concluido"
+            duracao_pedidos.observar(time.perf_counter() - inicio)
 
+        except ServidorOcupado as e:
+            desfecho = "rejeitado"
+            logger.warning(f"🚦 {e}")
+            yield format_sse({"type": "error", "content": str(e)})
         except Exception as e:
+            desfecho = "erro"
             logger.error("❌ Erro no stream: {}", e, exc_info=True)
             yield format_sse({"type": "error", "content": f"Erro no servidor."})
+        finally:
+            vigia.cancel()
+            pedidos_chat.inc(outcome=desfecho)
+            logger.info(f"⏱️ Pedido {desfecho} em {(time.perf_counter() - inicio) * 1000:.0f}ms: {resumo_etapas(etapas)}")
 
     response = StreamingResponse(event_stream(), media_type="text/event-stream")
     if not request.cookies.get("session_id"):
-        response.set_cookie("session_id", str(uuid.uuid4()), httponly=True, samesite="strict", max_age=3600*24*7)
+        response.set_cookie("session_id", session_id, httponly=True, samesite="strict", max_age=int(settings.HISTORY_TTL))
     return response
\ No newline at end of file
@@ -1,5 +1,8 @@
 # app/api/schemas.py
 from pydantic import BaseModel
+from typing import List, Optional
 
 class ChatRequest(BaseModel):
-    message: str
\ No newline at end of file
+    message: str
+    # Áreas de conhecimento (títulos de /knowledge-areas) a que a busca se restringe; None: todas
+    areas: Optional[List[str]] = None
\ No newline at end of file
@@ -0,0 +1,190 @@
+# app/core/admission.py - Controlo de admissão e fila justa por sessão à frente do llama.cpp
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Tuple
+import asyncio
+import math
+import time
+from app.core.config import settings
+from app.utils.metrics import MetricaCalculada
+
+class ServidorOcupado(Exception):
+    """A fila está cheia, a sessão já tem pedidos em espera ou a espera excedeu o limite."""
+
+class Senha:
+    """Lugar de um pedido na fila; `concedida` resolve quando a geração pode começar."""
+
+    def __init__(self, sessao: str):
+        self.sessao = sessao
+        self.concedida: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.criada = time.monotonic()
+        self.inicio: Optional[float] = None
+
+class ControloAdmissao:
+    """Limita as gerações em simultâneo no llama-server e ordena as restantes.
+
+    Até `max_concorrencia` gerações correm de imediato; as seguintes esperam numa
+    fila limitada a `max_fila` pedidos (e `max_por_sessao` por sessão). A fila é
+    servida em round-robin por sessão: um utilizador com vários pedidos não passa
+    à frente de quem só tem um. A posição e o tempo estimado (média móvel da
+    duração das gerações) são calculados a pedido para os eventos SSE.
+    """
+
+    def __init__(self, max_concorrencia: int, max_fila: int, max_por_sessao: int, timeout: float):
+        self.max_concorrencia = max_concorrencia
+        self.max_fila = max_fila
+        self.max_por_sessao = max_por_sessao
+        self.timeout = timeout
+        self._ativas = 0
+        # Sessão à cabeça = a próxima a ser servida
+        self._filas: "OrderedDict[str, Deque[Senha]]" = OrderedDict()
+        self._em_fila = 0
+        self._duracao_media: Optional[float] = None
+        self._mudou = asyncio.Event()
+        self.contadores: Dict[str, float] = {"admitidos": 0, "rejeitados": 0, "desistencias": 0, "espera_total_s": 0.0}
+
+    @property
+    def ativo(self) -> bool:
+        return self.max_concorrencia > 0
+
+    def _admite_ja(self) -> bool:
+        return not self.ativo or (self._ativas < self.max_concorrencia and not self._em_fila)
+
+    def recusaria(self, sessao: str) -> bool:
+        """True se `pedir(sessao)` fosse agora recusado: fila cheia ou a sessão já no limite."""
+        if self._admite_ja():
+            return False
+        fila = self._filas.get(sessao)
+        return self._em_fila >= self.max_fila or (fila is not None and len(fila) >= self.max_por_sessao)
+
+    def _acordar(self) -> None:
+        self._mudou.set()
+        self._mudou = asyncio.Event()
+
+    def pedir(self, sessao: str) -> Senha:
+        """Entra na fila (ou é admitido logo); levanta `ServidorOcupado` se não houver lugar."""
+        senha = Senha(sessao)
+        if self._admite_ja():
+            self._conceder(senha)
+            return senha
+        if self.recusaria(sessao):
+            self.contadores["rejeitados"] += 1
+            raise ServidorOcupado("Servidor ocupado: tente novamente dentro de instantes.")
+        fila = self._filas.setdefault(sessao, deque())
+        fila.append(senha)
+        self._em_fila += 1
+        return senha
+
+    def _conceder(self, senha: Senha) -> None:
+        self._ativas += 1
+        senha.inicio = time.monotonic()
+        self.contadores["admitidos"] += 1
+        self.contadores["espera_total_s"] += senha.inicio - senha.criada
+        senha.concedida.set_result(True)
+
+    def _conceder_proximas(self) -> None:
+        while self._filas and self._ativas < self.max_concorrencia:
+            sessao, fila = next(iter(self._filas.items()))
+            senha = fila.popleft()
+            self._em_fila -= 1
+            if fila:
+                self._filas.move_to_end(sessao)
+            else:
+                del self._filas[sessao]
+            self._conceder(senha)
+        self._acordar()
+
+    def posicao(self, senha: Senha) -> int:
+        """Posição (1 = a próxima), simulando as voltas do round-robin."""
+        fila = self._filas.get(senha.sessao)
+        if fila is None or senha not in fila:
+            return 0
+        volta = fila.index(senha)
+        antes, depois_da_sessao = 0, False
+        for sessao, outra in self._filas.items():
+            if sessao == senha.sessao:
+                antes += volta
+                depois_da_sessao = True
+                continue
+            # Voltas completas antes da nossa e, se a sessão vier antes na ordem, a própria volta
+            antes += min(len(outra), volta) + (len(outra) > volta and not depois_da_sessao)
+        return antes + 1
+
+    def eta(self, posicao: int) -> Optional[float]:
+        if self._duracao_media is None or posicao <= 0:
+            return None
+        return math.ceil(posicao / self.max_concorrencia) * self._duracao_media
+
+    async def esperar(self, senha: Senha) -> AsyncIterator[Tuple[int, Optional[float]]]:
+        """Devolve (posição, ETA em segundos) sempre que a posição muda, até ser admitido.
+
+        Levanta `ServidorOcupado` se a espera exceder `timeout`; se a tarefa for
+        cancelada (o cliente desligou-se), o lugar na fila é libertado.
+        """
+        limite = senha.criada + self.timeout
+        ultima = None
+        try:
+            while not senha.concedida.done():
+                posicao = self.posicao(senha)
+                if posicao != ultima:
+                    ultima = posicao
+                    yield posicao, self.eta(posicao)
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise ServidorOcupado("Tempo de espera na fila esgotado: tente novamente dentro de instantes.")
+                mudou = asyncio.ensure_future(self._mudou.wait())
+                try:
+                    await asyncio.wait([senha.concedida, mudou], timeout=restante, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    mudou.cancel()
+        except BaseException:
+            self.desistir(senha)
+            raise
+
+    def desistir(self, senha: Senha) -> None:
+        """Tira da fila um pedido ainda não admitido (sem efeito se já foi admitido)."""
+        fila = self._filas.get(senha.sessao)
+        if senha.concedida.done() or fila is None or senha not in fila:
+            return
+        fila.remove(senha)
+        self._em_fila -= 1
+        if not fila:
+            del self._filas[senha.sessao]
+        self.contadores["desistencias"] += 1
+        self._acordar()
+
+    def soltar(self, senha: Senha) -> None:
+        """Larga a senha em qualquer estado: sai da fila ou, se já foi admitida, termina a geração."""
+        self.desistir(senha)
+        self.liberar(senha)
+
+    def liberar(self, senha: Senha) -> None:
+        """Termina uma geração admitida e passa a vez aos seguintes."""
+        if senha.inicio is None:
+            return
+        duracao = time.monotonic() - senha.inicio
+        senha.inicio = None
+        self._duracao_media = duracao if self._duracao_media is None else 0.8 * self._duracao_media + 0.2 * duracao
+        self._ativas -= 1
+        self._conceder_proximas()
+
+    def estatisticas(self) -> Dict[str, Any]:
+        admitidos = self.contadores["admitidos"]
+        return {
+            "ativas": self._ativas,
+            "em_fila": self._em_fila,
+            "sessoes_em_fila": len(self._filas),
+            "duracao_media_s": round(self._duracao_media, 2) if self._duracao_media is not None else None,
+            "espera_media_s": round(self.contadores["espera_total_s"] / admitidos, 3) if admitidos else None,
+            **{chave: valor for chave, valor in self.contadores.items() if chave != "espera_total_s"},
+        }
+
+controlo_admissao = ControloAdmissao(
+    settings.LLM_MAX_CONCURRENCY, settings.LLM_QUEUE_SIZE, settings.LLM_QUEUE_PER_SESSION, settings.LLM_QUEUE_TIMEOUT
+)
+
+MetricaCalculada("ucdb_llm_active_generations", "Gerações admitidas a correr no llama.cpp.", "gauge",
+                 lambda: {(): controlo_admissao.estatisticas()["ativas"]})
+MetricaCalculada("ucdb_llm_queue_length", "Pedidos à espera de vez no llama.cpp.", "gauge",
+                 lambda: {(): controlo_admissao.estatisticas()["em_fila"]})
+MetricaCalculada("ucdb_llm_queue_rejected_total", "Pedidos recusados por fila cheia ou espera esgotada.", "counter",
+                 lambda: {(): controlo_admissao.contadores["rejeitados"]})
@@ -0,0 +1,109 @@
+# app/core/bm25.py - Índice invertido BM25 guardado nas tabelas do chunk store
+from collections import Counter
+from typing import AbstractSet, Dict, Iterable, List, Optional, Tuple
+import heapq
+import math
+import re
+import sqlite3
+import unicodedata
+
+_TOKEN = re.compile(r"\w+")
+_STOPWORDS = frozenset("""
+a ao aos as com como da das de do dos e em entre era essa esse esta este eu foi ha isso
+mais mas na nas no nos o os ou para pela pelas pelo pelos por qual quando que se sem ser
+seu sua sao so tambem tem um uma umas uns the of and to in is
+""".split())
+
+def tokenizar(texto: str) -> List[str]:
+    """Minúsculas sem acentos; mantém números e símbolos de uma letra (códigos, variáveis)."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return [t for t in _TOKEN.findall(texto) if t not in _STOPWORDS]
+
+def criar_tabelas(db: sqlite3.Connection) -> None:
+    db.execute("CREATE TABLE IF NOT EXISTS bm25_postings (termo TEXT, id TEXT, tf INTEGER NOT NULL, PRIMARY KEY (termo, id)) WITHOUT ROWID")
+    db.execute("CREATE TABLE IF NOT EXISTS bm25_termos (termo TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID")
+    db.execute("CREATE TABLE IF NOT EXISTS bm25_comprimentos (id TEXT PRIMARY KEY, n INTEGER NOT NULL) WITHOUT ROWID")
+
+def indexar(db: sqlite3.Connection, documentos: Dict[str, str]) -> None:
+    """Acrescenta os postings de `{id: texto}`; o chamador faz o commit."""
+    postings, comprimentos, df = [], [], Counter()
+    for doc_id, texto in documentos.items():
+        frequencias = Counter(tokenizar(texto))
+        comprimentos.append((doc_id, sum(frequencias.values())))
+        postings.extend((termo, doc_id, tf) for termo, tf in frequencias.items())
+        df.update(frequencias.keys())
+    db.executemany("INSERT OR REPLACE INTO bm25_postings VALUES (?, ?, ?)", postings)
+    db.executemany("INSERT OR REPLACE INTO bm25_comprimentos VALUES (?, ?)", comprimentos)
+    db.executemany(
+        "INSERT INTO bm25_termos VALUES (?, ?) ON CONFLICT(termo) DO UPDATE SET df = df + excluded.df",
+        df.items()
+    )
+
+def remover(db: sqlite3.Connection, documentos: Dict[str, str]) -> None:
+    """Retira os postings de `{id: texto}`, re-tokenizando o texto para encontrar os termos."""
+    if not documentos:
+        return
+    postings, df = [], Counter()
+    for doc_id, texto in documentos.items():
+        termos = set(tokenizar(texto))
+        postings.extend((termo, doc_id) for termo in termos)
+        df.update(termos)
+    db.executemany("DELETE FROM bm25_postings WHERE termo = ? AND id = ?", postings)
+    db.executemany("DELETE FROM bm25_comprimentos WHERE id = ?", [(doc_id,) for doc_id in documentos])
+    db.executemany("UPDATE bm25_termos SET df = df - ? WHERE termo = ?", [(n, termo) for termo, n in df.items()])
+    # Só os termos decrementados podem ter chegado a zero: não percorre o vocabulário inteiro
+    db.executemany("DELETE FROM bm25_termos WHERE termo = ? AND df <= 0", [(termo,) for termo in df])
+
+def estatisticas(db: sqlite3.Connection) -> Tuple[int, float]:
+    """Devolve (número de documentos, comprimento médio)."""
+    total, soma = db.execute("SELECT COUNT(*), COALESCE(SUM(n), 0) FROM bm25_comprimentos").fetchone()
+    return total, (soma / total if total else 0.0)
+
+def buscar(db: sqlite3.Connection, consulta: str, k: int, stats: Tuple[int, float],
+           k1: float = 1.2, b: float = 0.75, max_df: float = 0.5,
+           permitidos: Optional[AbstractSet[str]] = None) -> List[Tuple[str, float]]:
+    """Devolve os `k` ids com maior pontuação BM25, por ordem decrescente.
+
+    Com `permitidos`, só esses ids são pontuados (busca restrita a áreas de conhecimento);
+    o idf continua a ser o do índice inteiro.
+
+    Termos presentes em mais de `max_df` dos documentos contribuem pouco para a
+    pontuação e têm as listas de postings mais longas: são ignorados, exceto se a
+    consulta não tiver nenhum termo mais seletivo.
+    """
+    total, media = stats
+    termos = list(dict.fromkeys(tokenizar(consulta)))
+    if not termos or not total:
+        return []
+    marcadores = ",".join("?" * len(termos))
+    dfs = dict(db.execute(f"SELECT termo, df FROM bm25_termos WHERE termo IN ({marcadores})", termos))
+    if not dfs:
+        return []
+    seletivos = {termo: df for termo, df in dfs.items() if df <= max_df * total}
+    idf = {termo: math.log(1 + (total - df + 0.5) / (df + 0.5)) for termo, df in (seletivos or dfs).items()}
+    marcadores = ",".join("?" * len(idf))
+    pontuacoes: Dict[str, float] = {}
+    for termo, doc_id, tf, n in db.execute(
+        f"SELECT p.termo, p.id, p.tf, c.n FROM bm25_postings p JOIN bm25_comprimentos c ON c.id = p.id "
+        f"WHERE p.termo IN ({marcadores})", list(idf)
+    ):
+        if permitidos is not None and doc_id not in permitidos:
+            continue
+        peso = idf[termo] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * n / media))
+        pontuacoes[doc_id] = pontuacoes.get(doc_id, 0.0) + peso
+    return heapq.nlargest(k, pontuacoes.items(), key=lambda item: item[1])
+
+def reconstruir(db: sqlite3.Connection, documentos: Iterable[Tuple[str, str]], lote: int = 2000) -> int:
+    """Indexa de raiz os pares (id, texto) recebidos; usado para migrar stores sem BM25."""
+    total, pendentes = 0, {}
+    for doc_id, texto in documentos:
+        pendentes[doc_id] = texto
+        if len(pendentes) >= lote:
+            indexar(db, pendentes)
+            total += len(pendentes)
+            pendentes = {}
+    if pendentes:
+        indexar(db, pendentes)
+        total += len(pendentes)
+    return total
@@ -0,0 +1,212 @@
+# app/core/chunk_store.py - Docstore em SQLite com leitura preguiçosa dos chunks
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+from collections import OrderedDict
+from typing import AbstractSet, Dict, Iterator, List, Optional, Tuple, Union
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import uuid
+from app.core import bm25
+from app.utils.logger import logger
+
+NOME_FICHEIRO = "chunks.sqlite"
+_SUFIXO_ESCRITA = ".tmp"
+
+class ChunkStore(Docstore, AddableMixin):
+    """Docstore do índice FAISS guardado em SQLite em vez de pickle.
+
+    Só os chunks devolvidos pela busca são lidos do disco, passando por uma LRU em
+    memória. O ficheiro também guarda a posição de cada vetor no índice
+    (`index_to_docstore_id`) e o índice invertido BM25 dos chunks (ver `bm25`),
+    atualizado em cada `add`/`delete`.
+
+    Cada publicação grava uma `versao` nova, que identifica o índice nas caches de
+    respostas. O `/chat` abre o ficheiro só para leitura. A ingestão escreve numa cópia
+    (`chunks.sqlite.tmp`) que `publicar` coloca no lugar com `os.replace`, pelo
+    que quem ainda tem o ficheiro anterior aberto continua a lê-lo.
+    """
+
+    def __init__(self, caminho: str, somente_leitura: bool = True, lru_size: int = 0):
+        self.caminho = caminho
+        self.somente_leitura = somente_leitura
+        self.lru_size = lru_size
+        self._lru: "OrderedDict[str, Document]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats_bm25: Optional[Tuple[int, float]] = None
+        if somente_leitura:
+            self._db = sqlite3.connect(f"file:{caminho}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+            try:
+                linha = self._db.execute("SELECT valor FROM meta WHERE nome = 'versao'").fetchone()
+            except sqlite3.OperationalError:
+                linha = None  # Ficheiro publicado antes de existir a versão
+            self.versao = linha[0] if linha else str(os.stat(caminho).st_mtime_ns)
+        else:
+            self.versao = None
+            self._db = sqlite3.connect(caminho, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, texto TEXT NOT NULL, metadata TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS posicoes (posicao INTEGER PRIMARY KEY, id TEXT NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (nome TEXT PRIMARY KEY, valor TEXT)")
+            bm25.criar_tabelas(self._db)
+            self._db.commit()
+
+    @classmethod
+    def para_escrita(cls, path: str, copiar: bool = True, lru_size: int = 0) -> "ChunkStore":
+        """Abre uma cópia gravável do ficheiro em `path` (vazia se `copiar` for False)."""
+        final = os.path.join(path, NOME_FICHEIRO)
+        temporario = final + _SUFIXO_ESCRITA
+        if os.path.exists(temporario):
+            os.remove(temporario)  # Resto de uma ingestão interrompida
+        if copiar and os.path.exists(final):
+            shutil.copyfile(final, temporario)
+        return cls(temporario, somente_leitura=False, lru_size=lru_size)
+
+    def publicar(self, index_to_docstore_id: Dict[int, str]) -> str:
+        """Grava as posições, fecha a cópia e coloca-a no lugar do ficheiro publicado."""
+        if self.somente_leitura or not self.caminho.endswith(_SUFIXO_ESCRITA):
+            raise RuntimeError("Só uma cópia aberta com `para_escrita` pode ser publicada")
+        with self._lock:
+            self._db.execute("DELETE FROM posicoes")
+            self._db.executemany("INSERT INTO posicoes VALUES (?, ?)", index_to_docstore_id.items())
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('versao', ?)", (uuid.uuid4().hex,))
+            self._db.commit()
+            self._db.close()
+        final = self.caminho[:-len(_SUFIXO_ESCRITA)]
+        os.replace(self.caminho, final)
+        return final
+
+    def descartar(self) -> None:
+        """Fecha e apaga uma cópia de escrita que não vai ser publicada."""
+        self._db.close()
+        if not self.somente_leitura and os.path.exists(self.caminho):
+            os.remove(self.caminho)
+
+    def carregar_posicoes(self) -> Dict[int, str]:
+        with self._lock:
+            return dict(self._db.execute("SELECT posicao, id FROM posicoes").fetchall())
+
+    @staticmethod
+    def _documento(doc_id: str, texto: str, metadata: str) -> Document:
+        return Document(id=doc_id, page_content=texto, metadata=json.loads(metadata))
+
+    def search(self, search: str) -> Union[str, Document]:
+        with self._lock:
+            doc = self._lru.get(search)
+            if doc is not None:
+                self._lru.move_to_end(search)
+                return doc
+            linha = self._db.execute("SELECT texto, metadata FROM chunks WHERE id = ?", (search,)).fetchone()
+            if linha is None:
+                return f"ID {search} not found."
+            doc = self._documento(search, *linha)
+            if self.lru_size:
+                self._lru[search] = doc
+                while len(self._lru) > self.lru_size:
+                    self._lru.popitem(last=False)
+            return doc
+
+    def obter(self, ids: List[str]) -> List[Document]:
+        """Lê vários chunks de uma vez, pela ordem de `ids` (sem passar pela LRU)."""
+        encontrados = {}
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                lote = ids[i:i + 500]
+                marcadores = ",".join("?" * len(lote))
+                for doc_id, texto, metadata in self._db.execute(
+                    f"SELECT id, texto, metadata FROM chunks WHERE id IN ({marcadores})", lote
+                ):
+                    encontrados[doc_id] = self._documento(doc_id, texto, metadata)
+        return [encontrados[doc_id] for doc_id in ids]
+
+    def iterar_metadados(self) -> Iterator[Tuple[str, dict]]:
+        with self._lock:
+            linhas = self._db.execute("SELECT id, metadata FROM chunks").fetchall()
+        for doc_id, metadata in linhas:
+            yield doc_id, json.loads(metadata)
+
+    def buscar_lexical(self, consulta: str, k: int, k1: float = 1.2, b: float = 0.75,
+                       permitidos: Optional[AbstractSet[str]] = None) -> List[Tuple[str, float]]:
+        """Top-`k` ids por BM25, só entre `permitidos` se dado. No ficheiro só de leitura as
+        estatísticas globais são lidas uma vez."""
+        with self._lock:
+            stats = self._stats_bm25 or bm25.estatisticas(self._db)
+            if self.somente_leitura:
+                self._stats_bm25 = stats
+            return bm25.buscar(self._db, consulta, k, stats, k1=k1, b=b, permitidos=permitidos)
+
+    def _textos(self, ids: List[str]) -> Dict[str, str]:
+        textos = {}
+        for i in range(0, len(ids), 500):
+            lote = ids[i:i + 500]
+            marcadores = ",".join("?" * len(lote))
+            textos.update(self._db.execute(f"SELECT id, texto FROM chunks WHERE id IN ({marcadores})", lote))
+        return textos
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        """Acrescenta (ou substitui) chunks. Um id já presente perde primeiro os seus postings
+        BM25, para o df e os comprimentos não serem contados duas vezes."""
+        with self._lock:
+            existentes = self._textos(list(texts))
+            if existentes:
+                bm25.remover(self._db, existentes)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)",
+                [(doc_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False, default=str))
+                 for doc_id, doc in texts.items()]
+            )
+            bm25.indexar(self._db, {doc_id: doc.page_content for doc_id, doc in texts.items()})
+            self._db.commit()
+            for doc_id in texts:
+                self._lru.pop(doc_id, None)
+
+    def delete(self, ids: List) -> None:
+        with self._lock:
+            bm25.remover(self._db, self._textos(ids))
+            self._db.executemany("DELETE FROM chunks WHERE id = ?", [(doc_id,) for doc_id in ids])
+            self._db.commit()
+            for doc_id in ids:
+                self._lru.pop(doc_id, None)
+
+def migrar_pickle(path: str) -> bool:
+    """Converte um `index.pkl` (InMemoryDocstore do LangChain) para `chunks.sqlite`.
+
+    O pickle só é lido uma vez, aqui; é apagado depois de a migração ser publicada.
+    """
+    caminho_pickle = os.path.join(path, "index.pkl")
+    if not os.path.exists(caminho_pickle) or os.path.exists(os.path.join(path, NOME_FICHEIRO)):
+        return False
+    with open(caminho_pickle, "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    store = ChunkStore.para_escrita(path, copiar=False)
+    documentos = docstore._dict
+    for doc_id, doc in documentos.items():
+        if doc.id is None:
+            doc.id = doc_id
+    store.add(documentos)
+    store.publicar(index_to_docstore_id)
+    os.remove(caminho_pickle)
+    logger.info(f"🔁 Docstore migrado de index.pkl para {NOME_FICHEIRO} ({len(documentos)} chunks)")
+    return True
+
+def migrar_indice_lexical(path: str) -> bool:
+    """Constrói o índice BM25 de um `chunks.sqlite` criado antes de ele existir."""
+    final = os.path.join(path, NOME_FICHEIRO)
+    if not os.path.exists(final):
+        return False
+    db = sqlite3.connect(f"file:{final}?mode=ro", uri=True)
+    try:
+        existe = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'bm25_comprimentos'").fetchone()
+    finally:
+        db.close()
+    if existe:
+        return False
+    store = ChunkStore.para_escrita(path)
+    with store._lock:
+        total = bm25.reconstruir(store._db, store._db.execute("SELECT id, texto FROM chunks").fetchall())
+        store._db.commit()
+    store.publicar(store.carregar_posicoes())
+    logger.info(f"🔁 Índice BM25 construído para {total} chunks existentes")
+    return True
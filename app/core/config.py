@@ -11,6 +11,7 @@ class Settings(BaseSettings):
     API_V1_STR: str = "/api/v1"
     DEBUG: bool = False
     SECRET_KEY: str = secrets.token_hex(32)
+    ADMIN_TOKEN: str = ""  # exigido no cabeçalho X-Admin-Token pelos endpoints de administração
 
     # LLM
     LLM_BASE_URL: AnyHttpUrl = "http://localhost:8080/v1"
@@ -19,11 +20,104 @@ class Settings(BaseSettings):
     TEMPERATURE: float = 0.85  # Reduzir um pouco a temperatura pode ajudar na consistência
     TOP_P: float = 0.9
     REPETITION_PENALTY: float = 1  # <-- PREVENIR LOOPS
+    LLM_TIMEOUT: float = 120
+    LLM_CACHE_PROMPT: bool = True  # reaproveita a cache KV do prefixo comum entre pedidos
+    LLM_SLOTS: int = 0  # slots do llama-server (-np); > 0 fixa cada sessão num slot
+    LLM_TOKENIZE_URL: AnyHttpUrl = "http://localhost:8080/tokenize"
+    # Admissão: gerações em simultâneo no llama-server e fila justa por sessão para as restantes
+    LLM_MAX_CONCURRENCY: int = 4  # 0 desativa; normalmente igual ao -np do llama-server
+    LLM_QUEUE_SIZE: int = 64  # pedidos em espera; acima disto o /chat responde 429
+    LLM_QUEUE_PER_SESSION: int = 2
+    LLM_QUEUE_TIMEOUT: float = 90  # espera máxima na fila (segundos)
+    # Interrompe respostas em ciclo durante o streaming (n-gramas e linhas repetidas)
+    LLM_LOOP_DETECTION: bool = True
+    LLM_LOOP_NGRAM: int = 4
+    LLM_LOOP_WINDOW: int = 200  # palavras observadas
+    LLM_LOOP_THRESHOLD: float = 0.5  # proporção de n-gramas repetidos na janela
+    LLM_LOOP_MAX_LINE_REPEATS: int = 3
+    EMBEDDING_TIMEOUT: float = 30
+    EMBEDDING_BATCH_SIZE: int = 32  # textos por pedido ao /embedding
+    EMBEDDING_CONCURRENCY: int = 4  # lotes em paralelo durante a indexação
+    EMBEDDING_MAX_RETRIES: int = 4
+    EMBEDDING_MODEL_ID: str = ""  # identifica o modelo na cache; vazio = usa o EMBEDDING_API_URL
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_QUERY_LRU_SIZE: int = 2048
+
+    # HTTP: pool partilhado de ligações para o llama.cpp (LLM e embeddings)
+    HTTP_MAX_CONNECTIONS: int = 512
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 64
+    HTTP_KEEPALIVE_EXPIRY: float = 60
+    HTTP_CONNECT_TIMEOUT: float = 5
 
     # RAG
     CHUNK_SIZE: int = 812
     CHUNK_OVERLAP: int = 64
     RETRIEVAL_K: int = 7 # Aumentar ligeiramente para mais contexto
+    RETRIEVAL_HYBRID: bool = True  # funde a busca vetorial com BM25 (reciprocal rank fusion)
+    RETRIEVAL_FETCH_K: int = 20  # candidatos de cada via antes da fusão
+    RETRIEVAL_RRF_K: int = 60
+    BM25_K1: float = 1.2
+    BM25_B: float = 0.75
+    # Recuperação por área de conhecimento (`areas` no /chat): abaixo deste número de
+    # candidatos nas áreas pedidas, a busca é repetida em todo o índice
+    AREA_MIN_CANDIDATES: int = 3
+
+    # Montagem do contexto: MMR, fusão de chunks sobrepostos da mesma página e orçamento de tokens
+    CONTEXT_PACKING: bool = True
+    CONTEXT_CANDIDATES: int = 14  # chunks recuperados antes da montagem (substitui RETRIEVAL_K)
+    CONTEXT_TOKEN_BUDGET: int = 3072  # tokens do contexto no prompt (MAX_TOKENS é o limite da geração)
+    CONTEXT_MMR_LAMBDA: float = 0.7  # 1 = só relevância, 0 = só diversidade
+
+    # Perguntas de seguimento: reescrita só quando dependem do histórico, em paralelo com a recuperação
+    CONDENSE_SKIP_HEURISTIC: bool = True
+    CONDENSE_PARALLEL_RETRIEVAL: bool = True
+    CONDENSE_MAX_TOKENS: int = 64
+
+    # Caches de perguntas repetidas (invalidados quando o índice muda)
+    RETRIEVAL_CACHE_SIZE: int = 4096  # 0 desativa
+    RETRIEVAL_CACHE_TTL: float = 3600
+    ANSWER_CACHE_SIZE: int = 1024  # 0 desativa
+    ANSWER_CACHE_TTL: float = 3600
+
+    # Índice FAISS: string de fábrica (ex.: "Flat", "SQfp16", "HNSW32", "IVF1024,PQ32")
+    FAISS_INDEX_FACTORY: str = "Flat"
+    FAISS_TRAIN_SIZE: int = 50000  # vetores usados para treinar IVF/PQ
+    FAISS_NPROBE: int = 16  # listas IVF visitadas por consulta
+    FAISS_EF_SEARCH: int = 64  # largura da busca HNSW
+    FAISS_MMAP: bool = False  # mapeia o index.faiss só para leitura em vez de o ler para a RAM
+    CHUNK_STORE_LRU_SIZE: int = 4096  # chunks recentes mantidos em memória (o resto fica no SQLite)
+
+    # Ingestão: parse/split num pool de processos, títulos e embeddings em paralelo
+    INGESTION_WORKERS: int = 0  # 0 = número de CPUs
+    INGESTION_TITLE_CONCURRENCY: int = 2
+    INGESTION_QUEUE_SIZE: int = 8  # PDFs já divididos à espera de embedding
+    INGESTION_BATCH_CHUNKS: int = 256  # chunks adicionados ao índice de cada vez
+    INGESTION_WATCH: bool = True  # reindexa em segundo plano quando a pasta de PDFs muda
+    INGESTION_WATCH_INTERVAL: float = 30
+    # Vários workers (uvicorn --workers N). "multi": o worker que obtém o lock de ingestão indexa e publica
+    # snapshots versionados; todos servem o snapshot atual mapeado só para leitura. "reader": nunca indexa
+    # (a ingestão corre à parte com `python -m app.ingest`). "single": um só processo, como até aqui.
+    WORKER_MODE: str = "single"
+    SNAPSHOT_POLL_INTERVAL: float = 5  # segundos entre verificações de um snapshot novo
+    SNAPSHOT_KEEP: int = 3  # snapshots mantidos no disco, incluindo o atual
+
+    # Arranque: o índice carrega em segundo plano (o /readyz só responde 200 no fim), com novas tentativas
+    STARTUP_RETRY_INITIAL: float = 2  # segundos até à 2.ª tentativa; duplica a cada falha
+    STARTUP_RETRY_MAX: float = 60
+    STARTUP_WARMUP: bool = True  # aquece embeddings, LLM e páginas do índice antes de ficar pronto
+    STARTUP_WARMUP_TIMEOUT: float = 30
+
+    # Streaming SSE: agrupa tokens num delta até passar o intervalo ou atingir o tamanho
+    SSE_FLUSH_INTERVAL_MS: int = 30
+    SSE_FLUSH_MAX_CHARS: int = 64
+    SSE_DISCONNECT_POLL_MS: int = 250  # intervalo de verificação de clientes desligados
+
+    # Histórico das conversas (no servidor, por cookie session_id); "sqlite" partilha-o entre workers
+    HISTORY_BACKEND: str = "memory"  # "memory" ou "sqlite"
+    HISTORY_MAX_MESSAGES: int = 10
+    HISTORY_MAX_TOKENS: int = 2048  # estimados pelo número de caracteres
+    HISTORY_TTL: float = 3600 * 24 * 7
+    HISTORY_CACHE_SIZE: int = 10000  # sessões mantidas pelo backend em memória
 
     # Paths
     BASE_DIR: str = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -40,6 +134,19 @@ class Settings(BaseSettings):
         os.makedirs(path, exist_ok=True)
         return path
 
+    @property
+    def embedding_cache_path(self) -> str:
+        # Fora de `embeddings/`: a cache sobrevive à remoção do índice FAISS
+        path = os.path.join(self.BASE_DIR, "cache", "embeddings")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @property
+    def history_db_path(self) -> str:
+        path = os.path.join(self.BASE_DIR, "cache")
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, "historico.sqlite")
+
     @property
     def pdf_path(self) -> str:
         path = os.path.join(self.BASE_DIR, "pdfs")
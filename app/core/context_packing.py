@@ -0,0 +1,244 @@
+# app/core/context_packing.py - Montagem do contexto: MMR, fusão de chunks sobrepostos e orçamento de tokens
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+import asyncio
+import hashlib
+import threading
+import httpx
+import numpy as np
+import requests
+from app.utils.logger import logger
+from app.core.config import settings
+from app.core.http_client import get_async_client, get_sync_session
+
+_CHARS_POR_TOKEN = 3.5  # estimativa usada se o /tokenize falhar
+_MIN_SOBREPOSICAO = 16
+_SEPARADOR = "\n\n"  # o mesmo que separa os documentos no prompt
+
+def _repartir(tokens: list, textos: Sequence[str]) -> List[int]:
+    """Reparte os tokens de `_SEPARADOR.join(textos)` pelos textos, pelo byte onde cada token começa.
+
+    Servidores sem `with_pieces` só devolvem ids: aí a repartição é proporcional ao tamanho.
+    """
+    tamanhos = [len(t.encode("utf-8")) for t in textos]
+    if tokens and isinstance(tokens[0], dict):
+        limites = np.cumsum([n + len(_SEPARADOR) for n in tamanhos])
+        inicios, byte = [], 0
+        for token in tokens:
+            inicios.append(byte)
+            peca = token["piece"]  # lista de bytes quando a peça não é UTF-8 válido
+            byte += len(peca) if isinstance(peca, list) else len(peca.encode("utf-8"))
+        indices = np.minimum(np.searchsorted(limites, inicios, side="right"), len(textos) - 1)
+        return [max(int(n), 1) for n in np.bincount(indices, minlength=len(textos))]
+    total = max(sum(tamanhos), 1)
+    return [max(round(len(tokens) * n / total), 1) for n in tamanhos]
+
+class ContadorTokens:
+    """Conta tokens com o tokenizador do próprio llama-server (`/tokenize`), com LRU por texto.
+
+    Os textos que faltam na LRU vão num só pedido, concatenados como no prompt.
+    """
+
+    def __init__(self, url: str, lru_size: int = 8192):
+        self.url = url
+        self.lru_size = lru_size
+        self._lru: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._avisado = False
+
+    def _da_cache(self, textos: Sequence[str]):
+        chaves = [hashlib.sha256(t.encode("utf-8")).digest() for t in textos]
+        with self._lock:
+            contagens = {c: self._lru[c] for c in chaves if c in self._lru}
+            for c in contagens:
+                self._lru.move_to_end(c)
+        return chaves, contagens
+
+    def _guardar(self, novas: Dict[bytes, int]) -> None:
+        with self._lock:
+            self._lru.update(novas)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def _estimar(self, texto: str, erro: Exception) -> int:
+        if not self._avisado:
+            logger.warning(f"⚠️ /tokenize indisponível ({erro}); a estimar tokens pelo número de caracteres")
+            self._avisado = True
+        return int(len(texto) / _CHARS_POR_TOKEN) + 1
+
+    def _pedido(self, pendentes: Dict[bytes, str]) -> dict:
+        return {"content": _SEPARADOR.join(pendentes.values()), "with_pieces": True}
+
+    def contar(self, textos: Sequence[str]) -> List[int]:
+        chaves, contagens = self._da_cache(textos)
+        pendentes = {c: t for c, t in zip(chaves, textos) if c not in contagens}
+        if pendentes:
+            try:
+                resposta = get_sync_session().post(self.url, json=self._pedido(pendentes), timeout=settings.LLM_TIMEOUT)
+                resposta.raise_for_status()
+                novas = dict(zip(pendentes, _repartir(resposta.json()["tokens"], list(pendentes.values()))))
+                self._guardar(novas)
+            except requests.exceptions.RequestException as e:
+                novas = {c: self._estimar(t, e) for c, t in pendentes.items()}
+            contagens.update(novas)
+        return [contagens[c] for c in chaves]
+
+    async def acontar(self, textos: Sequence[str]) -> List[int]:
+        chaves, contagens = self._da_cache(textos)
+        pendentes = {c: t for c, t in zip(chaves, textos) if c not in contagens}
+        if pendentes:
+            try:
+                resposta = await get_async_client().post(self.url, json=self._pedido(pendentes), timeout=settings.LLM_TIMEOUT)
+                resposta.raise_for_status()
+                novas = dict(zip(pendentes, _repartir(resposta.json()["tokens"], list(pendentes.values()))))
+                self._guardar(novas)
+            except httpx.HTTPError as e:
+                novas = {c: self._estimar(t, e) for c, t in pendentes.items()}
+            contagens.update(novas)
+        return [contagens[c] for c in chaves]
+
+def ordenar_mmr(vetor_consulta, vetores, lambda_mult: float) -> List[int]:
+    """Ordena os candidatos por maximal marginal relevance (similaridade de cosseno)."""
+    vetores = np.asarray(vetores, dtype=np.float32)
+    vetores = vetores / np.maximum(np.linalg.norm(vetores, axis=1, keepdims=True), 1e-12)
+    consulta = np.asarray(vetor_consulta, dtype=np.float32)
+    consulta = consulta / max(np.linalg.norm(consulta), 1e-12)
+    relevancia = vetores @ consulta
+    semelhanca = vetores @ vetores.T
+    escolhidos: List[int] = []
+    restantes = list(range(len(vetores)))
+    while restantes:
+        if escolhidos:
+            redundancia = semelhanca[np.ix_(restantes, escolhidos)].max(axis=1)
+        else:
+            redundancia = np.zeros(len(restantes))
+        pontuacao = lambda_mult * relevancia[restantes] - (1 - lambda_mult) * redundancia
+        escolhido = restantes[int(np.argmax(pontuacao))]
+        escolhidos.append(escolhido)
+        restantes.remove(escolhido)
+    return escolhidos
+
+def _sobreposicao(anterior: str, seguinte: str, maximo: int) -> int:
+    """Tamanho do maior sufixo de `anterior` que é prefixo de `seguinte` (0 se < _MIN_SOBREPOSICAO)."""
+    for tamanho in range(min(len(anterior), len(seguinte), maximo), _MIN_SOBREPOSICAO - 1, -1):
+        if anterior.endswith(seguinte[:tamanho]):
+            return tamanho
+    return 0
+
+def _fundir_textos(a: str, b: str, maximo: int) -> Optional[str]:
+    """Junta dois chunks da mesma página se um contém o outro ou se se sobrepõem nas pontas."""
+    if b in a:
+        return a
+    if a in b:
+        return b
+    if (n := _sobreposicao(a, b, maximo)):
+        return a + b[n:]
+    if (n := _sobreposicao(b, a, maximo)):
+        return b + a[n:]
+    return None
+
+def fundir_sobrepostos(docs: List[Document], maximo: int) -> List[Document]:
+    """Funde chunks adjacentes ou sobrepostos da mesma página, mantendo a ordem de entrada.
+
+    Cada bloco fica na posição do seu chunk mais relevante e herda os metadados dele.
+    """
+    posicao = {doc.id: i for i, doc in enumerate(docs)}
+    blocos: List[Document] = []
+    for doc in sorted(docs, key=lambda d: d.metadata.get("start_index", 0)):
+        pagina = (doc.metadata.get("source"), doc.metadata.get("page"))
+        for i, bloco in enumerate(blocos):
+            if (bloco.metadata.get("source"), bloco.metadata.get("page")) != pagina:
+                continue
+            texto = _fundir_textos(bloco.page_content, doc.page_content, maximo)
+            if texto is not None:
+                principal = bloco if posicao[bloco.id] <= posicao[doc.id] else doc
+                blocos[i] = Document(id=principal.id, page_content=texto, metadata=principal.metadata)
+                break
+        else:
+            blocos.append(doc)
+    return sorted(blocos, key=lambda bloco: posicao[bloco.id])
+
+class ContextPacker:
+    """Etapa entre a recuperação e o `QA_PROMPT`.
+
+    Os candidatos são ordenados por MMR, com os vetores lidos do próprio índice FAISS
+    (sem re-embeber; índices que não os reconstroem ficam pela ordem da recuperação),
+    e acrescentados um a um enquanto o contexto, já com os chunks da mesma página
+    fundidos, couber em `orcamento_tokens`. Os tokens são contados com o
+    tokenizador do servidor; o custo de um bloco fundido é estimado pela
+    proporção tokens/caracteres dos chunks que o compõem.
+    """
+
+    def __init__(self, vectorstore: FAISS, contador: ContadorTokens, orcamento_tokens: int,
+                 lambda_mult: float = 0.7, sobreposicao_max: int = 256):
+        self.vectorstore = vectorstore
+        self.contador = contador
+        self.orcamento_tokens = orcamento_tokens
+        self.lambda_mult = lambda_mult
+        self.sobreposicao_max = sobreposicao_max
+        self._posicao_de: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._reconstroi = True
+
+    def _vetores(self, docs: List[Document]):
+        """Vetores dos candidatos reconstruídos do índice, ou None (o MMR é então ignorado)."""
+        if len(docs) < 2 or not self._reconstroi:
+            return None
+        mapa = self.vectorstore.index_to_docstore_id
+        with self._lock:
+            if len(self._posicao_de) != len(mapa):
+                self._posicao_de = {doc_id: posicao for posicao, doc_id in mapa.items()}
+            posicao_de = self._posicao_de
+        try:
+            posicoes = np.asarray([posicao_de[doc.id] for doc in docs], dtype=np.int64)
+            return self.vectorstore.index.reconstruct_batch(posicoes)
+        except KeyError:
+            return None
+        except RuntimeError as e:  # ex.: IVF sem mapa direto
+            logger.warning(f"⚠️ O índice não reconstrói vetores ({e}); o contexto segue a ordem da recuperação")
+            self._reconstroi = False
+            return None
+
+    def _custo(self, blocos: List[Document], tokens_por_char: Dict[str, float]) -> int:
+        media = sum(tokens_por_char.values()) / max(len(tokens_por_char), 1)
+        return int(sum(len(b.page_content) * tokens_por_char.get(b.id, media) for b in blocos))
+
+    def _empacotar(self, docs: List[Document], vetor_consulta, vetores, tokens: List[int]) -> List[Document]:
+        ordem = ordenar_mmr(vetor_consulta, vetores, self.lambda_mult) if vetores is not None else list(range(len(docs)))
+        tokens_por_char = {doc.id: t / max(len(doc.page_content), 1) for doc, t in zip(docs, tokens)}
+        escolhidos: List[Document] = []
+        blocos: List[Document] = []
+        for i in ordem:
+            tentativa = fundir_sobrepostos(escolhidos + [docs[i]], self.sobreposicao_max)
+            if self._custo(tentativa, tokens_por_char) > self.orcamento_tokens:
+                continue  # Um chunk menor mais abaixo ainda pode caber
+            escolhidos.append(docs[i])
+            blocos = tentativa
+        logger.debug(
+            f"📦 Contexto: {len(escolhidos)}/{len(docs)} chunks em {len(blocos)} blocos, "
+            f"~{self._custo(blocos, tokens_por_char)}/{self.orcamento_tokens} tokens (antes: {sum(tokens)})"
+        )
+        return blocos
+
+    def empacotar(self, pergunta: str, docs: List[Document]) -> List[Document]:
+        if not docs:
+            return docs
+        vetores = self._vetores(docs)
+        # A consulta acabou de ser embebida pelo retriever: vem da LRU da cache de embeddings
+        vetor_consulta = self.vectorstore.embeddings.embed_query(pergunta) if vetores is not None else None
+        return self._empacotar(docs, vetor_consulta, vetores, self.contador.contar([doc.page_content for doc in docs]))
+
+    async def aempacotar(self, pergunta: str, docs: List[Document]) -> List[Document]:
+        if not docs:
+            return docs
+        vetores = self._vetores(docs)
+        textos = [doc.page_content for doc in docs]
+        if vetores is not None:
+            vetor_consulta, tokens = await asyncio.gather(
+                self.vectorstore.embeddings.aembed_query(pergunta), self.contador.acontar(textos)
+            )
+        else:
+            vetor_consulta, tokens = None, await self.contador.acontar(textos)
+        return await asyncio.to_thread(self._empacotar, docs, vetor_consulta, vetores, tokens)
@@ -0,0 +1,162 @@
+# app/core/conversational_chain.py - Chain conversacional com atalho para perguntas de seguimento
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain_core.documents import Document
+from typing import Any, Dict, List, Optional
+import asyncio
+import re
+import time
+from app.utils.logger import logger
+from app.core.response_cache import normalizar_pergunta
+from app.core.retrieval import fundir_rrf
+from app.utils.metrics import medir
+
+# Palavras que remetem para a conversa anterior (já sem acentos)
+_REFERENCIAS = frozenset("""
+isso isto aquilo ele ela eles elas dele dela deles delas nele nela neles nelas disso disto
+daquilo desse dessa desses dessas deste destes nesse nessa neste esse essa esses essas este
+estes aquele aquela aqueles aquelas anterior anteriores acima mesmo mesma tambem outro outra
+outros outras seguinte
+""".split())
+_INICIOS_DE_SEGUIMENTO = ("e ", "mas ", "entao", "explique melhor", "explica melhor", "continue", "continua", "mais ", "como assim", "de um exemplo", "da um exemplo")
+_MIN_PALAVRAS = 4
+
+def precisa_reescrita(pergunta: str) -> bool:
+    """Heurística: a pergunta só é reescrita se parecer depender do histórico.
+
+    Perguntas muito curtas, que começam como continuação ("e quanto a...", "explique
+    melhor") ou que usam pronomes/demonstrativos ("isso", "dele") precisam do contexto.
+    """
+    texto = normalizar_pergunta(pergunta)
+    palavras = re.findall(r"\w+", texto)
+    if len(palavras) < _MIN_PALAVRAS or texto.startswith(_INICIOS_DE_SEGUIMENTO):
+        return True
+    return any(palavra in _REFERENCIAS for palavra in palavras)
+
+def _fundir_documentos(listas: List[List[Document]], rrf_k: int) -> List[Document]:
+    """Funde as recuperações da pergunta reescrita e da original, mantendo o número de chunks."""
+    por_id = {}
+    ids = []
+    for documentos in listas:
+        chaves = [doc.id or doc.page_content for doc in documentos]
+        por_id.update(zip(chaves, documentos))
+        ids.append(chaves)
+    return [por_id[chave] for chave in fundir_rrf(ids, max(len(l) for l in listas), rrf_k)]
+
+class FastConversationalRetrievalChain(ConversationalRetrievalChain):
+    """`ConversationalRetrievalChain` que evita esperar pela reescrita da pergunta.
+
+    - Sem histórico, ou se `precisa_reescrita` disser que a pergunta é autónoma, a
+      pergunta segue tal como está: não há chamada de condensação ao LLM.
+    - Quando é preciso reescrever, a recuperação com a pergunta original começa em
+      paralelo com a reescrita; no fim, as duas listas são fundidas por RRF.
+
+    O LLM de condensação deve ter `max_tokens` baixo: a reescrita é uma só linha.
+    Com `context_packer`, os documentos recuperados passam pela montagem do contexto
+    (`ContextPacker`) antes de chegarem ao prompt.
+    """
+
+    skip_heuristic: bool = True
+    parallel_retrieval: bool = True
+    rrf_k: int = 60
+    context_packer: Optional[Any] = None
+
+    def _deve_reescrever(self, pergunta: str, chat_history_str: str) -> bool:
+        if not chat_history_str:
+            return False
+        return not self.skip_heuristic or precisa_reescrita(pergunta)
+
+    @staticmethod
+    def _limpar_reescrita(reescrita: str, pergunta: str) -> str:
+        reescrita = reescrita.strip().splitlines()[0].strip() if reescrita.strip() else ""
+        return reescrita or pergunta
+
+    def _responder(self, pergunta, docs, resposta) -> Dict[str, Any]:
+        output: Dict[str, Any] = {self.output_key: resposta}
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        if self.return_generated_question:
+            output["generated_question"] = pergunta
+        return output
+
+    def _entradas_resposta(self, inputs, pergunta, chat_history_str):
+        novas = inputs.copy()
+        if self.rephrase_question:
+            novas["question"] = pergunta
+        novas["chat_history"] = chat_history_str
+        return novas
+
+    def _call(self, inputs: Dict[str, Any], run_manager: Optional[CallbackManagerForChainRun] = None) -> Dict[str, Any]:
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        pergunta = inputs["question"]
+        chat_history_str = (self.get_chat_history or _get_chat_history)(inputs["chat_history"])
+        if self._deve_reescrever(pergunta, chat_history_str):
+            with medir("condense"):
+                reescrita = self.question_generator.run(
+                    question=pergunta, chat_history=chat_history_str, callbacks=_run_manager.get_child()
+                )
+            pergunta = self._limpar_reescrita(reescrita, pergunta)
+        with medir("retrieval"):
+            docs = self._get_docs(pergunta, inputs, run_manager=_run_manager)
+        if self.context_packer is not None:
+            with medir("context_packing"):
+                docs = self.context_packer.empacotar(pergunta, docs)
+        if self.response_if_no_docs_found is not None and not docs:
+            return self._responder(pergunta, docs, self.response_if_no_docs_found)
+        resposta = self.combine_docs_chain.run(
+            input_documents=docs, callbacks=_run_manager.get_child(),
+            **self._entradas_resposta(inputs, pergunta, chat_history_str)
+        )
+        return self._responder(pergunta, docs, resposta)
+
+    async def _arecuperar(self, pergunta, inputs, run_manager):
+        """Uma recuperação, medida como etapa "retrieval" (a reescrita fica de fora, em "condense")."""
+        with medir("retrieval"):
+            return await self._aget_docs(pergunta, inputs, run_manager=run_manager)
+
+    async def _aobter_docs(self, pergunta, inputs, chat_history_str, run_manager):
+        """Devolve (pergunta usada, documentos), reescrevendo a pergunta só quando necessário."""
+        if not self._deve_reescrever(pergunta, chat_history_str):
+            if chat_history_str:
+                logger.debug("⏩ Pergunta de seguimento autónoma: reescrita dispensada")
+            return pergunta, await self._arecuperar(pergunta, inputs, run_manager)
+
+        inicio = time.perf_counter()
+        brutos = (asyncio.ensure_future(self._arecuperar(pergunta, inputs, run_manager))
+                  if self.parallel_retrieval else None)
+        try:
+            with medir("condense"):
+                reescrita = await self.question_generator.arun(
+                    question=pergunta, chat_history=chat_history_str, callbacks=run_manager.get_child()
+                )
+        except BaseException:
+            if brutos is not None:
+                brutos.cancel()
+            raise
+        reescrita = self._limpar_reescrita(reescrita, pergunta)
+        logger.debug(f"✏️ Pergunta reescrita em {(time.perf_counter() - inicio) * 1000:.0f} ms: '{reescrita}'")
+        if brutos is None:
+            return reescrita, await self._arecuperar(reescrita, inputs, run_manager)
+        if normalizar_pergunta(reescrita) == normalizar_pergunta(pergunta):
+            return reescrita, await brutos
+        docs_reescrita, docs_brutos = await asyncio.gather(
+            self._arecuperar(reescrita, inputs, run_manager), brutos
+        )
+        with medir("fusion"):
+            return reescrita, _fundir_documentos([docs_reescrita, docs_brutos], self.rrf_k)
+
+    async def _acall(self, inputs: Dict[str, Any], run_manager: Optional[AsyncCallbackManagerForChainRun] = None) -> Dict[str, Any]:
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        chat_history_str = (self.get_chat_history or _get_chat_history)(inputs["chat_history"])
+        pergunta, docs = await self._aobter_docs(inputs["question"], inputs, chat_history_str, _run_manager)
+        if self.context_packer is not None:
+            with medir("context_packing"):
+                docs = await self.context_packer.aempacotar(pergunta, docs)
+        if self.response_if_no_docs_found is not None and not docs:
+            return self._responder(pergunta, docs, self.response_if_no_docs_found)
+        resposta = await self.combine_docs_chain.arun(
+            input_documents=docs, callbacks=_run_manager.get_child(),
+            **self._entradas_resposta(inputs, pergunta, chat_history_str)
+        )
+        return self._responder(pergunta, docs, resposta)
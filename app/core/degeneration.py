@@ -0,0 +1,167 @@
+# app/core/degeneration.py - Deteção de respostas em ciclo durante o streaming do LLM
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import re
+import threading
+from app.utils.metrics import MetricaCalculada
+
+_PALAVRA = re.compile(r"\S+(?=\s)")
+_ESPACO = re.compile(r"\s")
+
+class DetectorRepeticao:
+    """Acompanha os tokens de uma geração e deteta quando o modelo entra em ciclo.
+
+    Dois sinais, ambos incrementais:
+    - proporção de n-gramas de palavras repetidos nas últimas `janela` palavras
+      (ciclos curtos, frases a repetir-se);
+    - a mesma linha (normalizada, com pelo menos `min_linha` caracteres) a aparecer
+      `max_linhas_repetidas` vezes (ciclos de parágrafos inteiros).
+
+    Ao detetar, `corte` passa a indicar onde começa a repetição: `texto_limpo()`
+    devolve o que foi gerado antes disso.
+
+    Os tokens ficam numa lista; cada verificação só junta o que falta analisar
+    (a linha ou a palavra em curso), e só quando o token a pode completar.
+    """
+
+    def __init__(self, n: int = 4, janela: int = 200, limiar: float = 0.5,
+                 max_linhas_repetidas: int = 3, min_linha: int = 20):
+        self.n = n
+        self.janela = janela
+        self.limiar = limiar
+        self.max_linhas_repetidas = max_linhas_repetidas
+        self.min_linha = min_linha
+        self.tokens = 0
+        self.corte: Optional[int] = None
+        self.motivo: Optional[str] = None
+        self._partes: List[str] = []
+        self._comprimento = 0
+        self._pos_palavras = 0  # início de `_resto_palavras` no texto gerado
+        self._pos_linhas = 0  # início de `_resto_linha`
+        self._resto_palavras: List[str] = []
+        self._resto_linha: List[str] = []
+        self._palavras: Deque[Tuple[str, int]] = deque(maxlen=n)
+        # (n-grama, posição de início, já estava na janela)
+        self._ngramas: Deque[Tuple[Tuple[str, ...], int, bool]] = deque()
+        self._contagem: Counter = Counter()
+        self._repetidos = 0
+        self._linhas: Dict[str, List[int]] = {}
+
+    @property
+    def degenerado(self) -> bool:
+        return self.corte is not None
+
+    def alimentar(self, token: str) -> bool:
+        """Acrescenta um token; devolve True assim que a geração for considerada degenerada."""
+        if self.degenerado:
+            return True
+        self.tokens += 1
+        self._partes.append(token)
+        self._comprimento += len(token)
+        self._verificar_linhas(token)
+        if not self.degenerado:
+            self._verificar_ngramas(token)
+        return self.degenerado
+
+    def texto_limpo(self) -> str:
+        texto = "".join(self._partes)
+        return texto if self.corte is None else texto[:self.corte].rstrip()
+
+    def tokens_limpos(self) -> int:
+        """Tokens do prefixo limpo, estimados pela proporção de caracteres do texto gerado."""
+        if self.corte is None or not self._comprimento:
+            return self.tokens
+        return round(self.tokens * len(self.texto_limpo()) / self._comprimento)
+
+    def _verificar_linhas(self, token: str) -> None:
+        self._resto_linha.append(token)
+        if "\n" not in token:
+            return
+        *linhas, resto = "".join(self._resto_linha).split("\n")
+        self._resto_linha = [resto]
+        inicio = self._pos_linhas
+        for linha in linhas:
+            chave = " ".join(linha.lower().split())
+            if len(chave) >= self.min_linha:
+                posicoes = self._linhas.setdefault(chave, [])
+                posicoes.append(inicio)
+                if len(posicoes) >= self.max_linhas_repetidas:
+                    # Guarda a primeira ocorrência; corta a partir da segunda
+                    self.corte, self.motivo = posicoes[1], "linha repetida"
+                    return
+            inicio += len(linha) + 1
+        self._pos_linhas = inicio
+
+    def _verificar_ngramas(self, token: str) -> None:
+        self._resto_palavras.append(token)
+        if not _ESPACO.search(token):
+            return  # Sem espaço nenhuma palavra fica completa
+        texto, base, fim = "".join(self._resto_palavras), self._pos_palavras, 0
+        for palavra in _PALAVRA.finditer(texto):
+            fim = palavra.end()
+            self._palavras.append((palavra.group().lower(), base + palavra.start()))
+            if len(self._palavras) < self.n:
+                continue
+            ngrama = tuple(p for p, _ in self._palavras)
+            repetido = self._contagem[ngrama] > 0
+            self._repetidos += repetido
+            self._contagem[ngrama] += 1
+            self._ngramas.append((ngrama, self._palavras[0][1], repetido))
+            if len(self._ngramas) > self.janela:
+                antigo, _, _ = self._ngramas.popleft()
+                self._repetidos -= self._contagem[antigo] > 1
+                self._contagem[antigo] -= 1
+            if len(self._ngramas) == self.janela and self._repetidos / self.janela >= self.limiar:
+                self.corte, self.motivo = self._inicio_do_ciclo(), "n-gramas repetidos"
+                return
+        self._resto_palavras = [texto[fim:]]
+        self._pos_palavras = base + fim
+
+    def _inicio_do_ciclo(self) -> int:
+        """Início da sequência final de n-gramas repetidos (tolera falhas curtas, ex.: numeração)."""
+        inicio, falhas = self._ngramas[-1][1], 0
+        for _, posicao, repetido in reversed(self._ngramas):
+            if repetido:
+                inicio, falhas = posicao, 0
+            else:
+                falhas += 1
+                if falhas > self.n:
+                    break
+        return inicio
+
+class EstatisticasDegeneracao:
+    """Contadores globais das gerações interrompidas por repetição."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.geracoes = 0
+        self.abortadas = 0
+        self.tokens_descartados = 0
+        self.orcamento_por_usar = 0
+
+    def registar(self, detector: DetectorRepeticao, max_tokens: int) -> None:
+        with self._lock:
+            self.geracoes += 1
+            if detector.degenerado:
+                self.abortadas += 1
+                # Tokens gerados mas cortados da resposta, e o que restava de `max_tokens`: um
+                # limite superior do que o servidor deixou de gerar (o modelo podia ter parado antes)
+                self.tokens_descartados += detector.tokens - detector.tokens_limpos()
+                self.orcamento_por_usar += max(max_tokens - detector.tokens, 0)
+
+    def como_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "geracoes": self.geracoes,
+                "abortadas": self.abortadas,
+                "tokens_descartados": self.tokens_descartados,
+                "orcamento_por_usar": self.orcamento_por_usar,
+            }
+
+estatisticas_degeneracao = EstatisticasDegeneracao()
+
+MetricaCalculada("ucdb_llm_loop_aborts_total", "Gerações interrompidas por repetição.", "counter",
+                 lambda: {(): estatisticas_degeneracao.abortadas})
+MetricaCalculada("ucdb_llm_loop_unused_token_budget_total",
+                 "Tokens de max_tokens por usar quando um ciclo foi interrompido (limite superior dos tokens poupados).",
+                 "counter", lambda: {(): estatisticas_degeneracao.orcamento_por_usar})
@@ -0,0 +1,183 @@
+# app/core/embedding_cache.py
+from langchain_core.embeddings import Embeddings
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+import asyncio
+import fcntl
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+from app.utils.logger import logger
+
+def _chave(texto: str) -> bytes:
+    return hashlib.sha256(texto.encode("utf-8")).digest()
+
+class EmbeddingDiskCache:
+    """Cache persistente de embeddings endereçado pelo conteúdo.
+
+    Os vetores ficam num ficheiro binário `float32` só de acréscimo, lido via memmap;
+    um índice SQLite mapeia o sha256 do texto para a linha do vetor. Cada modelo
+    (endpoint/identificador) tem o seu próprio diretório, pelo que a chave efetiva
+    é o par (texto, modelo).
+
+    Vários processos podem partilhar a cache (workers do uvicorn e o líder da
+    ingestão): cada acréscimo é feito sob um `flock` exclusivo do ficheiro de
+    vetores, que abrange o cálculo da primeira linha livre e o commit das linhas.
+    """
+
+    def __init__(self, path: str, modelo_id: str):
+        namespace = hashlib.sha256(modelo_id.encode("utf-8")).hexdigest()[:16]
+        self.dir = os.path.join(path, namespace)
+        os.makedirs(self.dir, exist_ok=True)
+        self._caminho_vetores = os.path.join(self.dir, "vetores.f32")
+        self._lock = threading.Lock()
+        self._mmap: Optional[np.memmap] = None
+
+        self._db = sqlite3.connect(os.path.join(self.dir, "indice.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS vetores (chave BLOB PRIMARY KEY, linha INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (nome TEXT PRIMARY KEY, valor TEXT)")
+        self._db.execute("INSERT OR IGNORE INTO meta VALUES ('modelo', ?)", (modelo_id,))
+        self._db.commit()
+        self.dim: Optional[int] = self._ler_dim()
+
+    def _ler_dim(self) -> Optional[int]:
+        linha = self._db.execute("SELECT valor FROM meta WHERE nome = 'dim'").fetchone()
+        return int(linha[0]) if linha else None
+
+    def _linhas_no_ficheiro(self) -> int:
+        if not self.dim or not os.path.exists(self._caminho_vetores):
+            return 0
+        return os.path.getsize(self._caminho_vetores) // (self.dim * 4)
+
+    def _matriz(self, linha_max: int) -> np.memmap:
+        if self._mmap is None or self._mmap.shape[0] <= linha_max:
+            self._mmap = np.memmap(
+                self._caminho_vetores, dtype=np.float32, mode="r",
+                shape=(self._linhas_no_ficheiro(), self.dim)
+            )
+        return self._mmap
+
+    def obter(self, chaves: Iterable[bytes]) -> Dict[bytes, List[float]]:
+        chaves = list(chaves)
+        if not chaves:
+            return {}
+        with self._lock:
+            if self.dim is None:
+                # A cache estava vazia ao abrir: outro processo pode ter guardado vetores desde então
+                self.dim = self._ler_dim()
+                if self.dim is None:
+                    return {}
+            linhas: Dict[bytes, int] = {}
+            for i in range(0, len(chaves), 500):
+                lote = chaves[i:i + 500]
+                marcadores = ",".join("?" * len(lote))
+                linhas.update(self._db.execute(
+                    f"SELECT chave, linha FROM vetores WHERE chave IN ({marcadores})", lote
+                ).fetchall())
+            if not linhas:
+                return {}
+            matriz = self._matriz(max(linhas.values()))
+            return {chave: matriz[linha].tolist() for chave, linha in linhas.items()}
+
+    def guardar(self, vetores: Dict[bytes, List[float]]) -> None:
+        if not vetores:
+            return
+        matriz = np.asarray(list(vetores.values()), dtype=np.float32)
+        with self._lock, open(self._caminho_vetores, "ab") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                if self.dim is None:
+                    # Outro processo pode ter fixado a dimensão depois de esta instância abrir a cache
+                    self.dim = self._ler_dim() or int(matriz.shape[1])
+                    self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self.dim),))
+                if matriz.shape[1] != self.dim:
+                    raise ValueError(f"Dimensão {matriz.shape[1]} incompatível com a cache ({self.dim})")
+                # Descarta uma eventual linha parcial deixada por uma escrita interrompida
+                inicio = self._linhas_no_ficheiro()
+                f.truncate(inicio * self.dim * 4)
+                f.write(matriz.tobytes())
+                f.flush()
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO vetores VALUES (?, ?)",
+                    [(chave, inicio + i) for i, chave in enumerate(vetores)]
+                )
+                self._db.commit()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class CachedEmbeddings(Embeddings):
+    """Camada de cache à frente de um cliente de embeddings.
+
+    Documentos passam pela cache em disco; consultas passam primeiro por uma LRU
+    em memória e depois pela mesma cache em disco (sem a alimentar).
+    """
+
+    def __init__(self, backend: Embeddings, cache: EmbeddingDiskCache, lru_size: int = 2048):
+        self.backend = backend
+        self.cache = cache
+        self.lru_size = lru_size
+        self._lru: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._lru_lock = threading.Lock()
+
+    def _pendentes(self, texts: List[str]):
+        chaves = [_chave(t) for t in texts]
+        encontrados = self.cache.obter(set(chaves))
+        faltam = {c: t for c, t in zip(chaves, texts) if c not in encontrados}
+        logger.debug(f"🗃️ Cache de embeddings: {len(encontrados)} reutilizados, {len(faltam)} por gerar")
+        return chaves, encontrados, faltam
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        chaves, encontrados, faltam = self._pendentes(texts)
+        if faltam:
+            novos = dict(zip(faltam, self.backend.embed_documents(list(faltam.values()))))
+            self.cache.guardar(novos)
+            encontrados.update(novos)
+        return [encontrados[c] for c in chaves]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        chaves, encontrados, faltam = await asyncio.to_thread(self._pendentes, texts)
+        if faltam:
+            novos = dict(zip(faltam, await self.backend.aembed_documents(list(faltam.values()))))
+            await asyncio.to_thread(self.cache.guardar, novos)
+            encontrados.update(novos)
+        return [encontrados[c] for c in chaves]
+
+    def _da_lru(self, chave: bytes) -> Optional[List[float]]:
+        with self._lru_lock:
+            vetor = self._lru.get(chave)
+            if vetor is not None:
+                self._lru.move_to_end(chave)
+            return vetor
+
+    def _do_disco(self, chave: bytes) -> Optional[List[float]]:
+        vetor = self.cache.obter([chave]).get(chave)
+        if vetor is not None:
+            self._guardar_consulta(chave, vetor)
+        return vetor
+
+    def _guardar_consulta(self, chave: bytes, vetor: List[float]) -> None:
+        with self._lru_lock:
+            self._lru[chave] = vetor
+            self._lru.move_to_end(chave)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        chave = _chave(text)
+        vetor = self._da_lru(chave) or self._do_disco(chave)
+        if vetor is None:
+            vetor = self.backend.embed_query(text)
+            self._guardar_consulta(chave, vetor)
+        return vetor
+
+    async def aembed_query(self, text: str) -> List[float]:
+        chave = _chave(text)
+        # A LRU responde logo; o SQLite e o memmap correm fora do event loop
+        vetor = self._da_lru(chave) or await asyncio.to_thread(self._do_disco, chave)
+        if vetor is None:
+            vetor = await self.backend.aembed_query(text)
+            self._guardar_consulta(chave, vetor)
+        return vetor
@@ -1,41 +1,138 @@
 # app/core/embeddings.py
 from langchain_core.embeddings import Embeddings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from typing import List, Optional
+import asyncio
+import time
+import httpx
 import requests
-from typing import List
 from app.utils.logger import logger
+from app.core.config import settings
+from app.core.http_client import get_async_client, get_sync_session, registar_erro_upstream
+
+def _extrair_embedding(data) -> List[float]:
+    return data[0]["embedding"][0]
+
+def _extrair_embeddings_lote(data, quantidade: int) -> List[List[float]]:
+    """O `/embedding` do llama.cpp devolve um item por `content`, com o respetivo `index`."""
+    if len(data) != quantidade:
+        raise ValueError(f"Servidor devolveu {len(data)} embeddings para {quantidade} textos")
+    itens = sorted(data, key=lambda item: item.get("index", 0))
+    return [item["embedding"][0] for item in itens]
+
+def _erro_transitorio(e: BaseException) -> bool:
+    """Falhas de rede, timeouts e respostas 429/5xx justificam nova tentativa."""
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, httpx.TransportError)):
+        return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return status in (429, 500, 502, 503, 504)
+
+def _antes_de_nova_tentativa(estado) -> None:
+    logger.warning(f"⚠️ Falha transitória no servidor de embeddings (tentativa {estado.attempt_number}): {estado.outcome.exception()}")
+
+_POLITICA_RETRY = dict(
+    retry=retry_if_exception(_erro_transitorio),
+    wait=wait_exponential(multiplier=0.5, max=10),
+    stop=stop_after_attempt(settings.EMBEDDING_MAX_RETRIES),
+    before_sleep=_antes_de_nova_tentativa,
+    reraise=True,
+)
+
+def _registar_conclusao(quantidade: int, inicio: float) -> None:
+    # Cada chamada é um lote da ingestão (ou do /chat): o progresso acumulado é registado em app/core/ingestion.py
+    duracao = time.monotonic() - inicio
+    logger.debug(f"✓ Embeddings gerados para {quantidade} textos em {duracao:.2f}s ({quantidade / max(duracao, 1e-9):.1f}/s)")
 
 class LlamaEmbeddings(Embeddings):
-    def __init__(self, api_url: str):
-        self.api_url = api_url
+    def __init__(self, api_url: str, batch_size: Optional[int] = None, concorrencia: Optional[int] = None):
+        self.api_url = str(api_url)
+        self.batch_size = batch_size or settings.EMBEDDING_BATCH_SIZE
+        self.concorrencia = concorrencia or settings.EMBEDDING_CONCURRENCY
+
+    def _lotes(self, texts: List[str]) -> List[List[str]]:
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+    @retry(**_POLITICA_RETRY)
+    def _embed_lote(self, lote: List[str]) -> List[List[float]]:
+        response = get_sync_session().post(
+            self.api_url,
+            json={"content": lote},
+            timeout=settings.EMBEDDING_TIMEOUT
+        )
+        response.raise_for_status()
+        return _extrair_embeddings_lote(response.json(), len(lote))
+
+    @retry(**_POLITICA_RETRY)
+    async def _aembed_lote(self, lote: List[str]) -> List[List[float]]:
+        response = await get_async_client().post(
+            self.api_url,
+            json={"content": lote},
+            timeout=settings.EMBEDDING_TIMEOUT
+        )
+        response.raise_for_status()
+        return _extrair_embeddings_lote(response.json(), len(lote))
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Envia os textos em lotes, com até `concorrencia` pedidos em paralelo."""
+        if not texts:
+            return []
         try:
-            embeddings = []
-            for text in texts:
-                response = requests.post(
-                    self.api_url,
-                    json={"content": text},
-                    timeout=30
-                )
-                response.raise_for_status()
-                data = response.json()
-                embeddings.append(data[0]["embedding"][0])
-            logger.info(f"✓ Embeddings gerados para {len(texts)} documentos")
-            return embeddings
+            lotes = self._lotes(texts)
+            resultados: List[Optional[List[List[float]]]] = [None] * len(lotes)
+            inicio = time.monotonic()
+            with ThreadPoolExecutor(max_workers=self.concorrencia) as executor:
+                futuros = {executor.submit(self._embed_lote, lote): i for i, lote in enumerate(lotes)}
+                for futuro in as_completed(futuros):
+                    resultados[futuros[futuro]] = futuro.result()
+            _registar_conclusao(len(texts), inicio)
+            return [vetor for lote in resultados for vetor in lote]
         except Exception as e:
             logger.error(f"✗ Falha ao gerar embeddings: {e}")
             raise
 
     def embed_query(self, text: str) -> List[float]:
         try:
-            response = requests.post(
+            response = get_sync_session().post(
+                self.api_url,
+                json={"content": text},
+                timeout=settings.EMBEDDING_TIMEOUT
+            )
+            response.raise_for_status()
+            return _extrair_embedding(response.json())
+        except Exception as e:
+            registar_erro_upstream("embedding", e)
+            logger.error(f"✗ Falha ao gerar embedding de consulta: {e}")
+            raise
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        try:
+            semaforo = asyncio.Semaphore(self.concorrencia)
+            inicio = time.monotonic()
+
+            async def processar(lote: List[str]) -> List[List[float]]:
+                async with semaforo:
+                    return await self._aembed_lote(lote)
+
+            resultados = await asyncio.gather(*(processar(lote) for lote in self._lotes(texts)))
+            _registar_conclusao(len(texts), inicio)
+            return [vetor for lote in resultados for vetor in lote]
+        except Exception as e:
+            logger.error(f"✗ Falha ao gerar embeddings: {e}")
+            raise
+
+    async def aembed_query(self, text: str) -> List[float]:
+        try:
+            response = await get_async_client().post(
                 self.api_url,
                 json={"content": text},
-                timeout=30
+                timeout=settings.EMBEDDING_TIMEOUT
             )
             response.raise_for_status()
-            data = response.json()
-            return data[0]["embedding"][0]
+            return _extrair_embedding(response.json())
         except Exception as e:
+            registar_erro_upstream("embedding", e)
             logger.error(f"✗ Falha ao gerar embedding de consulta: {e}")
-            raise
\ No newline at end of file
+            raise
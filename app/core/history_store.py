@@ -0,0 +1,102 @@
+# app/core/history_store.py - Histórico das conversas guardado no servidor, por session_id
+from abc import ABC, abstractmethod
+from typing import Dict, List
+import json
+import sqlite3
+import threading
+import time
+from app.core.config import settings
+from app.core.response_cache import TTLCache
+
+_CHARS_POR_TOKEN = 3.5
+
+def _tokens_estimados(mensagem: Dict[str, str]) -> int:
+    return int(len(mensagem.get("content", "")) / _CHARS_POR_TOKEN) + 1
+
+def limitar_historico(mensagens: List[Dict[str, str]], max_mensagens: int, max_tokens: int) -> List[Dict[str, str]]:
+    """Mantém os pares pergunta/resposta mais recentes que cabem em `max_mensagens` e `max_tokens`.
+
+    Os tokens são estimados pelo número de caracteres: o limite serve para que o
+    histórico enviado à reescrita da pergunta não cresça sem fim, não precisa de ser exato.
+    """
+    mensagens = mensagens[-max_mensagens:] if max_mensagens > 0 else []
+    total = 0
+    for inicio in range(len(mensagens) - 2, -1, -2):
+        total += sum(_tokens_estimados(m) for m in mensagens[inicio:inicio + 2])
+        # O par mais recente fica sempre, mesmo que sozinho exceda o limite
+        if total > max_tokens and inicio < len(mensagens) - 2:
+            return mensagens[inicio + 2:]
+    return mensagens
+
+class HistoryStore(ABC):
+    """Interface comum: histórico como lista de mensagens `{"role", "content"}` por sessão."""
+
+    @abstractmethod
+    def obter(self, session_id: str) -> List[Dict[str, str]]:
+        ...
+
+    @abstractmethod
+    def guardar(self, session_id: str, mensagens: List[Dict[str, str]]) -> None:
+        ...
+
+    def acrescentar(self, session_id: str, pergunta: str, resposta: str) -> None:
+        mensagens = self.obter(session_id) + [
+            {"role": "user", "content": pergunta},
+            {"role": "ai", "content": resposta},
+        ]
+        self.guardar(session_id, limitar_historico(mensagens, settings.HISTORY_MAX_MESSAGES, settings.HISTORY_MAX_TOKENS))
+
+class MemoryHistoryStore(HistoryStore):
+    """LRU com TTL em memória; cada processo tem a sua (usar só com um worker)."""
+
+    def __init__(self, tamanho: int, ttl: float):
+        self._cache = TTLCache(tamanho, ttl)
+
+    def obter(self, session_id: str) -> List[Dict[str, str]]:
+        return list(self._cache.obter(session_id) or [])
+
+    def guardar(self, session_id: str, mensagens: List[Dict[str, str]]) -> None:
+        self._cache.guardar(session_id, mensagens)
+
+class SQLiteHistoryStore(HistoryStore):
+    """Histórico num ficheiro SQLite (WAL), partilhado por todos os workers da máquina."""
+
+    def __init__(self, caminho: str, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(caminho, check_same_thread=False, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS historico (session_id TEXT PRIMARY KEY, mensagens TEXT NOT NULL, expira REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS historico_expira ON historico (expira)")
+        self._db.commit()
+        self._ultima_limpeza = 0.0
+
+    def obter(self, session_id: str) -> List[Dict[str, str]]:
+        with self._lock:
+            linha = self._db.execute(
+                "SELECT mensagens FROM historico WHERE session_id = ? AND expira > ?", (session_id, time.time())
+            ).fetchone()
+        return json.loads(linha[0]) if linha else []
+
+    def guardar(self, session_id: str, mensagens: List[Dict[str, str]]) -> None:
+        agora = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO historico VALUES (?, ?, ?)",
+                (session_id, json.dumps(mensagens, ensure_ascii=False), agora + self.ttl)
+            )
+            # Sessões expiradas são apagadas no máximo uma vez por minuto
+            if agora - self._ultima_limpeza > 60:
+                self._db.execute("DELETE FROM historico WHERE expira <= ?", (agora,))
+                self._ultima_limpeza = agora
+            self._db.commit()
+
+def criar_history_store() -> HistoryStore:
+    if settings.HISTORY_BACKEND == "sqlite":
+        return SQLiteHistoryStore(settings.history_db_path, settings.HISTORY_TTL)
+    if settings.HISTORY_BACKEND != "memory":
+        raise ValueError(f"HISTORY_BACKEND desconhecido: {settings.HISTORY_BACKEND}")
+    return MemoryHistoryStore(settings.HISTORY_CACHE_SIZE, settings.HISTORY_TTL)
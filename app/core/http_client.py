@@ -0,0 +1,66 @@
+# app/core/http_client.py
+import asyncio
+import weakref
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from app.core.config import settings
+from app.utils.logger import logger
+from app.utils.metrics import erros_upstream
+
+# Um cliente assíncrono por event loop: as ligações do httpx ficam presas ao loop que as criou.
+_clientes_async: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_sessao_sync = None
+
+def get_async_client() -> httpx.AsyncClient:
+    """Devolve o cliente HTTP assíncrono partilhado (com pool e keep-alive) do loop atual."""
+    loop = asyncio.get_running_loop()
+    cliente = _clientes_async.get(loop)
+    if cliente is None or cliente.is_closed:
+        cliente = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(settings.LLM_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT),
+        )
+        _clientes_async[loop] = cliente
+    return cliente
+
+def get_sync_session() -> requests.Session:
+    """Devolve a sessão `requests` partilhada, reutilizando ligações entre chamadas síncronas."""
+    global _sessao_sync
+    if _sessao_sync is None:
+        sessao = requests.Session()
+        adaptador = HTTPAdapter(
+            pool_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            pool_maxsize=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        )
+        sessao.mount("http://", adaptador)
+        sessao.mount("https://", adaptador)
+        _sessao_sync = sessao
+    return _sessao_sync
+
+async def fechar_clientes():
+    """Fecha o cliente assíncrono do loop atual e a sessão síncrona (usado no shutdown)."""
+    global _sessao_sync
+    cliente = _clientes_async.pop(asyncio.get_running_loop(), None)
+    if cliente is not None:
+        await cliente.aclose()
+    if _sessao_sync is not None:
+        _sessao_sync.close()
+        _sessao_sync = None
+    logger.debug("Clientes HTTP fechados.")
+
+def registar_erro_upstream(servico: str, e: BaseException) -> None:
+    """Conta uma falha HTTP ao llama.cpp por tipo: timeout, http_status ou connection."""
+    if isinstance(e, (httpx.TimeoutException, requests.exceptions.Timeout)):
+        tipo = "timeout"
+    elif isinstance(e, (httpx.HTTPStatusError, requests.exceptions.HTTPError)):
+        tipo = "http_status"
+    elif isinstance(e, (httpx.HTTPError, requests.exceptions.RequestException)):
+        tipo = "connection"
+    else:
+        return
+    erros_upstream.inc(service=servico, kind=tipo)
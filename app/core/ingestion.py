@@ -0,0 +1,211 @@
+# app/core/ingestion.py - Pipeline de ingestão de PDFs (parse → split → título → embedding)
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from langchain_community.document_loaders import PyPDFLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from app.utils.logger import logger
+from app.core.config import settings
+from app.core.llm import LlamaServerLLM
+from app.core.vector_index import criar_indice, novo_vectorstore
+import multiprocessing
+import numpy as np
+import os
+import queue
+import threading
+import time
+import uuid
+
+_FIM = object()
+
+def _gerar_titulo_para_documento(texto_documento: str, llm: LlamaServerLLM) -> str:
+    prompt_template = """<|start_header_id|>system<|end_header_id|>
+Você é um especialista em catalogação. Sua única tarefa é ler o texto e gerar um título curto (3 a 7 palavras) que resuma a área de conhecimento. Regras: Responda APENAS com o título. Exemplo: "Análise de Circuitos Elétricos"<|eot_id|><|start_header_id|>user<|end_header_id|>
+**Texto:**
+{texto}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"""
+    texto_limitado = texto_documento[:4096]
+    prompt = prompt_template.format(texto=texto_limitado)
+    try:
+        titulo = llm._call(prompt).strip().replace('"', '').replace("Título:", "").strip()
+        return titulo if len(titulo) > 8 else "Tópico Geral"
+    except Exception: return "Tópico não identificado"
+
+def _carregar_e_dividir(caminho, chunk_size, chunk_overlap):
+    """Executado no pool de processos: lê o PDF e divide-o em chunks com ids próprios."""
+    docs = PyPDFLoader(caminho).load()
+    texto_para_titulo = " ".join([doc.page_content for doc in docs[:3]])
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+    chunks = splitter.split_documents(docs)
+    for chunk in chunks:
+        chunk.id = str(uuid.uuid4())
+    return texto_para_titulo, chunks
+
+class _Progresso:
+    """Regista periodicamente, ao longo de toda a ingestão, os chunks embebidos e a taxa (chunks/s)."""
+
+    INTERVALO_LOG = 5.0
+
+    def __init__(self, total_pdfs: int):
+        self.total_pdfs = total_pdfs
+        self.pdfs_lidos = 0
+        self.chunks_lidos = 0
+        self.feitos = 0
+        self.inicio = time.monotonic()
+        self._ultimo_log = self.inicio
+        self._lock = threading.Lock()
+
+    @property
+    def taxa(self) -> float:
+        return self.feitos / max(time.monotonic() - self.inicio, 1e-9)
+
+    def ler(self, chunks: int) -> None:
+        with self._lock:
+            self.pdfs_lidos += 1
+            self.chunks_lidos += chunks
+
+    def avancar(self, quantidade: int) -> None:
+        with self._lock:
+            self.feitos += quantidade
+            agora = time.monotonic()
+            if agora - self._ultimo_log >= self.INTERVALO_LOG:
+                self._ultimo_log = agora
+                logger.info(
+                    f"⏳ Embeddings: {self.feitos}/{self.chunks_lidos} chunks lidos "
+                    f"({self.pdfs_lidos}/{self.total_pdfs} PDFs, {self.taxa:.1f} chunks/s)"
+                )
+
+class _IndexadorEmLotes:
+    """Consome chunks de uma fila e adiciona-os ao índice em lotes.
+
+    É a única thread que escreve no vectorstore. Índices sem treino (Flat, SQfp16,
+    HNSW) são criados logo com o primeiro lote. Os que precisam de treino (IVF, PQ)
+    retêm os vetores, num array float32, até haver `FAISS_TRAIN_SIZE` (ou até ao fim
+    da ingestão). Se falhar, continua a esvaziar a fila (para não
+    bloquear os produtores) e guarda o erro para o fim da ingestão.
+    """
+
+    def __init__(self, embedding_client, vectorstore, tamanho_lote, progresso):
+        self.embedding_client = embedding_client
+        self.vectorstore = vectorstore
+        self.tamanho_lote = tamanho_lote
+        self.progresso = progresso
+        self.indexados = 0
+        self.erro = None
+        self._pendentes = []
+        # À espera do treino do índice: (texto, metadata, id) e os vetores de cada lote
+        self._retidos = []
+        self._vetores_retidos = []
+
+    def _adicionar(self, itens, vetores):
+        textos, metadatas, ids = zip(*itens)
+        self.vectorstore.add_embeddings(list(zip(textos, vetores)), metadatas=list(metadatas), ids=list(ids))
+        self.indexados += len(itens)
+
+    def _criar_indice_com_retidos(self):
+        vetores = np.concatenate(self._vetores_retidos)
+        self.vectorstore = novo_vectorstore(self.embedding_client, vetores)
+        self._adicionar(self._retidos, vetores)
+        self._retidos, self._vetores_retidos = [], []
+
+    def _adicionar_lote(self, lote):
+        textos = [chunk.page_content for chunk in lote]
+        vetores = np.asarray(self.embedding_client.embed_documents(textos), dtype=np.float32)
+        self.progresso.avancar(len(lote))
+        itens = list(zip(textos, [chunk.metadata for chunk in lote], [chunk.id for chunk in lote]))
+        if self.vectorstore is None and not self._retidos and criar_indice(vetores.shape[1]).is_trained:
+            self.vectorstore = novo_vectorstore(self.embedding_client, vetores)
+        if self.vectorstore is None:
+            self._retidos.extend(itens)
+            self._vetores_retidos.append(vetores)
+            if len(self._retidos) >= settings.FAISS_TRAIN_SIZE:
+                self._criar_indice_com_retidos()
+        else:
+            self._adicionar(itens, vetores)
+
+    def consumir(self, fila):
+        while (chunks := fila.get()) is not _FIM:
+            if self.erro is not None:
+                continue
+            try:
+                self._pendentes.extend(chunks)
+                while len(self._pendentes) >= self.tamanho_lote:
+                    lote = self._pendentes[:self.tamanho_lote]
+                    del self._pendentes[:self.tamanho_lote]
+                    self._adicionar_lote(lote)
+            except Exception as e:
+                self.erro = e
+        if self.erro is None:
+            try:
+                if self._pendentes:
+                    self._adicionar_lote(self._pendentes)
+                    self._pendentes = []
+                if self._retidos:
+                    self._criar_indice_com_retidos()
+            except Exception as e:
+                self.erro = e
+
+def executar_ingestao(pdf_path, ficheiros, assinaturas, llm, embedding_client, vectorstore=None):
+    """Indexa `ficheiros` num pipeline com as etapas sobrepostas.
+
+    O parse e o split correm num pool de processos; os títulos são gerados num pool
+    de threads; os chunks seguem por uma fila limitada até à thread de embeddings,
+    que os adiciona ao índice em lotes. A fila e o número de PDFs em curso limitam
+    a memória usada. Devolve o vectorstore (criado se `vectorstore` for None) e as
+    novas entradas do manifesto.
+    """
+    if not ficheiros:
+        return vectorstore, {}
+    trabalhadores = min(settings.INGESTION_WORKERS or os.cpu_count() or 1, len(ficheiros))
+    max_em_curso = trabalhadores * 2
+    fila_chunks = queue.Queue(maxsize=settings.INGESTION_QUEUE_SIZE)
+    progresso = _Progresso(len(ficheiros))
+    indexador = _IndexadorEmLotes(embedding_client, vectorstore, settings.INGESTION_BATCH_CHUNKS, progresso)
+    consumidor = threading.Thread(target=indexador.consumir, args=(fila_chunks,), name="ingestao-embeddings", daemon=True)
+    consumidor.start()
+
+    inicio = time.monotonic()
+    entradas, titulos = {}, {}
+    restantes = iter(ficheiros)
+    contexto = multiprocessing.get_context("spawn")
+    logger.info(f"📥 Ingestão de {len(ficheiros)} PDFs com {trabalhadores} processos")
+
+    with ProcessPoolExecutor(max_workers=trabalhadores, mp_context=contexto) as pool, \
+            ThreadPoolExecutor(max_workers=settings.INGESTION_TITLE_CONCURRENCY, thread_name_prefix="ingestao-titulos") as pool_titulos:
+        em_curso = {}
+
+        def submeter():
+            while len(em_curso) < max_em_curso:
+                ficheiro = next(restantes, None)
+                if ficheiro is None:
+                    return
+                futuro = pool.submit(_carregar_e_dividir, os.path.join(pdf_path, ficheiro), settings.CHUNK_SIZE, settings.CHUNK_OVERLAP)
+                em_curso[futuro] = ficheiro
+
+        try:
+            submeter()
+            while em_curso and indexador.erro is None:
+                concluidos, _ = wait(em_curso, return_when=FIRST_COMPLETED)
+                for futuro in concluidos:
+                    ficheiro = em_curso.pop(futuro)
+                    try:
+                        texto_para_titulo, chunks = futuro.result()
+                    except Exception as e:
+                        logger.error(f"✗ Erro ao processar {ficheiro}: {e}")
+                        continue
+                    titulos[ficheiro] = pool_titulos.submit(_gerar_titulo_para_documento, texto_para_titulo, llm)
+                    entradas[ficheiro] = {**assinaturas[ficheiro], "ids": [chunk.id for chunk in chunks]}
+                    progresso.ler(len(chunks))
+                    fila_chunks.put(chunks)  # Bloqueia enquanto os embeddings estiverem atrasados
+                    logger.info(f"📄 {ficheiro}: {len(chunks)} chunks ({len(entradas)}/{len(ficheiros)} PDFs lidos)")
+                submeter()
+        finally:
+            fila_chunks.put(_FIM)
+            consumidor.join()
+
+        for ficheiro, futuro in titulos.items():
+            entradas[ficheiro] = {"titulo": futuro.result(), **entradas[ficheiro]}
+
+    if indexador.erro is not None:
+        raise indexador.erro
+    duracao = time.monotonic() - inicio
+    logger.info(f"✓ Ingestão concluída: {len(entradas)} PDFs, {indexador.indexados} chunks em {duracao:.1f}s ({indexador.indexados / max(duracao, 1e-9):.1f} chunks/s)")
+    return indexador.vectorstore, entradas
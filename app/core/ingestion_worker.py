@@ -0,0 +1,90 @@
+# app/core/ingestion_worker.py - Ingestão em segundo plano com troca a quente do índice
+
+from typing import Callable, Optional
+from app.utils.logger import logger
+from app.core.config import settings
+import os
+import threading
+import time
+
+class IngestionWorker:
+    """Thread que reindexa a pasta de PDFs quando ela muda ou quando é pedido.
+
+    O índice novo é construído à parte (`criar_vectorstore` carrega a sua própria cópia)
+    e entregue a `ao_concluir`, que faz a troca atómica do vectorstore e da chain em uso.
+    Os pedidos ao /chat já em curso continuam com a chain antiga até terminarem.
+    """
+
+    def __init__(self, ao_concluir: Callable[[object], None], intervalo: Optional[float] = None):
+        self.ao_concluir = ao_concluir
+        self.intervalo = intervalo or settings.INGESTION_WATCH_INTERVAL
+        self._pedido = threading.Event()
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._assinatura_pasta = None
+        self.status = {
+            "estado": "inativo",
+            "execucoes": 0,
+            "ultima_execucao": None,
+            "ultima_duracao_s": None,
+            "ultimo_erro": None,
+            "pedido_pendente": False,
+        }
+
+    def _ler_assinatura_pasta(self):
+        pasta = settings.pdf_path
+        assinatura = []
+        for nome in sorted(os.listdir(pasta)):
+            if not nome.endswith(".pdf"): continue
+            try:
+                stat = os.stat(os.path.join(pasta, nome))
+            except FileNotFoundError:
+                continue
+            assinatura.append((nome, stat.st_mtime, stat.st_size))
+        return tuple(assinatura)
+
+    def iniciar(self):
+        if self._thread is not None: return
+        self._assinatura_pasta = self._ler_assinatura_pasta()
+        self._thread = threading.Thread(target=self._ciclo, name="ingestao-segundo-plano", daemon=True)
+        self._thread.start()
+        logger.info(f"👀 A vigiar {settings.pdf_path} a cada {self.intervalo:.0f}s")
+
+    def parar(self):
+        self._parar.set()
+        self._pedido.set()
+
+    def solicitar(self) -> bool:
+        """Agenda uma reindexação; devolve False se já havia uma pendente."""
+        if self._pedido.is_set(): return False
+        self.status["pedido_pendente"] = True
+        self._pedido.set()
+        return True
+
+    def _ciclo(self):
+        while not self._parar.is_set():
+            pedido = self._pedido.wait(self.intervalo)
+            if self._parar.is_set(): break
+            self._pedido.clear()
+            self.status["pedido_pendente"] = False
+            assinatura = self._ler_assinatura_pasta()
+            if pedido or (settings.INGESTION_WATCH and assinatura != self._assinatura_pasta):
+                self._assinatura_pasta = assinatura
+                self._executar()
+
+    def _executar(self):
+        from app.core.rag import criar_vectorstore
+        inicio = time.monotonic()
+        self.status.update(estado="a_indexar", ultima_execucao=time.time())
+        logger.info("🔄 Reindexação em segundo plano iniciada")
+        try:
+            vectorstore = criar_vectorstore()
+            self.ao_concluir(vectorstore)
+            self.status.update(estado="inativo", ultimo_erro=None)
+            logger.success("✅ Reindexação concluída e índice trocado")
+        except Exception as e:
+            self.status.update(estado="erro", ultimo_erro=str(e))
+            logger.error(f"❌ Falha na reindexação em segundo plano: {e}", exc_info=True)
+        finally:
+            self.status["execucoes"] += 1
+            self.status["ultima_duracao_s"] = round(time.monotonic() - inicio, 2)
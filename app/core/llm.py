@@ -1,17 +1,197 @@
 # app/core/llm.py - Versão com Stop Tokens Otimizados para Llama 3
 
 from langchain_core.language_models.llms import LLM
-from langchain_core.callbacks import CallbackManagerForLLMRun
-from typing import Any, List, Optional
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.outputs import GenerationChunk
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Iterator, List, Optional
+import hashlib
+import json
+import time
+import httpx
 import requests
 from app.utils.logger import logger
 from app.core.config import settings
+from app.core.http_client import get_async_client, get_sync_session, registar_erro_upstream
+from app.core.degeneration import DetectorRepeticao, estatisticas_degeneracao
+from app.utils.metrics import registar_etapa, tokens_gerados, tokens_por_segundo
+
+# --- LISTA DE STOP TOKENS CORRIGIDA E OTIMIZADA PARA LLAMA 3 ---
+STOP_TOKENS_PADRAO = [
+    "<|eot_id|>",
+    "<|end_of_text|>",
+    "<|start_header_id|>"
+]
+
+_FIM_DO_STREAM = object()
+
+# Sessão do pedido em curso; as tarefas asyncio criadas a partir dele herdam o valor
+_sessao_atual: ContextVar[Optional[str]] = ContextVar("sessao_llm", default=None)
+
+def definir_sessao(session_id: Optional[str]) -> None:
+    """Associa as chamadas seguintes ao LLM (neste contexto) à sessão do utilizador."""
+    _sessao_atual.set(session_id)
+
+def slot_da_sessao(session_id: Optional[str]) -> Optional[int]:
+    """Slot do llama-server fixo para a sessão (hash estável), ou None sem afinidade.
+
+    Com o mesmo slot, o llama.cpp reaproveita a cache KV do prefixo já processado
+    (prompt de sistema e contexto repetido) em vez de o voltar a calcular.
+    """
+    if not session_id or settings.LLM_SLOTS <= 0:
+        return None
+    return int.from_bytes(hashlib.sha1(session_id.encode("utf-8")).digest()[:4], "big") % settings.LLM_SLOTS
+
+def _token_do_evento(linha: str):
+    """Extrai o texto de uma linha SSE do llama.cpp (`None` se não houver, `_FIM_DO_STREAM` no fim)."""
+    if not linha or not linha.startswith("data:"):
+        return None
+    dados = linha[5:].strip()
+    if dados == "[DONE]":
+        return _FIM_DO_STREAM
+    return json.loads(dados)["choices"][0].get("text", "") or None
+
+class _MedicaoStream:
+    """Tempo até ao primeiro token (inclui o prefill), duração e velocidade de uma geração."""
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.primeiro: Optional[float] = None
+        self.tokens = 0
+
+    def token(self) -> None:
+        if self.primeiro is None:
+            self.primeiro = time.perf_counter()
+            registar_etapa("llm_ttft", self.primeiro - self.inicio)
+        self.tokens += 1
+
+    def concluir(self) -> None:
+        if self.primeiro is None:
+            return
+        duracao = time.perf_counter() - self.primeiro
+        registar_etapa("llm_generation", duracao)
+        tokens_gerados.inc(self.tokens)
+        if self.tokens > 1 and duracao > 0:
+            tokens_por_segundo.observar((self.tokens - 1) / duracao)
 
 class LlamaServerLLM(LLM):
+    # Quando ativo, `_call`/`_acall` consomem o endpoint em modo streaming e emitem cada
+    # token via `on_llm_new_token`, permitindo que a API o reencaminhe ao cliente.
+    streaming: bool = False
+    # Sobrepõem as settings para usos curtos (ex.: reescrita da pergunta com poucos tokens)
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    stop_tokens: Optional[List[str]] = None
+    # Fixa os pedidos da sessão atual num slot (ver `slot_da_sessao`). Só o LLM da resposta
+    # final o faz: prompts com outro prefixo (reescrita) expulsariam a cache do slot.
+    fixar_slot: bool = False
+    # Acompanha o stream com um `DetectorRepeticao` e fecha o pedido ao llama.cpp (que
+    # deixa de gerar) quando a resposta entra em ciclo; devolve só o prefixo limpo.
+    detetar_repeticao: bool = False
+
     @property
     def _llm_type(self) -> str:
         return "llama_server"
 
+    @property
+    def _url(self) -> str:
+        return f"{settings.LLM_BASE_URL}/completions"
+
+    def _montar_payload(self, prompt: str, stop: Optional[List[str]], stream: bool) -> dict:
+        payload = {
+            "prompt": prompt,
+            "temperature": settings.TEMPERATURE if self.temperature is None else self.temperature,
+            "max_tokens": self.max_tokens or settings.MAX_TOKENS,
+            "top_p": settings.TOP_P,
+            "repeat_penalty": settings.REPETITION_PENALTY,
+            "stop": stop or self.stop_tokens or STOP_TOKENS_PADRAO,
+            "stream": stream,
+            # O llama.cpp só processa a parte do prompt que difere da cache KV do slot
+            "cache_prompt": settings.LLM_CACHE_PROMPT,
+        }
+        slot = slot_da_sessao(_sessao_atual.get()) if self.fixar_slot else None
+        if slot is not None:
+            payload["id_slot"] = slot
+        return payload
+
+    def _novo_detector(self) -> Optional[DetectorRepeticao]:
+        if not (self.detetar_repeticao and settings.LLM_LOOP_DETECTION):
+            return None
+        return DetectorRepeticao(
+            n=settings.LLM_LOOP_NGRAM,
+            janela=settings.LLM_LOOP_WINDOW,
+            limiar=settings.LLM_LOOP_THRESHOLD,
+            max_linhas_repetidas=settings.LLM_LOOP_MAX_LINE_REPEATS,
+        )
+
+    def _abortar_se_degenerado(self, detector: Optional[DetectorRepeticao], token: str) -> bool:
+        if detector is None or not detector.alimentar(token):
+            return False
+        max_tokens = self.max_tokens or settings.MAX_TOKENS
+        logger.warning(
+            f"🔁 Resposta em ciclo ({detector.motivo}) após {detector.tokens} tokens: geração interrompida, "
+            f"até {max(max_tokens - detector.tokens, 0)} tokens poupados"
+        )
+        return True
+
+    def _texto_final(self, partes: List[str], detector: Optional[DetectorRepeticao]) -> str:
+        if detector is None:
+            return "".join(partes)
+        estatisticas_degeneracao.registar(detector, self.max_tokens or settings.MAX_TOKENS)
+        return detector.texto_limpo()
+
+    def _finalizar(self, text: str) -> str:
+        if not text:
+            logger.warning("⚠️ LLM retornou texto vazio")
+            # Retornamos uma string vazia para a API tratar a mensagem de erro padrão
+            return ""
+        logger.info(f"← Resposta recebida ({len(text)} chars)")
+        return text
+
+    def _erro_de_conexao(self, e: Exception) -> Exception:
+        registar_erro_upstream("llm", e)
+        logger.critical(f"🛑 LLM não acessível em {settings.LLM_BASE_URL}. Erro: {e}")
+        return Exception("LLM não está respondendo. Verifique se o servidor llama.cpp está em execução.")
+
+    # --- Caminho síncrono (ingestão, geração de títulos) ---
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        """Consome o `/completions` do llama.cpp com `stream: true` (eventos SSE)."""
+        logger.info(f"→ Enviando prompt em streaming ({len(prompt)} chars)")
+        detector = kwargs.get("detector")
+        medicao = _MedicaoStream()
+        try:
+            with get_sync_session().post(
+                self._url,
+                json=self._montar_payload(prompt, stop, stream=True),
+                stream=True,
+                timeout=settings.LLM_TIMEOUT
+            ) as response:
+                response.raise_for_status()
+                for linha in response.iter_lines():
+                    token = _token_do_evento(linha.decode("utf-8"))
+                    if token is _FIM_DO_STREAM:
+                        break
+                    if token is None:
+                        continue
+                    medicao.token()
+                    if self._abortar_se_degenerado(detector, token):
+                        break  # Fechar a ligação cancela a geração no llama.cpp
+                    chunk = GenerationChunk(text=token)
+                    if run_manager:
+                        run_manager.on_llm_new_token(token, chunk=chunk)
+                    yield chunk
+        except requests.exceptions.RequestException as e:
+            raise self._erro_de_conexao(e)
+        finally:
+            medicao.concluir()
+
     def _call(
         self,
         prompt: str,
@@ -19,50 +199,98 @@ class LlamaServerLLM(LLM):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> str:
- 
+
         try:
-            logger.info(f"→ Enviando prompt ({len(prompt)} chars)")
-            
-            # --- LISTA DE STOP TOKENS CORRIGIDA E OTIMIZADA PARA LLAMA 3 ---
-            stop_tokens = stop or [
-                "<|eot_id|>",
-                "<|end_of_text|>",
-                "<|start_header_id|>"
-            ]
-
-            response = requests.post(
-                f"{settings.LLM_BASE_URL}/completions",
-                json={
-                    "prompt": prompt,
-                    "temperature": settings.TEMPERATURE,
-                    "max_tokens": settings.MAX_TOKENS,
-                    "top_p": settings.TOP_P,
-                    "repeat_penalty": settings.REPETITION_PENALTY,
-                    "stop": stop_tokens,
-                    "stream": False,
-                },
-                timeout=120
-            )
-
-            response.raise_for_status()
-            data = response.json()
-            text = data["choices"][0]["text"].strip()
-            
-            if not text:
-                logger.warning("⚠️ LLM retornou texto vazio")
-                # Retornamos uma string vazia para a API tratar a mensagem de erro padrão
-                return ""
-
-            logger.info(f"← Resposta recebida ({len(text)} chars)")
-            return text
+            if self.streaming:
+                detector = self._novo_detector()
+                partes = [chunk.text for chunk in self._stream(prompt, stop, run_manager, detector=detector, **kwargs)]
+                text = self._texto_final(partes, detector)
+            else:
+                logger.info(f"→ Enviando prompt ({len(prompt)} chars)")
+                response = get_sync_session().post(
+                    self._url,
+                    json=self._montar_payload(prompt, stop, stream=False),
+                    timeout=settings.LLM_TIMEOUT
+                )
+                response.raise_for_status()
+                text = response.json()["choices"][0]["text"]
+            return self._finalizar(text.strip())
 
         except requests.exceptions.RequestException as e:
-            logger.critical(f"🛑 LLM não acessível em {settings.LLM_BASE_URL}. Erro: {e}")
-            raise Exception("LLM não está respondendo. Verifique se o servidor llama.cpp está em execução.")
+            raise self._erro_de_conexao(e)
+        except Exception as e:
+            logger.error(f"❌ Erro na chamada ao LLM: {e}")
+            raise
+
+    # --- Caminho assíncrono (/chat), sobre o pool HTTP partilhado ---
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        """Versão assíncrona de `_stream`; fechar o iterador fecha a ligação ao llama.cpp."""
+        logger.info(f"→ Enviando prompt em streaming ({len(prompt)} chars)")
+        detector = kwargs.get("detector")
+        medicao = _MedicaoStream()
+        try:
+            async with get_async_client().stream(
+                "POST",
+                self._url,
+                json=self._montar_payload(prompt, stop, stream=True),
+                timeout=settings.LLM_TIMEOUT
+            ) as response:
+                response.raise_for_status()
+                async for linha in response.aiter_lines():
+                    token = _token_do_evento(linha)
+                    if token is _FIM_DO_STREAM:
+                        break
+                    if token is None:
+                        continue
+                    medicao.token()
+                    if self._abortar_se_degenerado(detector, token):
+                        break
+                    chunk = GenerationChunk(text=token)
+                    if run_manager:
+                        await run_manager.on_llm_new_token(token, chunk=chunk)
+                    yield chunk
+        except httpx.HTTPError as e:
+            raise self._erro_de_conexao(e)
+        finally:
+            medicao.concluir()
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+
+        try:
+            if self.streaming:
+                detector = self._novo_detector()
+                partes = [chunk.text async for chunk in self._astream(prompt, stop, run_manager, detector=detector, **kwargs)]
+                text = self._texto_final(partes, detector)
+            else:
+                logger.info(f"→ Enviando prompt ({len(prompt)} chars)")
+                response = await get_async_client().post(
+                    self._url,
+                    json=self._montar_payload(prompt, stop, stream=False),
+                    timeout=settings.LLM_TIMEOUT
+                )
+                response.raise_for_status()
+                text = response.json()["choices"][0]["text"]
+            return self._finalizar(text.strip())
+
+        except httpx.HTTPError as e:
+            raise self._erro_de_conexao(e)
         except Exception as e:
             logger.error(f"❌ Erro na chamada ao LLM: {e}")
             raise
 
     @property
     def _identifying_params(self) -> dict[str, Any]:
-        return {"endpoint": settings.LLM_BASE_URL}
\ No newline at end of file
+        return {"endpoint": settings.LLM_BASE_URL}
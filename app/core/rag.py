@@ -1,88 +1,263 @@
 # app/core/rag.py - Versão Definitiva com Prompt "Tolerância Zero" contra Alucinações
 
-from langchain.chains import ConversationalRetrievalChain
 from langchain.prompts import PromptTemplate
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from app.utils.logger import logger
 from app.core.config import settings
 from app.core.embeddings import LlamaEmbeddings
-from app.core.llm import LlamaServerLLM
+from app.core.embedding_cache import CachedEmbeddings, EmbeddingDiskCache
+from app.core.llm import STOP_TOKENS_PADRAO, LlamaServerLLM
+from app.core.ingestion import executar_ingestao
+from app.core.chunk_store import NOME_FICHEIRO
+from app.core.context_packing import ContadorTokens, ContextPacker
+from app.core.conversational_chain import FastConversationalRetrievalChain
+from app.core.response_cache import cache_recuperacao
+from app.core.retrieval import HybridRetriever
+from app.core.snapshots import SnapshotIndisponivel, caminho_snapshot, versao_atual
+from app.core.vector_index import (
+    abrir_para_escrita, carregar_vectorstore, criar_particoes, reconstruir_sem, salvar_vectorstore, suporta_remocao
+)
 import os
 import json
+import hashlib
 
-# As funções auxiliares permanecem as mesmas
-def _gerar_titulo_para_documento(texto_documento: str, llm: LlamaServerLLM) -> str:
-    prompt_template = """<|start_header_id|>system<|end_header_id|>
-Você é um especialista em catalogação. Sua única tarefa é ler o texto e gerar um título curto (3 a 7 palavras) que resuma a área de conhecimento. Regras: Responda APENAS com o título. Exemplo: "Análise de Circuitos Elétricos"<|eot_id|><|start_header_id|>user<|end_header_id|>
-**Texto:**
-{texto}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"""
-    texto_limitado = texto_documento[:4096]
-    prompt = prompt_template.format(texto=texto_limitado)
-    try:
-        titulo = llm._call(prompt).strip().replace('"', '').replace("Título:", "").strip()
-        return titulo if len(titulo) > 8 else "Tópico Geral"
-    except Exception: return "Tópico não identificado"
+MANIFESTO_VERSAO = 2
 
 def _carregar_manifesto(path):
+    """Lê o manifesto: {ficheiro: {titulo, sha256, mtime, tamanho, ids}}.
+
+    Manifestos antigos ({ficheiro: titulo}) são devolvidos com entradas sem hash nem ids,
+    que `_migrar_manifesto` completa a partir do índice carregado.
+    """
     manifest_path = os.path.join(path, "manifest.json")
     if os.path.exists(manifest_path):
         with open(manifest_path, "r", encoding="utf-8") as f:
-            try: return json.load(f)
+            try: dados = json.load(f)
             except json.JSONDecodeError: return {}
+        if isinstance(dados, dict) and "ficheiros" in dados:
+            return dados["ficheiros"]
+        return {ficheiro: {"titulo": titulo} for ficheiro, titulo in dados.items()}
     return {}
 
 def _salvar_manifesto(path, manifest_data):
     manifest_path = os.path.join(path, "manifest.json")
-    with open(manifest_path, "w", encoding="utf-8") as f:
-        json.dump(manifest_data, f, indent=4, ensure_ascii=False)
-
-def _processar_novos_pdfs(pdf_path, files_to_process, llm):
-    chunks, novos_titulos = [], {}
-    splitter = RecursiveCharacterTextSplitter(chunk_size=settings.CHUNK_SIZE, chunk_overlap=settings.CHUNK_OVERLAP)
-    for file in files_to_process:
-        try:
-            loader = PyPDFLoader(os.path.join(pdf_path, file))
-            docs = loader.load()
-            texto_para_titulo = " ".join([doc.page_content for doc in docs[:3]])
-            titulo_gerado = _gerar_titulo_para_documento(texto_para_titulo, llm)
-            novos_titulos[file] = titulo_gerado
-            chunks.extend(splitter.split_documents(docs))
-        except Exception as e: logger.error(f"✗ Erro ao processar {file}: {e}")
-    return chunks, novos_titulos
+    temporario = manifest_path + ".tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump({"versao": MANIFESTO_VERSAO, "ficheiros": manifest_data}, f, indent=4, ensure_ascii=False)
+    os.replace(temporario, manifest_path)
+
+def carregar_areas_conhecimento(path=None):
+    """Devolve os títulos (áreas de conhecimento) registados no manifesto."""
+    manifesto = _carregar_manifesto(path or settings.vectorstore_path)
+    return sorted(set(entrada["titulo"] for entrada in manifesto.values() if entrada.get("titulo")))
+
+def carregar_particoes(vectorstore):
+    """Partições do índice por área de conhecimento, a partir dos ids de cada ficheiro no manifesto.
+
+    O manifesto lido é o que está junto do chunk store do vectorstore: num snapshot, é o
+    da mesma versão do índice. Ficheiros com o mesmo título ficam na mesma área.
+    """
+    caminho = getattr(vectorstore.docstore, "caminho", None)
+    if not caminho:
+        return {}
+    ids_por_area = {}
+    for entrada in _carregar_manifesto(os.path.dirname(caminho)).values():
+        if entrada.get("titulo") and entrada.get("ids"):
+            ids_por_area.setdefault(entrada["titulo"], []).extend(entrada["ids"])
+    particoes = criar_particoes(vectorstore, ids_por_area)
+    logger.info(f"🗂️ {len(particoes)} áreas de conhecimento particionadas no índice")
+    return particoes
+
+def _hash_ficheiro(caminho):
+    sha = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(bloco)
+    return sha.hexdigest()
+
+def _assinatura_ficheiro(caminho, entrada_anterior=None):
+    """Devolve {sha256, mtime, tamanho}; só relê o conteúdo se o mtime ou o tamanho mudaram."""
+    stat = os.stat(caminho)
+    assinatura = {"mtime": stat.st_mtime, "tamanho": stat.st_size}
+    if (entrada_anterior and entrada_anterior.get("sha256")
+            and entrada_anterior.get("mtime") == stat.st_mtime
+            and entrada_anterior.get("tamanho") == stat.st_size):
+        assinatura["sha256"] = entrada_anterior["sha256"]
+    else:
+        assinatura["sha256"] = _hash_ficheiro(caminho)
+    return assinatura
+
+def _migrar_manifesto(manifesto, vectorstore, pdf_path):
+    """Completa entradas de manifestos antigos com os ids dos vetores e a assinatura atual."""
+    pendentes = {f for f, entrada in manifesto.items() if "ids" not in entrada}
+    if not pendentes: return False
+    ids_por_ficheiro = {f: [] for f in pendentes}
+    for doc_id, metadata in vectorstore.docstore.iterar_metadados():
+        ficheiro = os.path.basename(metadata.get("source", ""))
+        if ficheiro in ids_por_ficheiro:
+            ids_por_ficheiro[ficheiro].append(doc_id)
+    for ficheiro in pendentes:
+        entrada = manifesto[ficheiro]
+        entrada["ids"] = ids_por_ficheiro[ficheiro]
+        caminho = os.path.join(pdf_path, ficheiro)
+        if os.path.exists(caminho):
+            entrada.update(_assinatura_ficheiro(caminho))
+    logger.info(f"🔁 Manifesto migrado para o formato v{MANIFESTO_VERSAO} ({len(pendentes)} ficheiros)")
+    return True
+
+_cliente_embeddings = None
+
+def _criar_cliente_embeddings():
+    """Cliente de embeddings partilhado: as reindexações reaproveitam a cache e a LRU de consultas."""
+    global _cliente_embeddings
+    if _cliente_embeddings is not None:
+        return _cliente_embeddings
+    cliente = LlamaEmbeddings(api_url=settings.EMBEDDING_API_URL)
+    if settings.EMBEDDING_CACHE_ENABLED:
+        modelo_id = settings.EMBEDDING_MODEL_ID or str(settings.EMBEDDING_API_URL)
+        cache = EmbeddingDiskCache(settings.embedding_cache_path, modelo_id)
+        cliente = CachedEmbeddings(cliente, cache, lru_size=settings.EMBEDDING_QUERY_LRU_SIZE)
+    _cliente_embeddings = cliente
+    return cliente
+
+def _calcular_delta(pdf_path, pdfs_atuais, manifesto):
+    """Compara a pasta de PDFs com o manifesto: (a processar, removidos, tocados, assinaturas).
+
+    `tocados` são ficheiros com mtime novo mas o mesmo conteúdo; só o manifesto é atualizado.
+    """
+    assinaturas, a_processar, tocados = {}, [], []
+    for ficheiro in sorted(pdfs_atuais):
+        anterior = manifesto.get(ficheiro)
+        assinatura = _assinatura_ficheiro(os.path.join(pdf_path, ficheiro), anterior)
+        assinaturas[ficheiro] = assinatura
+        if anterior is None or anterior.get("sha256") != assinatura["sha256"]:
+            a_processar.append(ficheiro)
+        elif anterior.get("mtime") != assinatura["mtime"] or anterior.get("tamanho") != assinatura["tamanho"]:
+            anterior.update(assinatura)
+            tocados.append(ficheiro)
+    removidos = sorted(set(manifesto) - set(pdfs_atuais))
+    return a_processar, removidos, tocados, assinaturas
+
+def carregar_snapshot(versao=None):
+    """Carrega um snapshot publicado (o atual por omissão), mapeado só para leitura: (versão, vectorstore).
+
+    Todos os workers mapeiam os mesmos ficheiros, pelo que as páginas do índice ficam
+    uma só vez na page cache do sistema, por muitos workers que haja.
+    """
+    versao = versao or versao_atual()
+    if versao is None:
+        raise SnapshotIndisponivel("Ainda não foi publicado nenhum snapshot do índice.")
+    return versao, carregar_vectorstore(caminho_snapshot(versao), _criar_cliente_embeddings(), mmap=True)
+
+def _para_servir(vectorstore, vectorstore_path, embedding_client):
+    """Com `FAISS_MMAP`, troca a cópia em RAM usada na ingestão pelo ficheiro mapeado só para leitura."""
+    if not settings.FAISS_MMAP:
+        return vectorstore
+    return carregar_vectorstore(vectorstore_path, embedding_client, mmap=True)
 
 def criar_vectorstore():
-    if not os.listdir(settings.pdf_path): return None
-    embedding_client = LlamaEmbeddings(api_url=settings.EMBEDDING_API_URL)
+    # Mesmo com a pasta vazia, um índice existente passa pelo delta: os PDFs apagados saem dele
+    embedding_client = _criar_cliente_embeddings()
     llm_para_titulos = LlamaServerLLM()
     vectorstore_path = settings.vectorstore_path
     index_path = os.path.join(vectorstore_path, "index.faiss")
     pdfs_atuais = set(f for f in os.listdir(settings.pdf_path) if f.endswith(".pdf"))
     manifesto_atual = _carregar_manifesto(vectorstore_path)
-    pdfs_processados = set(manifesto_atual.keys())
     if os.path.exists(index_path):
-        vectorstore = FAISS.load_local(vectorstore_path, embeddings=embedding_client, allow_dangerous_deserialization=True)
-        novos_pdfs = pdfs_atuais - pdfs_processados
-        if novos_pdfs:
-            novos_chunks, novos_titulos = _processar_novos_pdfs(settings.pdf_path, list(novos_pdfs), llm_para_titulos)
-            if novos_chunks:
-                vectorstore.add_documents(novos_chunks)
-                vectorstore.save_local(vectorstore_path)
-                manifesto_atual.update(novos_titulos)
-                _salvar_manifesto(vectorstore_path, manifesto_atual)
-        return vectorstore
-    todos_os_chunks, todos_os_titulos = _processar_novos_pdfs(settings.pdf_path, list(pdfs_atuais), llm_para_titulos)
-    if not todos_os_chunks: return None
-    vectorstore = FAISS.from_documents(todos_os_chunks, embedding=embedding_client)
-    vectorstore.save_local(vectorstore_path)
-    _salvar_manifesto(vectorstore_path, todos_os_titulos)
-    return vectorstore
+        # A ingestão escreve no índice: carrega sempre uma cópia em RAM, nunca mapeada
+        vectorstore = carregar_vectorstore(vectorstore_path, embedding_client)
+        alterado = _migrar_manifesto(manifesto_atual, vectorstore, settings.pdf_path)
+        a_processar, removidos, tocados, assinaturas = _calcular_delta(settings.pdf_path, pdfs_atuais, manifesto_atual)
+
+        # Vetores de ficheiros apagados ou com conteúdo alterado deixam de ser válidos
+        obsoletos = removidos + [f for f in a_processar if f in manifesto_atual]
+        ids_indexados = set(vectorstore.index_to_docstore_id.values())
+        ids_obsoletos = [i for f in obsoletos for i in manifesto_atual[f].get("ids", []) if i in ids_indexados]
+        if ids_obsoletos or a_processar:
+            # Os chunks passam a ser escritos numa cópia, publicada só no fim
+            abrir_para_escrita(vectorstore, vectorstore_path)
+        if ids_obsoletos:
+            if suporta_remocao(vectorstore.index):
+                vectorstore.delete(ids_obsoletos)
+            else:
+                vectorstore = reconstruir_sem(vectorstore, ids_obsoletos, embedding_client)
+            logger.info(f"🗑️ {len(ids_obsoletos)} vetores removidos de {len(obsoletos)} ficheiros obsoletos")
+        for ficheiro in removidos:
+            del manifesto_atual[ficheiro]
+
+        if a_processar:
+            logger.info(f"📄 {len(a_processar)} PDFs novos ou alterados a indexar")
+            vectorstore, novas_entradas = executar_ingestao(
+                settings.pdf_path, a_processar, assinaturas, llm_para_titulos, embedding_client, vectorstore
+            )
+            for ficheiro in a_processar:
+                manifesto_atual.pop(ficheiro, None)
+            manifesto_atual.update(novas_entradas)
+
+        if vectorstore is not None and vectorstore.index.ntotal == 0:
+            vectorstore.docstore.descartar()
+            vectorstore = None
+        if vectorstore is None:
+            # Todos os PDFs foram apagados: não resta índice para servir
+            for nome in ("index.faiss", NOME_FICHEIRO):
+                os.remove(os.path.join(vectorstore_path, nome))
+            _salvar_manifesto(vectorstore_path, manifesto_atual)
+            return None
+        if ids_obsoletos or a_processar:
+            salvar_vectorstore(vectorstore, vectorstore_path)
+        if alterado or removidos or a_processar or tocados:
+            _salvar_manifesto(vectorstore_path, manifesto_atual)
+        return _para_servir(vectorstore, vectorstore_path, embedding_client)
+    _, _, _, assinaturas = _calcular_delta(settings.pdf_path, pdfs_atuais, {})
+    vectorstore, todas_as_entradas = executar_ingestao(
+        settings.pdf_path, sorted(pdfs_atuais), assinaturas, llm_para_titulos, embedding_client
+    )
+    if vectorstore is None: return None
+    salvar_vectorstore(vectorstore, vectorstore_path)
+    _salvar_manifesto(vectorstore_path, todas_as_entradas)
+    return _para_servir(vectorstore, vectorstore_path, embedding_client)
+
+def _criar_retriever(vectorstore):
+    # Com a montagem do contexto, recuperam-se mais candidatos: o orçamento de tokens decide quantos entram
+    k = settings.CONTEXT_CANDIDATES if settings.CONTEXT_PACKING else settings.RETRIEVAL_K
+    if not settings.RETRIEVAL_HYBRID:
+        return vectorstore.as_retriever(search_kwargs={"k": k, "fetch_k": 10})
+    return HybridRetriever(
+        vectorstore=vectorstore,
+        k=k,
+        fetch_k=settings.RETRIEVAL_FETCH_K,
+        rrf_k=settings.RETRIEVAL_RRF_K,
+        bm25_k1=settings.BM25_K1,
+        bm25_b=settings.BM25_B,
+        cache=cache_recuperacao,
+        particoes=carregar_particoes(vectorstore),
+        area_min_candidatos=settings.AREA_MIN_CANDIDATES,
+    )
+
+_contador_tokens = ContadorTokens(str(settings.LLM_TOKENIZE_URL))
+
+def _criar_context_packer(vectorstore):
+    if not settings.CONTEXT_PACKING:
+        return None
+    return ContextPacker(
+        vectorstore,
+        _contador_tokens,
+        orcamento_tokens=settings.CONTEXT_TOKEN_BUDGET,
+        lambda_mult=settings.CONTEXT_MMR_LAMBDA,
+        sobreposicao_max=2 * settings.CHUNK_OVERLAP,
+    )
 
 def criar_rag_chain(vectorstore):
-    llm = LlamaServerLLM()
+    # O LLM da resposta final emite tokens à medida que chegam; a reescrita da
+    # pergunta usa uma instância sem streaming (para não vazar tokens para o cliente),
+    # limitada a uma linha curta e determinística.
+    llm = LlamaServerLLM(streaming=True, fixar_slot=True, detetar_repeticao=True)
+    llm_condensacao = LlamaServerLLM(
+        max_tokens=settings.CONDENSE_MAX_TOKENS, temperature=0, stop_tokens=STOP_TOKENS_PADRAO + ["\n"]
+    )
     
     # --- PROMPT DEFINITIVO "TOLERÂNCIA ZERO" ---
+    # As regras (fixas) vêm antes do contexto e da pergunta: com `cache_prompt`, o llama.cpp
+    # reaproveita a cache KV deste prefixo e só processa o que muda em cada pedido.
     qa_template = """<|start_header_id|>system<|end_header_id|>
 
 Você é o UCDB-IA, um assistente académico factual. A sua única função é responder à pergunta do utilizador baseando-se **EXCLUSIVAMENTE** nas informações encontradas na secção "Contexto Fornecido".
@@ -112,12 +287,17 @@ Pergunta de Seguimento: {question}
 Pergunta Autónoma:"""
     CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(condense_question_template)
 
-    chain = ConversationalRetrievalChain.from_llm(
+    chain = FastConversationalRetrievalChain.from_llm(
         llm=llm,
-        retriever=vectorstore.as_retriever(search_kwargs={"k": settings.RETRIEVAL_K, "fetch_k": 10}),
+        condense_question_llm=llm_condensacao,
+        retriever=_criar_retriever(vectorstore),
         condense_question_prompt=CONDENSE_QUESTION_PROMPT,
         combine_docs_chain_kwargs={"prompt": QA_PROMPT},
-        return_source_documents=True
+        return_source_documents=True,
+        skip_heuristic=settings.CONDENSE_SKIP_HEURISTIC,
+        parallel_retrieval=settings.CONDENSE_PARALLEL_RETRIEVAL,
+        rrf_k=settings.RETRIEVAL_RRF_K,
+        context_packer=_criar_context_packer(vectorstore),
     )
     
     return chain
\ No newline at end of file
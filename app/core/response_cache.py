@@ -0,0 +1,95 @@
+# app/core/response_cache.py - Caches de recuperação e de respostas para perguntas repetidas
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from app.core.config import settings
+from app.utils.metrics import MetricaCalculada
+
+class TTLCache:
+    """LRU com tempo de vida por entrada e contadores de acertos/falhas."""
+
+    def __init__(self, tamanho: int, ttl: float):
+        self.tamanho = tamanho
+        self.ttl = ttl
+        self._dados: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, chave: Hashable) -> Optional[Any]:
+        with self._lock:
+            entrada = self._dados.get(chave)
+            if entrada is not None and entrada[0] < time.monotonic():
+                del self._dados[chave]
+                entrada = None
+            if entrada is None:
+                self.falhas += 1
+                return None
+            self._dados.move_to_end(chave)
+            self.acertos += 1
+            return entrada[1]
+
+    def contem(self, chave: Hashable) -> bool:
+        """Se há uma entrada válida para `chave`, sem contar acerto nem falha."""
+        with self._lock:
+            entrada = self._dados.get(chave)
+            return entrada is not None and entrada[0] >= time.monotonic()
+
+    def guardar(self, chave: Hashable, valor: Any) -> None:
+        if self.tamanho <= 0:
+            return
+        with self._lock:
+            self._dados[chave] = (time.monotonic() + self.ttl, valor)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.tamanho:
+                self._dados.popitem(last=False)
+
+    def limpar(self) -> None:
+        with self._lock:
+            self._dados.clear()
+
+    def estatisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.acertos + self.falhas
+            return {
+                "entradas": len(self._dados),
+                "acertos": self.acertos,
+                "falhas": self.falhas,
+                "taxa_acerto": round(self.acertos / total, 3) if total else None,
+            }
+
+def normalizar_pergunta(texto: str) -> str:
+    """Minúsculas, sem acentos, espaços colapsados e sem pontuação nas pontas."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", texto).strip(" ?!.,;:")
+
+def chave_prompt(versao_indice: str, areas: Iterable[str], pergunta: str) -> str:
+    """Identifica o prompt final: com o índice fixo, as áreas e a pergunta normalizada
+    determinam os chunks recuperados e, com eles, o prompt (em qualquer retriever)."""
+    conteudo = "\x00".join([versao_indice, ",".join(sorted(set(areas))), pergunta])
+    return hashlib.sha256(conteudo.encode("utf-8")).hexdigest()
+
+# Nível 1: (versão do índice, pergunta normalizada) -> ids dos chunks recuperados
+cache_recuperacao = TTLCache(settings.RETRIEVAL_CACHE_SIZE, settings.RETRIEVAL_CACHE_TTL)
+# Nível 2: hash do prompt -> resposta final limpa e fontes, para repetir via SSE
+cache_respostas = TTLCache(settings.ANSWER_CACHE_SIZE, settings.ANSWER_CACHE_TTL)
+
+def limpar_caches() -> None:
+    cache_recuperacao.limpar()
+    cache_respostas.limpar()
+
+def estatisticas_caches() -> Dict[str, Any]:
+    return {"recuperacao": cache_recuperacao.estatisticas(), "respostas": cache_respostas.estatisticas()}
+
+def _contagens(atributo: str) -> Dict[Tuple[str, ...], float]:
+    return {(nome,): getattr(cache, atributo) for nome, cache in (("recuperacao", cache_recuperacao), ("respostas", cache_respostas))}
+
+MetricaCalculada("ucdb_cache_hits_total", "Acertos nas caches de recuperação e de respostas.", "counter",
+                 lambda: _contagens("acertos"), ("cache",))
+MetricaCalculada("ucdb_cache_misses_total", "Falhas nas caches de recuperação e de respostas.", "counter",
+                 lambda: _contagens("falhas"), ("cache",))
@@ -0,0 +1,199 @@
+# app/core/retrieval.py - Recuperação híbrida (vetorial + BM25) com reciprocal rank fusion
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from collections import OrderedDict
+from contextvars import ContextVar
+from pydantic import ConfigDict, PrivateAttr
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import threading
+import time
+from app.utils.logger import logger
+from app.core.response_cache import TTLCache, normalizar_pergunta
+from app.core.vector_index import ParticaoArea
+from app.utils.metrics import recuperacoes_por_area, registar_etapa
+
+# Uniões de várias áreas guardadas por retriever (cada combinação cria um seletor FAISS novo)
+_MAX_UNIOES = 64
+
+# Áreas de conhecimento a que o pedido atual restringe a recuperação (vazio: índice inteiro)
+_areas_atuais: ContextVar[Tuple[str, ...]] = ContextVar("areas_recuperacao", default=())
+
+def definir_areas(areas: Optional[Iterable[str]]) -> None:
+    """Restringe as recuperações seguintes (neste contexto) às áreas de conhecimento dadas."""
+    _areas_atuais.set(tuple(sorted(set(areas or ()))))
+
+def fundir_rrf(listas: List[List[str]], k: int, rrf_k: int = 60) -> List[str]:
+    """Reciprocal rank fusion: ordena os ids pela soma de 1 / (`rrf_k` + posição) nas listas."""
+    pontuacoes: Dict[str, float] = {}
+    for ids in listas:
+        for posicao, doc_id in enumerate(ids):
+            pontuacoes[doc_id] = pontuacoes.get(doc_id, 0.0) + 1.0 / (rrf_k + posicao + 1)
+    return sorted(pontuacoes, key=pontuacoes.get, reverse=True)[:k]
+
+class HybridRetriever(BaseRetriever):
+    """Combina a busca densa do FAISS com a busca lexical BM25 do chunk store.
+
+    Cada via devolve `fetch_k` candidatos; a ordem final é dada por reciprocal rank
+    fusion (soma de 1 / (`rrf_k` + posição) em cada lista). Códigos de disciplina,
+    símbolos de fórmulas e nomes próprios, que a busca densa falha, chegam pela via
+    lexical. A duração de cada etapa (embedding da pergunta, FAISS, BM25, fusão) vai
+    para as métricas e para o log em DEBUG.
+
+    Com `cache`, os ids recuperados ficam guardados por (versão do índice, áreas,
+    pergunta normalizada): uma pergunta repetida só lê os chunks, sem embedding nem buscas.
+
+    `particoes` ({área: ParticaoArea}) permite restringir as duas vias às áreas de
+    conhecimento pedidas com `definir_areas`. Áreas desconhecidas, ou com menos de
+    `area_min_candidatos` candidatos para a pergunta, recorrem à busca em todo o índice.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: Any
+    k: int = 7
+    fetch_k: int = 20
+    rrf_k: int = 60
+    bm25_k1: float = 1.2
+    bm25_b: float = 0.75
+    cache: Optional[TTLCache] = None
+    particoes: Dict[str, Any] = {}
+    area_min_candidatos: int = 3
+    _unioes: "OrderedDict[Tuple, ParticaoArea]" = PrivateAttr(default_factory=OrderedDict)
+    _lock_unioes: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _chave_cache(self, query: str):
+        versao = getattr(self.vectorstore.docstore, "versao", None)
+        if self.cache is None or versao is None:
+            return None
+        return versao, _areas_atuais.get(), normalizar_pergunta(query)
+
+    def _particao(self) -> Optional[ParticaoArea]:
+        """Partição das áreas pedidas neste contexto, ou None para buscar em todo o índice."""
+        areas = _areas_atuais.get()
+        if not areas:
+            return None
+        conhecidas = [self.particoes[area] for area in areas if area in self.particoes]
+        if not conhecidas:
+            logger.debug(f"🗂️ Áreas sem chunks no índice {list(areas)}: busca global")
+            recuperacoes_por_area.inc(outcome="global")
+            return None
+        if len(conhecidas) == 1:
+            return conhecidas[0]
+        chave = (getattr(self.vectorstore.docstore, "versao", None), frozenset(p.areas[0] for p in conhecidas))
+        with self._lock_unioes:
+            uniao = self._unioes.get(chave)
+            if uniao is not None:
+                self._unioes.move_to_end(chave)
+                return uniao
+        uniao = ParticaoArea.unir(conhecidas, self.vectorstore.index_to_docstore_id, self.vectorstore.index)
+        with self._lock_unioes:
+            self._unioes[chave] = uniao
+            while len(self._unioes) > _MAX_UNIOES:
+                self._unioes.popitem(last=False)
+        return uniao
+
+    def _insuficiente(self, particao: Optional[ParticaoArea], densos, lexicais) -> bool:
+        """Regista o desfecho da busca por área; True se deve ser repetida no índice inteiro."""
+        if particao is None:
+            return False
+        candidatos = len({doc.id for doc, _ in densos} | {doc_id for doc_id, _ in lexicais})
+        if candidatos >= self.area_min_candidatos:
+            recuperacoes_por_area.inc(outcome="area")
+            return False
+        logger.debug(f"🗂️ Só {candidatos} candidatos nas áreas {list(particao.areas)}: busca global")
+        recuperacoes_por_area.inc(outcome="global")
+        return True
+
+    def _da_cache(self, chave) -> Optional[List[Document]]:
+        ids = self.cache.obter(chave) if chave is not None else None
+        if ids is None:
+            return None
+        logger.debug(f"🔎 Recuperação em cache ({len(ids)} chunks)")
+        return self.vectorstore.docstore.obter(ids)
+
+    def _para_cache(self, chave, documentos: List[Document]) -> None:
+        if chave is not None:
+            self.cache.guardar(chave, [doc.id for doc in documentos])
+
+    def _lexical(self, query: str, particao: Optional[ParticaoArea] = None) -> Tuple[List[Tuple[str, float]], float]:
+        inicio = time.perf_counter()
+        resultados = self.vectorstore.docstore.buscar_lexical(
+            query, self.fetch_k, k1=self.bm25_k1, b=self.bm25_b, permitidos=particao.ids if particao is not None else None
+        )
+        segundos = time.perf_counter() - inicio
+        registar_etapa("bm25", segundos)
+        return resultados, segundos * 1000
+
+    def _buscar_vetor(self, vetor: List[float], particao: Optional[ParticaoArea] = None) -> Tuple[List[Tuple[Document, float]], float]:
+        inicio = time.perf_counter()
+        if particao is not None:
+            densos = particao.buscar(self.vectorstore, vetor, self.fetch_k)
+        else:
+            densos = self.vectorstore.similarity_search_with_score_by_vector(vetor, k=self.fetch_k)
+        segundos = time.perf_counter() - inicio
+        registar_etapa("faiss_search", segundos)
+        return densos, segundos * 1000
+
+    def _fundir(self, densos: List[Tuple[Document, float]], lexicais: List[Tuple[str, float]]) -> List[Document]:
+        documentos: Dict[str, Document] = {doc.id: doc for doc, _ in densos}
+        escolhidos = fundir_rrf(
+            [[doc.id for doc, _ in densos], [doc_id for doc_id, _ in lexicais]], self.k, self.rrf_k
+        )
+        resultado = []
+        for doc_id in escolhidos:
+            doc = documentos.get(doc_id) or self.vectorstore.docstore.search(doc_id)
+            if isinstance(doc, Document):
+                resultado.append(doc)
+        return resultado
+
+    def _concluir(self, chave, densos, lexicais, ms_embedding: float, ms_faiss: float, ms_lexical: float) -> List[Document]:
+        inicio = time.perf_counter()
+        documentos = self._fundir(densos, lexicais)
+        segundos_fusao = time.perf_counter() - inicio
+        registar_etapa("fusion", segundos_fusao)
+        logger.debug(
+            f"🔎 Recuperação híbrida: embedding {ms_embedding:.1f} ms, FAISS {ms_faiss:.1f} ms ({len(densos)}), "
+            f"BM25 {ms_lexical:.2f} ms ({len(lexicais)}), fusão {segundos_fusao * 1000:.2f} ms"
+        )
+        self._para_cache(chave, documentos)
+        return documentos
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        chave = self._chave_cache(query)
+        if (documentos := self._da_cache(chave)) is not None:
+            return documentos
+        inicio = time.perf_counter()
+        vetor = self.vectorstore.embeddings.embed_query(query)
+        segundos_embedding = time.perf_counter() - inicio
+        registar_etapa("query_embedding", segundos_embedding)
+        particao = self._particao()
+        densos, ms_faiss = self._buscar_vetor(vetor, particao)
+        lexicais, ms_lexical = self._lexical(query, particao)
+        if self._insuficiente(particao, densos, lexicais):
+            densos, ms_faiss = self._buscar_vetor(vetor)
+            lexicais, ms_lexical = self._lexical(query)
+        return self._concluir(chave, densos, lexicais, segundos_embedding * 1000, ms_faiss, ms_lexical)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        chave = self._chave_cache(query)
+        if (documentos := await asyncio.to_thread(self._da_cache, chave)) is not None:
+            return documentos
+        particao = self._particao()
+        (densos, vetor, ms_embedding, ms_faiss), (lexicais, ms_lexical) = await asyncio.gather(
+            self._adenso(query, particao), asyncio.to_thread(self._lexical, query, particao)
+        )
+        if self._insuficiente(particao, densos, lexicais):
+            (densos, ms_faiss), (lexicais, ms_lexical) = await asyncio.gather(
+                asyncio.to_thread(self._buscar_vetor, vetor), asyncio.to_thread(self._lexical, query)
+            )
+        return self._concluir(chave, densos, lexicais, ms_embedding, ms_faiss, ms_lexical)
+
+    async def _adenso(self, query: str, particao: Optional[ParticaoArea] = None):
+        inicio = time.perf_counter()
+        vetor = await self.vectorstore.embeddings.aembed_query(query)
+        segundos_embedding = time.perf_counter() - inicio
+        registar_etapa("query_embedding", segundos_embedding)
+        densos, ms_faiss = await asyncio.to_thread(self._buscar_vetor, vetor, particao)
+        return densos, vetor, segundos_embedding * 1000, ms_faiss
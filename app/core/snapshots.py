@@ -0,0 +1,188 @@
+# app/core/snapshots.py - Snapshots versionados do índice e eleição do worker que faz a ingestão
+import fcntl
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+from app.core.chunk_store import NOME_FICHEIRO
+from app.core.config import settings
+from app.utils.logger import logger
+
+# Ficheiros que formam uma versão do índice; todos são substituídos com `os.replace` ao gravar
+FICHEIROS_SNAPSHOT = ("index.faiss", NOME_FICHEIRO, "manifest.json")
+_PONTEIRO = "ATUAL"
+# Pedido de reindexação deixado por um worker que não é o líder (ex.: /reindex)
+_PEDIDO_REINDEXACAO = "REINDEXAR"
+
+class SnapshotIndisponivel(Exception):
+    """Ainda nenhum worker (ou o comando de ingestão) publicou um snapshot do índice."""
+
+class BloqueioIngestao:
+    """Lock de ficheiro (`flock`) que elege o único processo autorizado a escrever o índice.
+
+    O lock é do processo: se o líder morrer, o sistema operativo liberta-o e outro
+    worker pode assumir a ingestão na próxima tentativa.
+    """
+
+    def __init__(self, caminho: str):
+        self.caminho = caminho
+        self._fd: Optional[int] = None
+
+    @property
+    def detido(self) -> bool:
+        return self._fd is not None
+
+    def adquirir(self, bloquear: bool = False) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.caminho, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if bloquear else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def libertar(self) -> None:
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+def _dir_snapshots(path: str) -> str:
+    caminho = os.path.join(path, "snapshots")
+    os.makedirs(caminho, exist_ok=True)
+    return caminho
+
+def versao_atual(path: Optional[str] = None) -> Optional[str]:
+    """Nome do snapshot publicado mais recente (o conteúdo do ponteiro `snapshots/ATUAL`)."""
+    try:
+        with open(os.path.join(_dir_snapshots(path or settings.vectorstore_path), _PONTEIRO), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def caminho_snapshot(versao: str, path: Optional[str] = None) -> str:
+    return os.path.join(_dir_snapshots(path or settings.vectorstore_path), versao)
+
+def _mesmo_ficheiro(a: str, b: str) -> bool:
+    try:
+        return os.path.samefile(a, b)
+    except FileNotFoundError:
+        return False
+
+def publicar_snapshot(path: Optional[str] = None) -> Optional[str]:
+    """Fixa o estado atual de `embeddings/` numa versão nova e aponta `ATUAL` para ela.
+
+    Os ficheiros do índice são sempre substituídos (nunca alterados no lugar), pelo que
+    um snapshot é só um diretório de hard links para os inodes atuais: não copia dados
+    e não muda depois de publicado. O diretório é montado à parte e renomeado, e o
+    ponteiro escrito com `os.replace`: os leitores nunca veem um snapshot incompleto.
+    Devolve a versão publicada, a atual se nada mudou, ou None sem índice gravado.
+    """
+    path = path or settings.vectorstore_path
+    origens = [os.path.join(path, nome) for nome in FICHEIROS_SNAPSHOT]
+    if not all(os.path.exists(origem) for origem in origens):
+        return None
+    atual = versao_atual(path)
+    if atual and all(_mesmo_ficheiro(o, os.path.join(caminho_snapshot(atual, path), n)) for o, n in zip(origens, FICHEIROS_SNAPSHOT)):
+        return atual
+
+    # Prefixo com a hora: a ordem alfabética é a ordem de publicação
+    versao = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    destino = caminho_snapshot(versao, path)
+    temporario = destino + ".tmp"
+    shutil.rmtree(temporario, ignore_errors=True)
+    os.makedirs(temporario)
+    for origem, nome in zip(origens, FICHEIROS_SNAPSHOT):
+        try:
+            os.link(origem, os.path.join(temporario, nome))
+        except OSError:
+            shutil.copyfile(origem, os.path.join(temporario, nome))  # Sistema de ficheiros sem hard links
+    os.rename(temporario, destino)
+
+    ponteiro = os.path.join(_dir_snapshots(path), _PONTEIRO)
+    with open(ponteiro + ".tmp", "w", encoding="utf-8") as f:
+        f.write(versao)
+    os.replace(ponteiro + ".tmp", ponteiro)
+    logger.info(f"📸 Snapshot do índice publicado: {versao}")
+    _limpar_antigos(path, manter=settings.SNAPSHOT_KEEP)
+    return versao
+
+def _limpar_antigos(path: str, manter: int) -> None:
+    """Apaga os snapshots mais antigos além dos `manter` mais recentes.
+
+    Os workers que ainda tenham um deles mapeado continuam a lê-lo: em POSIX o inode
+    só é libertado quando o último processo o fecha.
+    """
+    pasta = _dir_snapshots(path)
+    atual = versao_atual(path)
+    versoes = sorted(nome for nome in os.listdir(pasta) if os.path.isdir(os.path.join(pasta, nome)) and not nome.endswith(".tmp"))
+    for versao in versoes[:-max(manter, 1)]:
+        if versao != atual:
+            shutil.rmtree(os.path.join(pasta, versao), ignore_errors=True)
+
+def pedir_reindexacao(path: Optional[str] = None) -> None:
+    """Deixa um pedido de reindexação para o líder, que o vê na próxima verificação."""
+    with open(os.path.join(_dir_snapshots(path or settings.vectorstore_path), _PEDIDO_REINDEXACAO), "w"):
+        pass
+
+def _retirar_pedido_reindexacao(path: str) -> bool:
+    try:
+        os.remove(os.path.join(_dir_snapshots(path), _PEDIDO_REINDEXACAO))
+        return True
+    except FileNotFoundError:
+        return False
+
+class VigiaSnapshots:
+    """Thread que segue o ponteiro `ATUAL` e entrega cada versão nova a `ao_mudar`.
+
+    Com `ao_liderar` (modo "multi"), tenta também obter o lock de ingestão a cada
+    verificação: se o líder terminar, um dos restantes workers assume a ingestão.
+    O líder atende ainda os pedidos de reindexação deixados pelos outros workers.
+    """
+
+    def __init__(self, versao: Optional[str], ao_mudar: Callable[[str], None],
+                 ao_liderar: Optional[Callable[[], None]] = None, ao_pedir_reindexacao: Optional[Callable[[], None]] = None,
+                 intervalo: Optional[float] = None):
+        self.versao = versao
+        self.ao_mudar = ao_mudar
+        self.ao_liderar = ao_liderar
+        self.ao_pedir_reindexacao = ao_pedir_reindexacao
+        self.intervalo = intervalo or settings.SNAPSHOT_POLL_INTERVAL
+        self.path = settings.vectorstore_path
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def iniciar(self) -> None:
+        if self._thread is not None: return
+        self._thread = threading.Thread(target=self._ciclo, name="vigia-snapshots", daemon=True)
+        self._thread.start()
+
+    def parar(self) -> None:
+        self._parar.set()
+
+    def _ciclo(self) -> None:
+        while not self._parar.wait(self.intervalo):
+            try:
+                self._verificar()
+            except Exception as e:
+                logger.error(f"❌ Falha ao verificar snapshots do índice: {e}", exc_info=True)
+
+    def _verificar(self) -> None:
+        if self.ao_liderar is not None and not bloqueio_ingestao.detido and bloqueio_ingestao.adquirir():
+            logger.warning(f"👑 Lock de ingestão livre: o worker {os.getpid()} assume a ingestão")
+            self.ao_liderar()
+        if bloqueio_ingestao.detido and self.ao_pedir_reindexacao is not None and _retirar_pedido_reindexacao(self.path):
+            self.ao_pedir_reindexacao()
+        versao = versao_atual(self.path)
+        if versao is not None and versao != self.versao:
+            self.ao_mudar(versao)
+            self.versao = versao
+
+bloqueio_ingestao = BloqueioIngestao(os.path.join(settings.vectorstore_path, "ingestao.lock"))
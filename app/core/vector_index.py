@@ -0,0 +1,213 @@
+# app/core/vector_index.py - Criação, treino e persistência do índice FAISS
+
+from langchain_community.vectorstores import FAISS
+from app.utils.logger import logger
+from app.core.config import settings
+from app.core.chunk_store import NOME_FICHEIRO, ChunkStore, migrar_indice_lexical, migrar_pickle
+import os
+import faiss
+import numpy as np
+
+def criar_indice(dim, fabrica=None):
+    """Cria um índice vazio a partir da string de fábrica (ex.: "Flat", "SQfp16", "HNSW32", "IVF1024,PQ32")."""
+    return faiss.index_factory(dim, fabrica or settings.FAISS_INDEX_FACTORY, faiss.METRIC_L2)
+
+def configurar_busca(index, nprobe=None, ef_search=None):
+    """Aplica `nprobe` (IVF) e `efSearch` (HNSW) quando o tipo de índice os suporta."""
+    parametros = faiss.ParameterSpace()
+    for nome, valor in (("nprobe", nprobe or settings.FAISS_NPROBE), ("efSearch", ef_search or settings.FAISS_EF_SEARCH)):
+        try:
+            parametros.set_index_parameter(index, nome, valor)
+        except RuntimeError:
+            pass  # Parâmetro não se aplica a este tipo de índice
+    return index
+
+def suporta_remocao(index):
+    """Índices de códigos planos (Flat, SQ, PQ) compactam as posições ao remover, como o LangChain espera.
+
+    IVF mantém os rótulos antigos e HNSW não remove; nesses casos o índice é reconstruído.
+    """
+    return isinstance(faiss.downcast_index(index), faiss.IndexFlatCodes)
+
+def novo_vectorstore(embedding_client, vetores_treino, docstore=None):
+    """Devolve um vectorstore vazio com o índice configurado, treinado se necessário.
+
+    Se não houver vetores suficientes para treinar (ex.: IVF com poucos documentos),
+    usa um índice Flat exato. Sem `docstore`, os chunks vão para uma cópia de escrita
+    vazia do chunk store.
+    """
+    vetores_treino = np.asarray(vetores_treino, dtype=np.float32)
+    dim = vetores_treino.shape[1]
+    index = criar_indice(dim)
+    if not index.is_trained:
+        if len(vetores_treino) > settings.FAISS_TRAIN_SIZE:
+            amostra = np.random.default_rng(0).choice(len(vetores_treino), settings.FAISS_TRAIN_SIZE, replace=False)
+            vetores_treino = vetores_treino[amostra]
+        try:
+            logger.info(f"🏋️ A treinar índice {settings.FAISS_INDEX_FACTORY} com {len(vetores_treino)} vetores")
+            index.train(vetores_treino)
+        except RuntimeError as e:
+            logger.warning(f"⚠️ Treino de {settings.FAISS_INDEX_FACTORY} falhou ({e}); a usar índice Flat")
+            index = criar_indice(dim, "Flat")
+    configurar_busca(index)
+    if docstore is None:
+        docstore = ChunkStore.para_escrita(settings.vectorstore_path, copiar=False)
+    return FAISS(embedding_client, index, docstore, {})
+
+def _abrir_chunk_store(path):
+    return ChunkStore(os.path.join(path, NOME_FICHEIRO), lru_size=settings.CHUNK_STORE_LRU_SIZE)
+
+def abrir_para_escrita(vectorstore, path):
+    """Troca o chunk store só de leitura por uma cópia gravável, antes de alterar o índice."""
+    vectorstore.docstore = ChunkStore.para_escrita(path)
+
+def salvar_vectorstore(vectorstore, path):
+    """Grava `index.faiss` e publica o chunk store de forma atómica (ficheiro temporário + rename).
+
+    Processos que tenham o índice anterior mapeado em memória continuam a ler o ficheiro
+    antigo. No fim, o vectorstore passa a ler do chunk store publicado, só para leitura.
+    """
+    os.makedirs(path, exist_ok=True)
+    caminho_indice = os.path.join(path, "index.faiss")
+    faiss.write_index(vectorstore.index, caminho_indice + ".tmp")
+    vectorstore.docstore.publicar(vectorstore.index_to_docstore_id)
+    os.replace(caminho_indice + ".tmp", caminho_indice)
+    vectorstore.docstore = _abrir_chunk_store(path)
+
+def _ler_indice(caminho, mmap):
+    if not mmap:
+        return faiss.read_index(caminho)
+    # IO_FLAG_MMAP mapeia as listas invertidas (IVF); IO_FLAG_MMAP_IFC, nas versões que o
+    # têm, mapeia também os códigos de índices Flat/SQ/PQ em vez de os copiar para a RAM
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    flags_ifc = flags | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    try:
+        return faiss.read_index(caminho, flags_ifc)
+    except RuntimeError:
+        return faiss.read_index(caminho, flags)
+
+def carregar_vectorstore(path, embedding_client, mmap=False):
+    """Carrega o índice gravado; com `mmap=True` o ficheiro é mapeado só para leitura.
+
+    Um índice mapeado não aceita escritas: a ingestão carrega sempre uma cópia em RAM.
+    Os chunks ficam no disco e só são lidos quando a busca os devolve; um `index.pkl`
+    antigo é migrado para o chunk store (com o índice BM25) na primeira carga.
+    """
+    migrar_pickle(path)
+    migrar_indice_lexical(path)
+    index = _ler_indice(os.path.join(path, "index.faiss"), mmap)
+    configurar_busca(index)
+    docstore = _abrir_chunk_store(path)
+    return FAISS(embedding_client, index, docstore, docstore.carregar_posicoes())
+
+def _vetores_guardados(index, posicoes):
+    """Vetores nas `posicoes` do índice (descodificados em SQ/PQ), ou None se o tipo não os reconstrói.
+
+    IVF só reconstrói com o mapa direto, criado aqui: é a cópia em RAM da ingestão.
+    """
+    posicoes = np.asarray(posicoes, dtype=np.int64)
+    try:
+        return index.reconstruct_batch(posicoes)
+    except RuntimeError:
+        pass
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()
+        return index.reconstruct_batch(posicoes)
+    except RuntimeError:
+        return None
+
+def reconstruir_sem(vectorstore, ids_a_remover, embedding_client):
+    """Reconstrói o índice sem os `ids_a_remover`, para tipos que não suportam remoção.
+
+    Os vetores restantes são lidos do próprio índice; só se o tipo não os reconstruir
+    é que os textos voltam a ser embebidos (sem re-embeber quando há cache de embeddings).
+    O chunk store (já aberto para escrita) é reaproveitado: só perde os chunks removidos.
+    """
+    remover = set(ids_a_remover)
+    restantes = [(posicao, doc_id) for posicao, doc_id in sorted(vectorstore.index_to_docstore_id.items())
+                 if doc_id not in remover]
+    ids = [doc_id for _, doc_id in restantes]
+    logger.info(f"🔧 A reconstruir índice {settings.FAISS_INDEX_FACTORY} com {len(ids)} vetores")
+    if not ids:
+        vectorstore.docstore.descartar()
+        return None
+    vectorstore.docstore.delete(list(remover))
+    vetores = _vetores_guardados(vectorstore.index, [posicao for posicao, _ in restantes])
+    if vetores is None:
+        if not settings.EMBEDDING_CACHE_ENABLED:
+            logger.warning(f"⚠️ O índice não reconstrói vetores e a cache de embeddings está desligada: "
+                           f"a re-embeber {len(ids)} chunks")
+        textos = [doc.page_content for doc in vectorstore.docstore.obter(ids)]
+        vetores = embedding_client.embed_documents(textos)
+    vetores = np.asarray(vetores, dtype=np.float32)
+    novo = novo_vectorstore(embedding_client, vetores, docstore=vectorstore.docstore)
+    novo.index.add(vetores)
+    novo.index_to_docstore_id = dict(enumerate(ids))
+    return novo
+
+def _parametros_seletor(index, seletor):
+    """SearchParameters com `seletor` para o tipo de índice, ou None se não aceitar filtro na busca."""
+    base = faiss.downcast_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=seletor, nprobe=base.nprobe)
+    if isinstance(base, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=seletor, efSearch=base.hnsw.efSearch)
+    if isinstance(base, faiss.IndexFlatCodes):
+        return faiss.SearchParameters(sel=seletor)
+    return None  # ex.: "OPQ16,IVF..." (pré-transformação) não passa os parâmetros ao índice interno
+
+class ParticaoArea:
+    """Chunks de uma ou mais áreas de conhecimento dentro do índice partilhado.
+
+    Não é um índice à parte: guarda os ids (filtro da busca BM25) e um `IDSelectorBatch`
+    das posições no FAISS, e a busca só calcula distâncias para os vetores selecionados.
+    Índices que não aceitam o seletor são pesquisados por inteiro, com uma margem de
+    candidatos, e filtrados depois.
+    """
+
+    def __init__(self, areas, posicoes, index_to_docstore_id, index):
+        self.areas = tuple(areas)
+        self.posicoes = np.unique(np.asarray(posicoes, dtype=np.int64))
+        self.ids = frozenset(index_to_docstore_id[int(p)] for p in self.posicoes)
+        self._seletor = faiss.IDSelectorBatch(len(self.posicoes), faiss.swig_ptr(self.posicoes))
+        self._parametros = _parametros_seletor(index, self._seletor)
+
+    def __len__(self):
+        return len(self.posicoes)
+
+    @classmethod
+    def unir(cls, particoes, index_to_docstore_id, index):
+        return cls([a for p in particoes for a in p.areas], np.concatenate([p.posicoes for p in particoes]),
+                   index_to_docstore_id, index)
+
+    def buscar(self, vectorstore, vetor, k):
+        """Os `k` (documento, distância) mais próximos de `vetor`, só entre os chunks da partição."""
+        consulta = np.asarray([vetor], dtype=np.float32)
+        if self._parametros is not None:
+            try:
+                distancias, posicoes = vectorstore.index.search(consulta, k, params=self._parametros)
+            except RuntimeError as e:
+                logger.warning(f"⚠️ O índice não aceita busca filtrada ({e}); a filtrar os resultados")
+                self._parametros = None
+        if self._parametros is None:
+            margem = min(vectorstore.index.ntotal, k * max(1, vectorstore.index.ntotal // max(len(self), 1)))
+            distancias, posicoes = vectorstore.index.search(consulta, margem)
+        resultados = []
+        for posicao, distancia in zip(posicoes[0], distancias[0]):
+            doc_id = vectorstore.index_to_docstore_id.get(int(posicao))  # -1: menos de `k` resultados
+            if doc_id in self.ids:
+                resultados.append((doc_id, float(distancia)))
+                if len(resultados) == k:
+                    break
+        documentos = vectorstore.docstore.obter([doc_id for doc_id, _ in resultados])
+        return list(zip(documentos, (distancia for _, distancia in resultados)))
+
+def criar_particoes(vectorstore, ids_por_area):
+    """{área: ParticaoArea} com as posições no índice dos chunks de cada área (ids do manifesto)."""
+    posicao_de = {doc_id: posicao for posicao, doc_id in vectorstore.index_to_docstore_id.items()}
+    particoes = {}
+    for area, ids in ids_por_area.items():
+        posicoes = [posicao_de[doc_id] for doc_id in ids if doc_id in posicao_de]
+        if posicoes:
+            particoes[area] = ParticaoArea([area], posicoes, vectorstore.index_to_docstore_id, vectorstore.index)
+    return particoes
@@ -0,0 +1,43 @@
+# app/core/warmup.py - Aquecimento antes de o /readyz declarar a instância pronta
+import asyncio
+import time
+from app.core.config import settings
+from app.core.llm import LlamaServerLLM
+from app.utils.logger import logger
+
+_TEXTO_AQUECIMENTO = "regulamento académico"
+
+async def _etapa(nome: str, corrotina) -> None:
+    """Corre uma etapa do aquecimento; uma falha é registada mas não impede o arranque."""
+    inicio = time.perf_counter()
+    try:
+        await asyncio.wait_for(corrotina, settings.STARTUP_WARMUP_TIMEOUT)
+        logger.debug(f"🔥 Aquecimento {nome}: {(time.perf_counter() - inicio) * 1000:.0f}ms")
+    except Exception as e:
+        logger.warning(f"⚠️ Aquecimento {nome} falhou ({type(e).__name__}): {e}")
+
+async def aquecer(vectorstore) -> None:
+    """Abre as ligações aos dois llama-server e lê as páginas do índice antes do primeiro pedido.
+
+    - embedding: uma pergunta pelo cliente assíncrono (o do /chat) abre a ligação do pool;
+    - índice: uma busca FAISS e uma BM25 trazem para a page cache o `index.faiss`
+      (sobretudo se mapeado, `FAISS_MMAP`) e as páginas do SQLite dos chunks;
+    - LLM: um pedido de um token abre a ligação ao `/completions`.
+    """
+    inicio = time.perf_counter()
+    vetor = []
+
+    async def embedding():
+        vetor.extend(await vectorstore.embeddings.aembed_query(_TEXTO_AQUECIMENTO))
+
+    def indice():
+        if vetor:
+            vectorstore.similarity_search_with_score_by_vector(vetor, k=settings.RETRIEVAL_K)
+        buscar_lexical = getattr(vectorstore.docstore, "buscar_lexical", None)
+        if buscar_lexical is not None:
+            buscar_lexical(_TEXTO_AQUECIMENTO, settings.RETRIEVAL_K)
+
+    await _etapa("embedding", embedding())
+    await _etapa("índice", asyncio.to_thread(indice))
+    await _etapa("LLM", LlamaServerLLM(max_tokens=1, temperature=0).ainvoke(_TEXTO_AQUECIMENTO))
+    logger.info(f"🔥 Aquecimento concluído em {time.perf_counter() - inicio:.1f}s")
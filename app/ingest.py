@@ -0,0 +1,37 @@
+# app/ingest.py - Ingestão fora do servidor: indexa a pasta de PDFs e publica um snapshot do índice
+#
+# Uso (na raiz do projeto):
+#   python -m app.ingest            # falha se outro processo (ex.: o worker líder) tiver o lock
+#   python -m app.ingest --esperar  # espera que o lock fique livre
+#
+# Pensado para WORKER_MODE=reader: os workers do uvicorn só servem e carregam cada
+# snapshot novo que este comando publica (ex.: num cron ou num job do orquestrador).
+
+import argparse
+import sys
+import time
+from app.core.rag import criar_vectorstore
+from app.core.snapshots import bloqueio_ingestao, publicar_snapshot
+from app.utils.logger import logger, setup_logging
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexa os PDFs e publica um snapshot do índice para os workers.")
+    parser.add_argument("--esperar", action="store_true", help="espera pelo lock de ingestão em vez de falhar")
+    args = parser.parse_args()
+    setup_logging()
+
+    if not bloqueio_ingestao.adquirir(bloquear=args.esperar):
+        logger.error(f"🔒 Outro processo está a fazer a ingestão (lock em {bloqueio_ingestao.caminho})")
+        sys.exit(1)
+    inicio = time.monotonic()
+    try:
+        if criar_vectorstore() is None:
+            logger.warning("⚠️ Nenhum documento RAG encontrado: nada a publicar.")
+            return
+        versao = publicar_snapshot()
+        logger.success(f"✅ Ingestão concluída em {time.monotonic() - inicio:.1f}s; snapshot atual: {versao}")
+    finally:
+        bloqueio_ingestao.libertar()
+
+if __name__ == "__main__":
+    main()
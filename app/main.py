@@ -1,18 +1,18 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles # Importar StaticFiles
-from starlette.middleware.sessions import SessionMiddleware
 from app.api.routes import router
+from app.api.middleware import RequestIdMiddleware
 from app.utils.logger import setup_logging, logger
 from app.core.config import settings # Importar settings para obter o caminho
+import asyncio
 import os # Importar os
 
 def create_app() -> FastAPI:
     setup_logging()
     app = FastAPI(title="UCDB Chat")
 
-    # Usar SECRET_KEY da configuração para o SessionMiddleware
-    app.add_middleware(SessionMiddleware, secret_key=settings.SECRET_KEY)
+    # O histórico do chat fica no servidor (app/core/history_store.py): o cookie session_id só o identifica
     app.add_middleware(
         CORSMiddleware,
         # Ajuste as origens permitidas conforme necessário para produção
@@ -20,7 +20,10 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Request-ID"],
     )
+    # Adicionado por último: é o mais externo e cobre também os pedidos recusados pelo CORS
+    app.add_middleware(RequestIdMiddleware)
 
     # Monta as rotas da API definidas em app/api/routes.py
     app.include_router(router)
@@ -37,19 +40,27 @@ def create_app() -> FastAPI:
     app.mount("/pdfs", StaticFiles(directory=pdf_dir), name="pdfs")
 
     @app.on_event("startup")
-    def startup():
+    async def startup():
         """Função executada no início da aplicação."""
         logger.info("🌐 UCDB Chat iniciado!")
-        # Tenta inicializar o RAG no startup para acelerar a primeira resposta
-        try:
-            from app.api.routes import _initialize_rag
-            _initialize_rag()
-        except Exception as e:
-            logger.warning(f"⚠️ Falha na pré-inicialização do RAG no startup: {e}")
+        # O índice carrega numa tarefa à parte: o uvicorn aceita ligações (e o /healthz responde)
+        # de imediato, e o /readyz só passa a 200 quando o RAG estiver pronto e aquecido.
+        # A tarefa arranca também a ingestão em segundo plano dos PDFs novos.
+        from app.api.routes import arrancar_rag
+        app.state.arranque = asyncio.create_task(arrancar_rag())
         # Tenta obter a porta das settings, caso contrário usa 8000
         # Assume que uvicorn será executado externamente ou via __main__
         logger.info(f"💡 Servidor Uvicorn provavelmente rodando em http://localhost:8000 (verifique o comando de execução)")
 
+    @app.on_event("shutdown")
+    async def shutdown():
+        """Fecha as ligações HTTP partilhadas ao llama.cpp."""
+        app.state.arranque.cancel()
+        from app.api.routes import parar_ingestao_em_segundo_plano
+        parar_ingestao_em_segundo_plano()
+        from app.core.http_client import fechar_clientes
+        await fechar_clientes()
+
 
     return app
 
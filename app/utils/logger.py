@@ -18,10 +18,12 @@ class InterceptHandler(logging.Handler):
 
 def setup_logging():
     logger.remove()
+    # Fora de um pedido HTTP (arranque, ingestão) o id aparece como "-"; ver app/api/middleware.py
+    logger.configure(extra={"request_id": "-"})
     logger.add(
         sys.stdout,
         colorize=True,
-        format="<green>{time:HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan> | {message}",
+        format="<green>{time:HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan> | <magenta>{extra[request_id]}</magenta> | {message}",
         level="DEBUG"  # <-- ALTERAÇÃO IMPORTANTE AQUI
     )
     logging.basicConfig(handlers=[InterceptHandler()], level=0)
\ No newline at end of file
@@ -0,0 +1,172 @@
+# app/utils/metrics.py - Métricas no formato de texto do Prometheus e tempos por etapa de cada pedido
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+import bisect
+import threading
+import time
+
+_Rotulos = Tuple[str, ...]
+
+# Id do pedido HTTP em curso (definido pelo middleware) e tempos das etapas do /chat
+id_pedido: ContextVar[str] = ContextVar("id_pedido", default="-")
+_etapas: ContextVar[Optional[Dict[str, float]]] = ContextVar("etapas_pedido", default=None)
+
+def _escapar(valor: str) -> str:
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _formatar_rotulos(nomes: Sequence[str], valores: Sequence[str], extra: str = "") -> str:
+    pares = [f'{nome}="{_escapar(valor)}"' for nome, valor in zip(nomes, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+class _Metrica(ABC):
+    tipo = ""
+
+    def __init__(self, nome: str, ajuda: str, rotulos: Sequence[str] = ()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = tuple(rotulos)
+        self._lock = threading.Lock()
+        registo.registar(self)
+
+    def _chave(self, rotulos: Dict[str, str]) -> _Rotulos:
+        return tuple(str(rotulos.get(nome, "")) for nome in self.rotulos)
+
+    def _cabecalho(self) -> List[str]:
+        return [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+
+    @abstractmethod
+    def exportar(self) -> List[str]:
+        ...
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def __init__(self, nome: str, ajuda: str, rotulos: Sequence[str] = ()):
+        super().__init__(nome, ajuda, rotulos)
+        self._valores: Dict[_Rotulos, float] = {}
+
+    def inc(self, valor: float = 1, **rotulos: str) -> None:
+        chave = self._chave(rotulos)
+        with self._lock:
+            self._valores[chave] = self._valores.get(chave, 0) + valor
+
+    def valores(self) -> Dict[_Rotulos, float]:
+        with self._lock:
+            return dict(self._valores)
+
+    def exportar(self) -> List[str]:
+        linhas = self._cabecalho()
+        for chave, valor in sorted(self.valores().items()):
+            linhas.append(f"{self.nome}{_formatar_rotulos(self.rotulos, chave)} {valor:g}")
+        return linhas
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nome: str, ajuda: str, buckets: Sequence[float], rotulos: Sequence[str] = ()):
+        super().__init__(nome, ajuda, rotulos)
+        self.buckets = tuple(sorted(buckets))
+        # rótulos -> [contagem por bucket (não cumulativa, + o +Inf), soma]
+        self._series: Dict[_Rotulos, Tuple[List[int], List[float]]] = {}
+
+    def observar(self, valor: float, **rotulos: str) -> None:
+        chave = self._chave(rotulos)
+        indice = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            contagens, soma = self._series.setdefault(chave, ([0] * (len(self.buckets) + 1), [0.0]))
+            contagens[indice] += 1
+            soma[0] += valor
+
+    def exportar(self) -> List[str]:
+        linhas = self._cabecalho()
+        with self._lock:
+            series = {chave: (list(contagens), soma[0]) for chave, (contagens, soma) in self._series.items()}
+        for chave, (contagens, soma) in sorted(series.items()):
+            acumulado = 0
+            for limite, contagem in zip([*self.buckets, float("inf")], contagens):
+                acumulado += contagem
+                le = "+Inf" if limite == float("inf") else f"{limite:g}"
+                rotulos = _formatar_rotulos(self.rotulos, chave, 'le="' + le + '"')
+                linhas.append(f"{self.nome}_bucket{rotulos} {acumulado}")
+            linhas.append(f"{self.nome}_sum{_formatar_rotulos(self.rotulos, chave)} {soma:g}")
+            linhas.append(f"{self.nome}_count{_formatar_rotulos(self.rotulos, chave)} {acumulado}")
+        return linhas
+
+class MetricaCalculada(_Metrica):
+    """Valores lidos no momento da recolha (ex.: contadores já mantidos pelas caches)."""
+
+    def __init__(self, nome: str, ajuda: str, tipo: str, funcao: Callable[[], Dict[_Rotulos, float]],
+                 rotulos: Sequence[str] = ()):
+        self.tipo = tipo
+        self.funcao = funcao
+        super().__init__(nome, ajuda, rotulos)
+
+    def exportar(self) -> List[str]:
+        linhas = self._cabecalho()
+        for chave, valor in sorted(self.funcao().items()):
+            linhas.append(f"{self.nome}{_formatar_rotulos(self.rotulos, chave)} {valor:g}")
+        return linhas
+
+class RegistoMetricas:
+    def __init__(self):
+        self._metricas: List[_Metrica] = []
+
+    def registar(self, metrica: _Metrica) -> None:
+        self._metricas.append(metrica)
+
+    def exportar(self) -> str:
+        return "\n".join(linha for metrica in self._metricas for linha in metrica.exportar()) + "\n"
+
+registo = RegistoMetricas()
+
+_BUCKETS_ETAPAS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+duracao_etapas = Histograma(
+    "ucdb_chat_stage_seconds", "Duração de cada etapa do /chat.", _BUCKETS_ETAPAS, ("stage",)
+)
+duracao_pedidos = Histograma(
+    "ucdb_chat_request_seconds", "Duração total dos pedidos ao /chat (até ao evento complete).", _BUCKETS_ETAPAS
+)
+pedidos_chat = Contador("ucdb_chat_requests_total", "Pedidos ao /chat por desfecho.", ("outcome",))
+geracoes_canceladas = Contador(
+    "ucdb_chat_cancelled_generations_total", "Gerações canceladas no llama.cpp porque todos os clientes desligaram."
+)
+tokens_por_segundo = Histograma(
+    "ucdb_llm_tokens_per_second", "Velocidade de geração observada no stream do llama.cpp.",
+    (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+)
+tokens_gerados = Contador("ucdb_llm_generated_tokens_total", "Tokens recebidos do llama.cpp em streaming.")
+recuperacoes_por_area = Contador(
+    "ucdb_area_retrievals_total", "Recuperações com filtro de área: restritas às áreas ou com recurso à busca global.", ("outcome",)
+)
+erros_upstream = Contador(
+    "ucdb_upstream_errors_total", "Falhas nas chamadas ao llama.cpp.", ("service", "kind")
+)
+
+def iniciar_pedido() -> Dict[str, float]:
+    """Começa a recolher os tempos das etapas do pedido atual (herdados pelas tarefas filhas)."""
+    etapas: Dict[str, float] = {}
+    _etapas.set(etapas)
+    return etapas
+
+def registar_etapa(etapa: str, segundos: float) -> None:
+    duracao_etapas.observar(segundos, stage=etapa)
+    etapas = _etapas.get()
+    if etapas is not None:
+        etapas[etapa] = etapas.get(etapa, 0.0) + segundos
+
+@contextmanager
+def medir(etapa: str) -> Iterator[None]:
+    """Mede o bloco como uma etapa: histograma global e tempos do pedido atual."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registar_etapa(etapa, time.perf_counter() - inicio)
+
+def resumo_etapas(etapas: Dict[str, float]) -> str:
+    return " ".join(f"{etapa}={segundos * 1000:.0f}ms" for etapa, segundos in etapas.items())
@@ -0,0 +1,161 @@
+# app/utils/streaming.py
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional
+from langchain_core.callbacks import AsyncCallbackHandler
+
+# Versão do protocolo SSE do /chat, anunciada no evento `start`.
+# v2: eventos `chunk` transportam apenas o texto novo (delta) e `replace` substitui
+# a resposta inteira pela versão final corrigida.
+SSE_PROTOCOL_VERSION = 2
+
+class TokenQueueHandler(AsyncCallbackHandler):
+    """Reencaminha os tokens emitidos pelo LLM para uma fila asyncio."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.queue.put_nowait(token)
+
+async def iterar_deltas(
+    handler: TokenQueueHandler,
+    tarefa: asyncio.Future,
+    intervalo: float,
+    max_chars: int,
+) -> AsyncIterator[str]:
+    """Agrupa os tokens da fila em deltas até que a `tarefa` (a execução da chain) termine.
+
+    O primeiro token sai de imediato; os seguintes são acumulados e enviados a cada
+    `intervalo` segundos ou assim que o delta atingir `max_chars` caracteres.
+    O resultado (ou a exceção) da tarefa fica disponível via `await tarefa` no fim.
+    """
+    # O callback de conclusão é agendado depois de todos os tokens já enfileirados.
+    tarefa.add_done_callback(lambda _: handler.queue.put_nowait(None))
+    loop = asyncio.get_running_loop()
+    pendente: List[str] = []
+    tamanho = 0
+    ultimo_envio: Optional[float] = None
+
+    while True:
+        if pendente:
+            restante = intervalo - (loop.time() - ultimo_envio)
+            if restante <= 0:
+                yield "".join(pendente)
+                pendente, tamanho, ultimo_envio = [], 0, loop.time()
+                continue
+            try:
+                token = await asyncio.wait_for(handler.queue.get(), restante)
+            except asyncio.TimeoutError:
+                continue
+        else:
+            token = await handler.queue.get()
+
+        if token is None:
+            break
+        pendente.append(token)
+        tamanho += len(token)
+        if ultimo_envio is None or tamanho >= max_chars:
+            yield "".join(pendente)
+            pendente, tamanho, ultimo_envio = [], 0, loop.time()
+
+    if pendente:
+        yield "".join(pendente)
+
+class GeracaoPartilhada:
+    """Uma execução da chain difundida para vários streams SSE (single-flight).
+
+    Os deltas publicados ficam guardados, pelo que um subscritor que chega a meio
+    recebe primeiro o que já saiu. Se o último subscritor sair antes do fim, a
+    `tarefa` de geração é cancelada e a geração marcada como abandonada.
+    Enquanto espera pela vez no llama.cpp, `fila` guarda a posição e o tempo estimado.
+    """
+
+    def __init__(self):
+        self.deltas: List[str] = []
+        self.terminada = False
+        self.abandonada = False
+        self.admitida = False
+        self.fila: Optional[Dict[str, Any]] = None
+        self.tarefa: Optional[asyncio.Task] = None
+        self._resultado: Any = None
+        self._erro: Optional[BaseException] = None
+        self._mudou = asyncio.Event()
+        self._subscritores = 0
+
+    def _acordar(self) -> None:
+        self._mudou.set()
+        self._mudou = asyncio.Event()
+
+    def publicar(self, delta: str) -> None:
+        self.deltas.append(delta)
+        self._acordar()
+
+    def na_fila(self, posicao: int, eta: Optional[float]) -> None:
+        self.fila = {"position": posicao, "eta_s": None if eta is None else round(eta)}
+        self._acordar()
+
+    def admitir(self) -> None:
+        self.admitida = True
+        self._acordar()
+
+    def concluir(self, resultado: Any = None, erro: Optional[BaseException] = None) -> None:
+        self._resultado, self._erro = resultado, erro
+        self.terminada = True
+        self._acordar()
+
+    def entrar(self) -> None:
+        self._subscritores += 1
+
+    def sair(self) -> None:
+        self._subscritores -= 1
+        if self._subscritores == 0 and not self.terminada:
+            self.abandonada = True
+            if self.tarefa is not None:
+                self.tarefa.cancel()
+
+    @property
+    def subscritores(self) -> int:
+        return self._subscritores
+
+    async def _esperar_mudanca(self, parar: Optional[asyncio.Event]) -> None:
+        if parar is None:
+            await self._mudou.wait()
+            return
+        esperas = [asyncio.ensure_future(self._mudou.wait()), asyncio.ensure_future(parar.wait())]
+        try:
+            await asyncio.wait(esperas, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for espera in esperas:
+                espera.cancel()
+
+    async def iterar_fila(self, parar: Optional[asyncio.Event] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Devolve o estado da fila sempre que muda, até a geração ser admitida ou terminar."""
+        ultimo = None
+        while not (self.admitida or self.terminada or (parar is not None and parar.is_set())):
+            if self.fila is not None and self.fila != ultimo:
+                ultimo = self.fila
+                yield ultimo
+            await self._esperar_mudanca(parar)
+
+    async def iterar(self, parar: Optional[asyncio.Event] = None) -> AsyncIterator[str]:
+        """Devolve todos os deltas, desde o primeiro, até a geração terminar.
+
+        Com `parar` (ex.: o cliente desligou-se), a iteração acaba assim que o evento
+        for ativado, sem esperar pelo próximo delta.
+        """
+        i = 0
+        while True:
+            while i < len(self.deltas):
+                if parar is not None and parar.is_set():
+                    return
+                yield self.deltas[i]
+                i += 1
+            if self.terminada or (parar is not None and parar.is_set()):
+                return
+            await self._esperar_mudanca(parar)
+
+    def resultado(self) -> Any:
+        """Resultado final da geração; relança a exceção se a geração falhou."""
+        if self._erro is not None:
+            raise self._erro
+        return self._resultado
@@ -0,0 +1,107 @@
+# benchmarks/carga_chat.py - Clientes SSE concorrentes contra o /chat: TTFT, latência total e pedidos/s
+#
+# Uso (na raiz do projeto, com a aplicação a correr):
+#   python -m benchmarks.carga_chat --url http://127.0.0.1:8000 --clientes 16 --pedidos 200
+#
+# Cada pedido é feito sem cookie (sessão nova, sem histórico). Com --repetidas F, uma
+# fração F das perguntas repete-se para exercitar as caches e as gerações partilhadas.
+
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import random
+import time
+import httpx
+
+def percentil(valores: List[float], p: float) -> Optional[float]:
+    """Percentil por interpolação linear (como numpy.percentile)."""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    posicao = (len(ordenados) - 1) * p / 100
+    inferior = int(posicao)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicao - inferior)
+
+def gerar_perguntas(temas: List[str], quantidade: int, repetidas: float, semente: int = 0) -> List[str]:
+    rng = random.Random(semente)
+    base = [f"O que diz o regulamento sobre {rng.choice(temas)} e a frequencia minima? ({i})" for i in range(quantidade)]
+    fixas = base[:max(1, quantidade // 20)]
+    return [rng.choice(fixas) if rng.random() < repetidas else pergunta for pergunta in base]
+
+async def _um_pedido(cliente: httpx.AsyncClient, url: str, pergunta: str) -> Dict[str, Optional[float]]:
+    inicio = time.perf_counter()
+    ttft = None
+    desfecho = "erro"
+    try:
+        async with cliente.stream("POST", f"{url}/chat", json={"message": pergunta}) as resposta:
+            if resposta.status_code == 429:
+                return {"desfecho": "rejeitado", "ttft": None, "total": time.perf_counter() - inicio}
+            resposta.raise_for_status()
+            async for linha in resposta.aiter_lines():
+                if not linha.startswith("data:"):
+                    continue
+                evento = json.loads(linha[5:])
+                if evento["type"] == "chunk" and ttft is None:
+                    ttft = time.perf_counter() - inicio
+                elif evento["type"] == "complete":
+                    desfecho = "concluido"
+                elif evento["type"] == "error":
+                    break
+    except httpx.HTTPError:
+        pass
+    return {"desfecho": desfecho, "ttft": ttft, "total": time.perf_counter() - inicio}
+
+async def executar_carga(url: str, perguntas: List[str], clientes: int, timeout: float = 300) -> Dict[str, float]:
+    """Corre `perguntas` com `clientes` pedidos em simultâneo e agrega as medições (em ms)."""
+    fila: asyncio.Queue = asyncio.Queue()
+    for pergunta in perguntas:
+        fila.put_nowait(pergunta)
+    resultados = []
+
+    async def cliente_sse(cliente: httpx.AsyncClient):
+        while not fila.empty():
+            resultados.append(await _um_pedido(cliente, url, fila.get_nowait()))
+
+    limites = httpx.Limits(max_connections=clientes, max_keepalive_connections=clientes)
+    # O cookie session_id não é guardado: cada pedido é uma sessão nova, sem histórico
+    sem_cookies = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+    async with httpx.AsyncClient(timeout=timeout, limits=limites, cookies=sem_cookies) as cliente:
+        inicio = time.perf_counter()
+        await asyncio.gather(*(cliente_sse(cliente) for _ in range(clientes)))
+        duracao = time.perf_counter() - inicio
+
+    concluidos = [r for r in resultados if r["desfecho"] == "concluido"]
+    ttfts = [r["ttft"] * 1000 for r in concluidos if r["ttft"] is not None]
+    totais = [r["total"] * 1000 for r in concluidos]
+    metricas = {
+        "pedidos": len(resultados),
+        "concluidos": len(concluidos),
+        "rejeitados": sum(r["desfecho"] == "rejeitado" for r in resultados),
+        "erros": sum(r["desfecho"] == "erro" for r in resultados),
+        "pedidos_por_s": round(len(concluidos) / duracao, 2) if duracao > 0 else 0.0,
+    }
+    for nome, valores in (("ttft_ms", ttfts), ("total_ms", totais)):
+        for p in (50, 95, 99):
+            valor = percentil(valores, p)
+            metricas[f"{nome}_p{p}"] = None if valor is None else round(valor, 1)
+    return metricas
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga concorrente de clientes SSE contra o /chat.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--clientes", type=int, default=16, help="pedidos em simultâneo")
+    parser.add_argument("--pedidos", type=int, default=200)
+    parser.add_argument("--repetidas", type=float, default=0.0, help="fração de perguntas repetidas (0-1)")
+    parser.add_argument("--temas", default="tema000,tema001,tema002", help="termos usados nas perguntas (ver benchmarks.corpus)")
+    args = parser.parse_args()
+
+    perguntas = gerar_perguntas(args.temas.split(","), args.pedidos, args.repetidas)
+    metricas = asyncio.run(executar_carga(args.url, perguntas, args.clientes))
+    for chave, valor in metricas.items():
+        print(f"{chave:<16}{valor!s:>12}")
+
+if __name__ == "__main__":
+    main()
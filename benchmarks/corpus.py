@@ -0,0 +1,94 @@
+# benchmarks/corpus.py - Gera um corpus de PDFs sintéticos para os benchmarks de ingestão e do /chat
+#
+# Uso (na raiz do projeto):
+#   python -m benchmarks.corpus --destino /tmp/ucdb-bench/pdfs --pdfs 20 --paginas 12
+#
+# Os PDFs são escritos à mão (PDF 1.4, Helvetica, só ASCII), sem dependências extra,
+# e o PyPDFLoader da ingestão extrai o texto normalmente. O conteúdo é determinístico
+# para a mesma --semente, para que as execuções sejam comparáveis.
+
+import argparse
+import os
+import random
+
+# Vocabulário comum aos PDFs e às respostas do llama.cpp falso (sem acentos: Helvetica/WinAnsi)
+_PALAVRAS = (
+    "a universidade oferece cursos de graduacao e pos graduacao com avaliacao continua dos estudantes "
+    "o regulamento define prazos matricula frequencia minima trancamento disciplinas optativas estagio "
+    "supervisionado trabalho de conclusao coordenacao colegiado secretaria academica calendario semestre "
+    "bolsas monitoria pesquisa extensao laboratorio biblioteca emprestimo renovacao multa acervo digital "
+    "nota media exame recuperacao aprovacao reprovacao creditos carga horaria ementa plano ensino docente "
+    "orientador banca defesa dissertacao tese qualificacao projeto relatorio parecer recurso requerimento"
+).split()
+
+_LINHAS_POR_PAGINA = 45
+_PALAVRAS_POR_LINHA = 12
+
+def _escapar(texto: str) -> str:
+    return texto.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def _pagina(rng: random.Random, tema: str, numero: int) -> bytes:
+    linhas = [f"{tema.upper()} - pagina {numero}"]
+    for _ in range(_LINHAS_POR_PAGINA - 1):
+        # O tema aparece com frequência: perguntas sobre ele recuperam páginas deste PDF
+        palavras = [rng.choice(_PALAVRAS) for _ in range(_PALAVRAS_POR_LINHA)]
+        palavras[rng.randrange(len(palavras))] = tema
+        linhas.append(" ".join(palavras))
+    corpo = " T*\n".join(f"({_escapar(linha)}) Tj" for linha in linhas)
+    return f"BT\n/F1 10 Tf\n14 TL\n50 800 Td\n{corpo}\nET".encode("latin-1")
+
+def escrever_pdf(caminho: str, paginas: list) -> None:
+    """Escreve um PDF mínimo com uma stream de conteúdo por página."""
+    n = len(paginas)
+    # 1 catálogo, 2 árvore de páginas, 3 fonte; depois (página, conteúdo) para cada página
+    ids_paginas = [4 + 2 * i for i in range(n)]
+    objetos = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in ids_paginas)}] /Count {n} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    for i, conteudo in enumerate(paginas):
+        objetos.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+            f"/Contents {ids_paginas[i] + 1} 0 R >>".encode()
+        )
+        objetos.append(b"<< /Length %d >>\nstream\n" % len(conteudo) + conteudo + b"\nendstream")
+
+    saida = bytearray(b"%PDF-1.4\n")
+    deslocamentos = []
+    for numero, objeto in enumerate(objetos, start=1):
+        deslocamentos.append(len(saida))
+        saida += b"%d 0 obj\n" % numero + objeto + b"\nendobj\n"
+    inicio_xref = len(saida)
+    saida += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objetos) + 1)
+    saida += b"".join(b"%010d 00000 n \n" % d for d in deslocamentos)
+    saida += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objetos) + 1, inicio_xref)
+    with open(caminho, "wb") as f:
+        f.write(saida)
+
+def gerar_corpus(destino: str, pdfs: int, paginas: int, semente: int = 0) -> list:
+    """Gera `pdfs` ficheiros com `paginas` páginas cada; devolve os temas (um por PDF)."""
+    os.makedirs(destino, exist_ok=True)
+    rng = random.Random(semente)
+    temas = []
+    for i in range(pdfs):
+        tema = f"tema{i:03d}"
+        temas.append(tema)
+        escrever_pdf(
+            os.path.join(destino, f"documento_{i:03d}.pdf"),
+            [_pagina(rng, tema, numero + 1) for numero in range(paginas)]
+        )
+    return temas
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera PDFs sintéticos para os benchmarks.")
+    parser.add_argument("--destino", required=True)
+    parser.add_argument("--pdfs", type=int, default=20)
+    parser.add_argument("--paginas", type=int, default=12)
+    parser.add_argument("--semente", type=int, default=0)
+    args = parser.parse_args()
+    gerar_corpus(args.destino, args.pdfs, args.paginas, args.semente)
+    print(f"{args.pdfs} PDFs com {args.paginas} páginas escritos em {args.destino}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# benchmarks/faiss_indices.py - Recall vs. latência dos tipos de índice FAISS face ao Flat exato
+#
+# Uso (na raiz do projeto):
+#   python -m benchmarks.faiss_indices --fabricas "Flat;SQfp16;HNSW32;IVF1024,PQ32" --nprobe 8,16,32
+#
+# Os vetores vêm do índice gravado em embeddings/ (ou são sintéticos com --sinteticos N).
+# Uma amostra é retirada da base e usada como consultas; a verdade de referência é o
+# top-k do IndexFlatL2 sobre a base restante.
+
+from app.core.config import settings
+from app.core.vector_index import configurar_busca, criar_indice
+import argparse
+import os
+import time
+import faiss
+import numpy as np
+
+def _carregar_vetores(args):
+    if args.sinteticos:
+        rng = np.random.default_rng(0)
+        return rng.standard_normal((args.sinteticos, args.dim)).astype(np.float32)
+    index = faiss.read_index(os.path.join(settings.vectorstore_path, "index.faiss"))
+    try:
+        return index.reconstruct_n(0, index.ntotal)
+    except RuntimeError:
+        raise SystemExit("O índice gravado não permite reconstruir os vetores; grave-o com FAISS_INDEX_FACTORY=Flat ou use --sinteticos.")
+
+def _medir(index, consultas, referencia, k):
+    inicio = time.perf_counter()
+    _, encontrados = index.search(consultas, k)
+    duracao = time.perf_counter() - inicio
+    acertos = sum(len(set(e) & set(r)) for e, r in zip(encontrados, referencia))
+    return acertos / referencia.size, duracao / len(consultas) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k e latência por consulta de cada tipo de índice FAISS.")
+    parser.add_argument("--fabricas", default="Flat;SQfp16;HNSW32;IVF256,Flat;IVF256,PQ32", help="strings de fábrica separadas por ';'")
+    parser.add_argument("--nprobe", default="", help="valores de nprobe a testar em índices IVF (ex.: 4,16,64)")
+    parser.add_argument("--ef-search", default="", help="valores de efSearch a testar em índices HNSW (ex.: 32,64,128)")
+    parser.add_argument("--k", type=int, default=settings.RETRIEVAL_K)
+    parser.add_argument("--consultas", type=int, default=500)
+    parser.add_argument("--sinteticos", type=int, default=0, help="usa N vetores aleatórios em vez do índice gravado")
+    parser.add_argument("--dim", type=int, default=768, help="dimensão dos vetores sintéticos")
+    args = parser.parse_args()
+
+    vetores = _carregar_vetores(args)
+    rng = np.random.default_rng(1)
+    ordem = rng.permutation(len(vetores))
+    consultas = vetores[ordem[:args.consultas]]
+    base = vetores[ordem[args.consultas:]]
+    print(f"{len(base)} vetores de dimensão {base.shape[1]}, {len(consultas)} consultas, k={args.k}")
+
+    exato = faiss.IndexFlatL2(base.shape[1])
+    exato.add(base)
+    _, referencia = exato.search(consultas, args.k)
+
+    nprobes = [int(v) for v in args.nprobe.split(",") if v] or [settings.FAISS_NPROBE]
+    efs = [int(v) for v in args.ef_search.split(",") if v] or [settings.FAISS_EF_SEARCH]
+    print(f"{'fábrica':<22}{'parâmetros':<16}{'recall@k':>10}{'ms/consulta':>14}{'treino s':>10}{'MB':>9}")
+    for fabrica in dict.fromkeys(f.strip() for f in args.fabricas.split(";") if f.strip()):
+        index = criar_indice(base.shape[1], fabrica)
+        inicio = time.perf_counter()
+        if not index.is_trained:
+            amostra = base[rng.choice(len(base), min(len(base), settings.FAISS_TRAIN_SIZE), replace=False)]
+            index.train(amostra)
+        index.add(base)
+        treino = time.perf_counter() - inicio
+        tamanho_mb = faiss.serialize_index(index).nbytes / 2**20
+        if fabrica.startswith("IVF"):
+            variantes = [(f"nprobe={n}", {"nprobe": n}) for n in nprobes]
+        elif fabrica.startswith("HNSW"):
+            variantes = [(f"efSearch={e}", {"ef_search": e}) for e in efs]
+        else:
+            variantes = [("-", {})]
+        for descricao, parametros in variantes:
+            configurar_busca(index, **parametros)
+            recall, ms = _medir(index, consultas, referencia, args.k)
+            print(f"{fabrica:<22}{descricao:<16}{recall:>10.3f}{ms:>14.3f}{treino:>10.1f}{tamanho_mb:>9.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# benchmarks/fake_llama.py - Substituto local do llama-server (completions, tokenize e embedding) para benchmarks
+#
+# Uso (na raiz do projeto):
+#   python -m benchmarks.fake_llama --porta 18080 --ttft-ms 150 --tokens-por-segundo 40 --tokens 120
+#
+# Serve no mesmo processo o que a aplicação pede às duas instâncias do llama.cpp:
+#   POST /v1/completions  (com e sem "stream": true, eventos SSE como o llama.cpp)
+#   POST /tokenize
+#   POST /embedding       (um "content" ou uma lista, um item por texto com o respetivo "index")
+# As respostas são determinísticas para o mesmo prompt e os embeddings são sacos de
+# palavras com hashing, pelo que a recuperação devolve chunks que partilham termos com a pergunta.
+
+from benchmarks.corpus import _PALAVRAS
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+
+class ConfiguracaoFalsa:
+    def __init__(self, ttft_ms: float = 150, tokens_por_segundo: float = 40, tokens: int = 120,
+                 latencia_embedding_ms: float = 5, dim: int = 384):
+        self.ttft_ms = ttft_ms
+        self.tokens_por_segundo = tokens_por_segundo
+        self.tokens = tokens
+        self.latencia_embedding_ms = latencia_embedding_ms
+        self.dim = dim
+
+configuracao = ConfiguracaoFalsa()
+app = FastAPI(title="llama.cpp falso")
+
+def _semente(texto: str) -> int:
+    return int.from_bytes(hashlib.sha1(texto.encode("utf-8")).digest()[:8], "big")
+
+def _tokens_resposta(prompt: str, quantidade: int):
+    """Palavras aleatórias (semente = prompt): sem n-gramas repetidos que disparem o detetor de ciclos."""
+    rng = random.Random(_semente(prompt))
+    for i in range(quantidade):
+        palavra = rng.choice(_PALAVRAS)
+        yield (" " if i else "") + palavra + ("." if i % 17 == 16 else "")
+
+def _embedding(texto: str) -> list:
+    vetor = [0.0] * configuracao.dim
+    for palavra in re.findall(r"\w+", texto.lower()):
+        semente = _semente(palavra)
+        vetor[semente % configuracao.dim] += 1.0 if (semente >> 32) & 1 else -1.0
+    norma = math.sqrt(sum(v * v for v in vetor)) or 1.0
+    return [v / norma for v in vetor]
+
+@app.post("/v1/completions")
+async def completions(request: Request):
+    corpo = await request.json()
+    prompt = corpo.get("prompt", "")
+    quantidade = min(int(corpo.get("max_tokens") or configuracao.tokens), configuracao.tokens)
+    intervalo = 1 / configuracao.tokens_por_segundo if configuracao.tokens_por_segundo > 0 else 0
+
+    if not corpo.get("stream"):
+        await asyncio.sleep(configuracao.ttft_ms / 1000 + quantidade * intervalo)
+        texto = "".join(_tokens_resposta(prompt, quantidade))
+        return JSONResponse({"choices": [{"text": texto, "index": 0, "finish_reason": "length"}]})
+
+    async def eventos():
+        await asyncio.sleep(configuracao.ttft_ms / 1000)
+        for token in _tokens_resposta(prompt, quantidade):
+            yield f"data: {json.dumps({'choices': [{'text': token, 'index': 0}]})}\n\n"
+            await asyncio.sleep(intervalo)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(eventos(), media_type="text/event-stream")
+
+@app.post("/tokenize")
+async def tokenize(request: Request):
+    corpo = await request.json()
+    # ~1 token por palavra ou sinal, próximo do que o tokenizador real devolve para português
+    return {"tokens": [_semente(t) % 32000 for t in re.findall(r"\w+|[^\w\s]", corpo.get("content", ""))]}
+
+@app.post("/embedding")
+async def embedding(request: Request):
+    corpo = await request.json()
+    conteudo = corpo.get("content", "")
+    textos = conteudo if isinstance(conteudo, list) else [conteudo]
+    await asyncio.sleep(configuracao.latencia_embedding_ms / 1000 * len(textos))
+    return [{"index": i, "embedding": [_embedding(texto)]} for i, texto in enumerate(textos)]
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+def main():
+    global configuracao
+    parser = argparse.ArgumentParser(description="Servidor llama.cpp falso com latência e velocidade configuráveis.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=18080)
+    parser.add_argument("--ttft-ms", type=float, default=configuracao.ttft_ms, help="espera antes do primeiro token (prefill)")
+    parser.add_argument("--tokens-por-segundo", type=float, default=configuracao.tokens_por_segundo)
+    parser.add_argument("--tokens", type=int, default=configuracao.tokens, help="tokens por resposta (limitado por max_tokens)")
+    parser.add_argument("--latencia-embedding-ms", type=float, default=configuracao.latencia_embedding_ms, help="por texto")
+    parser.add_argument("--dim", type=int, default=configuracao.dim)
+    args = parser.parse_args()
+
+    configuracao = ConfiguracaoFalsa(args.ttft_ms, args.tokens_por_segundo, args.tokens, args.latencia_embedding_ms, args.dim)
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.porta, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# benchmarks/ingestao.py - Tempo e débito (chunks/s) do criar_vectorstore sobre a pasta de PDFs configurada
+#
+# Uso (na raiz do projeto, com o llama.cpp ou o benchmarks.fake_llama a correr):
+#   BASE_DIR=/tmp/ucdb-bench python -m benchmarks.ingestao --json
+#
+# Mede uma ingestão a frio se o índice e a cache de embeddings de BASE_DIR não existirem;
+# o benchmarks.suite prepara esse diretório e corre este módulo num processo à parte.
+
+import argparse
+import json
+import resource
+import time
+
+def medir_ingestao() -> dict:
+    inicio = time.perf_counter()
+    # O import conta: é parte do que o arranque da aplicação paga
+    from app.core.rag import criar_vectorstore
+    vectorstore = criar_vectorstore()
+    duracao = time.perf_counter() - inicio
+    chunks = vectorstore.index.ntotal if vectorstore is not None else 0
+    # ru_maxrss em KB no Linux; os filhos são o pool de processos do parse/split
+    pico_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        "ingestao_s": round(duracao, 3),
+        "ingestao_chunks": chunks,
+        "ingestao_chunks_por_s": round(chunks / duracao, 1) if duracao > 0 else 0.0,
+        "ingestao_pico_rss_mb": round(pico_kb / 1024, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Mede a ingestão dos PDFs de settings.pdf_path.")
+    parser.add_argument("--json", action="store_true", help="escreve o resultado numa linha JSON (usado pelo benchmarks.suite)")
+    args = parser.parse_args()
+    resultado = medir_ingestao()
+    if args.json:
+        print(json.dumps(resultado))
+    else:
+        for chave, valor in resultado.items():
+            print(f"{chave:<26}{valor:>12}")
+
+if __name__ == "__main__":
+    main()
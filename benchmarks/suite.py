@@ -0,0 +1,184 @@
+# benchmarks/suite.py - Corre o benchmark completo (ingestão, arranque e carga do /chat) e compara com uma baseline
+#
+# Uso (na raiz do projeto):
+#   python -m benchmarks.suite --salvar-baseline              # grava benchmarks/baseline.json
+#   python -m benchmarks.suite                                # compara com a baseline gravada
+#   python -m benchmarks.suite --clientes 32 --pedidos 400 --tokens-por-segundo 25
+#
+# Tudo corre localmente e num diretório temporário (BASE_DIR): o benchmarks.fake_llama
+# substitui o llama-server (completions e embeddings), o benchmarks.corpus gera os PDFs,
+# o benchmarks.ingestao mede o criar_vectorstore a frio e a aplicação é arrancada com uvicorn
+# para medir o tempo de arranque (até ao /healthz e ao /readyz), o pico de memória (RSS) e a
+# carga do benchmarks.carga_chat.
+
+from benchmarks.carga_chat import executar_carga, gerar_perguntas
+from benchmarks.corpus import gerar_corpus
+from typing import Dict, Optional
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+_RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_BASELINE = os.path.join(_RAIZ, "benchmarks", "baseline.json")
+
+# Métricas em que um valor maior é melhor; nas restantes (latências, memória, tempos) é pior
+_MAIOR_E_MELHOR = {"pedidos_por_s", "ingestao_chunks_por_s", "concluidos"}
+
+def _porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _esperar_http(url: str, timeout: float, processo: subprocess.Popen) -> float:
+    """Segundos até `url` responder 200; falha se o processo terminar antes."""
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < timeout:
+        if processo.poll() is not None:
+            raise SystemExit(f"O processo terminou antes de {url} responder (código {processo.returncode}).")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - inicio
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.05)
+    raise SystemExit(f"{url} não respondeu em {timeout:.0f}s.")
+
+def _pico_rss_mb(pid: int) -> Optional[float]:
+    """VmHWM (pico de memória residente) do processo; só disponível em Linux."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linha in f:
+                if linha.startswith("VmHWM:"):
+                    return round(int(linha.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def _ambiente(base_dir: str, porta_llama: int) -> Dict[str, str]:
+    llama = f"http://127.0.0.1:{porta_llama}"
+    return {
+        **os.environ,
+        "PYTHONPATH": _RAIZ,
+        "BASE_DIR": base_dir,
+        "LLM_BASE_URL": f"{llama}/v1",
+        "LLM_TOKENIZE_URL": f"{llama}/tokenize",
+        "EMBEDDING_API_URL": f"{llama}/embedding",
+        # O índice já está construído; a vigilância da pasta só acrescentaria ruído
+        "INGESTION_WATCH": "false",
+    }
+
+def executar_suite(args) -> Dict[str, Optional[float]]:
+    resultados: Dict[str, Optional[float]] = {}
+    processos = []
+    with tempfile.TemporaryDirectory(prefix="ucdb-bench-") as base_dir:
+        try:
+            temas = gerar_corpus(os.path.join(base_dir, "pdfs"), args.pdfs, args.paginas)
+            print(f"📄 Corpus: {args.pdfs} PDFs × {args.paginas} páginas")
+
+            porta_llama = _porta_livre()
+            processos.append(subprocess.Popen([
+                sys.executable, "-m", "benchmarks.fake_llama", "--porta", str(porta_llama),
+                "--ttft-ms", str(args.ttft_ms), "--tokens-por-segundo", str(args.tokens_por_segundo),
+                "--tokens", str(args.tokens), "--latencia-embedding-ms", str(args.latencia_embedding_ms),
+            ], cwd=_RAIZ))
+            _esperar_http(f"http://127.0.0.1:{porta_llama}/health", 30, processos[-1])
+            ambiente = _ambiente(base_dir, porta_llama)
+
+            print("⏳ Ingestão...")
+            saida = subprocess.run(
+                [sys.executable, "-m", "benchmarks.ingestao", "--json"],
+                cwd=_RAIZ, env=ambiente, check=True, stdout=subprocess.PIPE, text=True
+            ).stdout
+            resultados.update(json.loads(saida.strip().splitlines()[-1]))
+
+            print("⏳ Arranque da aplicação...")
+            porta_app = _porta_livre()
+            processos.append(subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(porta_app), "--log-level", "warning"],
+                cwd=_RAIZ, env=ambiente, stdout=subprocess.DEVNULL
+            ))
+            url = f"http://127.0.0.1:{porta_app}"
+            # Liveness (o uvicorn aceita ligações) e readiness (índice carregado e aquecido)
+            inicio = time.perf_counter()
+            resultados["arranque_healthz_s"] = round(_esperar_http(f"{url}/healthz", 300, processos[-1]), 3)
+            _esperar_http(f"{url}/readyz", 300, processos[-1])
+            resultados["arranque_s"] = round(time.perf_counter() - inicio, 3)
+
+            print(f"⏳ Carga: {args.pedidos} pedidos, {args.clientes} clientes")
+            perguntas = gerar_perguntas(temas, args.pedidos, args.repetidas)
+            resultados.update(asyncio.run(executar_carga(url, perguntas, args.clientes)))
+            resultados["app_pico_rss_mb"] = _pico_rss_mb(processos[-1].pid)
+        finally:
+            for processo in reversed(processos):
+                processo.terminate()
+                try:
+                    processo.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    processo.kill()
+    return resultados
+
+def comparar(resultados: Dict[str, Optional[float]], baseline: Dict[str, Optional[float]], tolerancia: float) -> bool:
+    """Imprime a comparação com a baseline; devolve False se alguma métrica piorou mais do que `tolerancia`."""
+    print(f"\n{'métrica':<26}{'baseline':>12}{'atual':>12}{'variação':>11}")
+    sem_regressoes = True
+    for chave, valor in resultados.items():
+        anterior = baseline.get(chave)
+        if not isinstance(valor, (int, float)) or not isinstance(anterior, (int, float)) or anterior == 0:
+            print(f"{chave:<26}{anterior!s:>12}{valor!s:>12}")
+            continue
+        variacao = (valor - anterior) / anterior
+        piorou = -variacao if chave in _MAIOR_E_MELHOR else variacao
+        marca = " ⚠️" if piorou > tolerancia else ""
+        sem_regressoes &= not marca
+        print(f"{chave:<26}{anterior:>12g}{valor:>12g}{variacao:>+10.1%}{marca}")
+    return sem_regressoes
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ingestão, arranque e carga do /chat com um llama.cpp falso.")
+    parser.add_argument("--pdfs", type=int, default=20)
+    parser.add_argument("--paginas", type=int, default=12)
+    parser.add_argument("--clientes", type=int, default=16)
+    parser.add_argument("--pedidos", type=int, default=200)
+    parser.add_argument("--repetidas", type=float, default=0.2, help="fração de perguntas repetidas (caches)")
+    parser.add_argument("--ttft-ms", type=float, default=150)
+    parser.add_argument("--tokens-por-segundo", type=float, default=40)
+    parser.add_argument("--tokens", type=int, default=120)
+    parser.add_argument("--latencia-embedding-ms", type=float, default=2)
+    parser.add_argument("--baseline", default=_BASELINE)
+    parser.add_argument("--salvar-baseline", action="store_true", help="grava os resultados como nova baseline")
+    parser.add_argument("--saida", default="", help="grava os resultados desta execução em JSON")
+    parser.add_argument("--tolerancia", type=float, default=0.10, help="piora relativa aceite antes de assinalar regressão")
+    args = parser.parse_args()
+
+    resultados = executar_suite(args)
+    # Guardar os parâmetros evita comparar execuções com cargas diferentes
+    registo = {"parametros": {k: v for k, v in vars(args).items() if k not in ("baseline", "salvar_baseline", "saida", "tolerancia")},
+               "resultados": resultados}
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(registo, f, indent=2)
+    if args.salvar_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(registo, f, indent=2)
+        print(f"💾 Baseline gravada em {args.baseline}")
+
+    if os.path.exists(args.baseline) and not args.salvar_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("parametros") != registo["parametros"]:
+            print("⚠️ A baseline foi gravada com outros parâmetros: a comparação é só indicativa.")
+        if not comparar(resultados, baseline["resultados"], args.tolerancia):
+            sys.exit(1)
+    else:
+        for chave, valor in resultados.items():
+            print(f"{chave:<26}{valor!s:>12}")
+
+if __name__ == "__main__":
+    main()
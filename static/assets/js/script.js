@@ -12,6 +12,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const closeSourcesButton = document.getElementById('close-sources-button');
 
     let currentSourceChunks = []; // Armazena chunks da resposta atual
+    const selectedAreas = new Set(); // Áreas marcadas na sidebar: restringem a busca do /chat
 
     /** Preenche Sidebar Esquerda (Conhecimento) */
     async function populateKnowledgeSidebar() {
@@ -24,6 +25,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 data.areas.forEach(area => {
                     const li = document.createElement('li');
                     li.textContent = area;
+                    li.title = 'Clique para limitar as respostas a esta área';
+                    if (selectedAreas.has(area)) li.classList.add('selected');
+                    li.addEventListener('click', () => {
+                        if (selectedAreas.delete(area)) li.classList.remove('selected');
+                        else { selectedAreas.add(area); li.classList.add('selected'); }
+                    });
                     knowledgeList.appendChild(li);
                 });
             } else {
@@ -139,15 +146,21 @@ document.addEventListener('DOMContentLoaded', () => {
         const aiContentDiv = aiMessageElement.querySelector('.content');
 
         let responseBuffer = '';
+        let protocolVersion = 1; // Anunciado pelo servidor no evento 'start'
+        let sseBuffer = ''; // Guarda eventos SSE incompletos entre leituras
         let sourcesData = null; // Lista formatada para o botão
         let streamComplete = false;
         let mathJaxRendered = false; // Flag para controlar renderização MathJax
 
         try {
             const response = await fetch('/chat', {
-                 method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ message: text })
+                 method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ message: text, areas: selectedAreas.size ? [...selectedAreas] : null })
             });
 
+            if (response.status === 429) {
+                const espera = response.headers.get('Retry-After');
+                throw new Error(`Servidor ocupado. Tente novamente${espera ? ` dentro de ${espera} s` : ''}.`);
+            }
             if (!response.ok || !response.body) {
                 throw new Error(`Erro de rede: ${response.statusText}`);
             }
@@ -195,19 +208,34 @@ document.addEventListener('DOMContentLoaded', () => {
                     break; // Sai do loop
                 }
 
-                const chunk = decoder.decode(value, { stream: true });
-                const lines = chunk.split('\n\n');
+                sseBuffer += decoder.decode(value, { stream: true });
+                const lines = sseBuffer.split('\n\n');
+                // O último pedaço pode ser um evento cortado a meio: fica para a próxima leitura
+                sseBuffer = lines.pop();
 
                 for (const line of lines) {
                      if (line.startsWith('data:')) {
                         try {
                             const data = JSON.parse(line.slice(5).trim());
 
-                            if (data.type === 'source_chunks') {
+                            if (data.type === 'start') {
+                                protocolVersion = data.v || 1;
+                            }
+                            else if (data.type === 'queue') {
+                                // Ainda à espera de vez no servidor do LLM
+                                const eta = data.eta_s ? ` (cerca de ${data.eta_s} s)` : '';
+                                aiContentDiv.textContent = `A aguardar na fila: posição ${data.position}${eta}…`;
+                            }
+                            else if (data.type === 'source_chunks') {
                                 currentSourceChunks = data.content;
                             }
-                            else if (data.type === 'chunk') {
-                                responseBuffer = data.content;
+                            else if (data.type === 'chunk' || data.type === 'replace') {
+                                // v2: 'chunk' traz apenas o texto novo; v1 e 'replace' trazem o texto completo
+                                if (data.type === 'chunk' && protocolVersion >= 2) {
+                                    responseBuffer += data.content;
+                                } else {
+                                    responseBuffer = data.content;
+                                }
                                 // Atualiza apenas texto bruto + cursor
                                 aiContentDiv.textContent = responseBuffer + '█';
                                 scrollToBottom(); // Scroll durante o stream